@@ -1,38 +1,171 @@
 import logging
 import aiohttp
 import json
+import time
 import asyncio
-from typing import List, Optional
+import functools
+from typing import List, Optional, Tuple
 from config import config
+from llm_cache import LLMCache
+from telemetry import track_llm, report_llm_usage, current_command
 
 logger = logging.getLogger(__name__)
 
 class AIClient:
-    """Универсальный клиент для работы с AI провайдерами"""
+    """Универсальный клиент для работы с AI провайдерами.
+    
+    Используется один экземпляр на процесс (ai_client ниже): все запросы идут
+    через одну aiohttp-сессию с пулом keep-alive соединений и кэшем DNS,
+    поэтому DNS, TCP и TLS оплачиваются один раз, а не на каждый вызов.
+    
+    Одинаковые запросы, отправленные пока первый еще выполняется (например,
+    несколько /summary подряд), не уходят в API повторно: они ждут ответа
+    первого запроса (single-flight).
+    """
+    
+    # Провайдеры с платными запросами - только их ответы кэшируются и объединяются
+    REMOTE_PROVIDERS = ("yandex", "openai")
     
     def __init__(self):
         self.provider = config.AI_PROVIDER
+        self._session = None
+        self._session_loop = None
+        self.cache = LLMCache()
+        self._inflight = {}  # ключ запроса -> задача, ответ которой ждут все такие же вызовы
         logger.info(f"Инициализирован AI клиент с провайдером: {self.provider}")
     
-    async def chat_completion(self, messages: List[dict], max_tokens: int = None, temperature: float = None) -> Optional[str]:
-        """Основной метод для получения ответов от AI"""
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия (создается в работающем цикле событий и привязана к нему).
+        
+        Открытую сессию другого цикла не подменяем молча: ее соединения
+        остались бы незакрытыми. Перед сменой цикла нужно вызвать close().
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._session_loop is not loop:
+            raise RuntimeError("AIClient: сессия открыта в другом цикле событий, сначала вызовите close()")
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.AI_HTTP_POOL_SIZE,
+                limit_per_host=config.AI_HTTP_POOL_PER_HOST,
+                ttl_dns_cache=config.AI_HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=config.AI_HTTP_KEEPALIVE_SECONDS
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+    
+    async def warm(self):
+        """Открытие соединения с API при запуске бота - до первой команды"""
+        if self.provider != "yandex":
+            return
+        try:
+            session = self._get_session()
+            timeout = aiohttp.ClientTimeout(total=10)
+            # Нужно только открыть соединение (DNS, TCP, TLS) и оставить его в пуле:
+            # endpoint принимает лишь POST, поэтому статус ошибки (405/404) ожидаем и не проверяем
+            async with session.head(getattr(config, "YANDEX_URL"), timeout=timeout) as response:
+                logger.info(f"🔧 AI клиент: соединение с API открыто (статус {response.status})")
+        except Exception as e:
+            # Не мешаем запуску: соединение откроется при первом запросе
+            logger.warning(f"⚠️ AI клиент: не удалось заранее открыть соединение: {e}")
+    
+    async def close(self):
+        """Закрытие сессии и всех соединений пула (при остановке бота)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        # Закрытие файла кэша ждет его потока - не на цикле событий
+        await asyncio.get_running_loop().run_in_executor(None, self.cache.close)
+    
+    async def chat_completion(self, messages: List[dict], max_tokens: int = None, temperature: float = None,
+                              cache: bool = None) -> Optional[str]:
+        """Основной метод для получения ответов от AI (время и токены идут в телеметрию команды).
+        
+        cache: None - по списку команд LLM_CACHE_COMMANDS, True/False - явно для этого вызова.
+        """
+        use_cache = self._use_cache(cache)
+        coalesce = config.AI_SINGLE_FLIGHT_ENABLED and self.provider in self.REMOTE_PROVIDERS
+        key = self._cache_key(messages, max_tokens, temperature) if use_cache or coalesce else None
+        if use_cache:
+            answer = await self.cache.get(key)
+            if answer is not None:
+                logger.info("🔧 AI клиент: ответ из кэша")
+                return answer
+        
+        started = time.perf_counter()
+        answer = None
+        cacheable = False
+        leader = True
+        try:
+            if coalesce:
+                task = self._inflight.get(key)
+                leader = task is None
+                if leader:
+                    task = asyncio.ensure_future(self._chat_completion(messages, max_tokens, temperature))
+                    self._inflight[key] = task
+                    task.add_done_callback(functools.partial(self._finish_inflight, key))
+                else:
+                    logger.info("🔧 AI клиент: такой же запрос уже выполняется, ждем его ответ")
+                # Отмена одного из ожидающих не должна отменять запрос для остальных
+                answer, cacheable = await asyncio.shield(task)
+            else:
+                answer, cacheable = await self._chat_completion(messages, max_tokens, temperature)
+        finally:
+            track_llm((time.perf_counter() - started) * 1000, messages, answer, billed=leader)
+        
+        if use_cache and leader and cacheable and answer is not None:
+            await self.cache.set(key, answer)
+        return answer
+    
+    def _finish_inflight(self, key: str, task: asyncio.Task):
+        """Снятие завершенного запроса: следующий такой же пойдет в API (или в кэш)"""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+    
+    def _use_cache(self, cache: Optional[bool]) -> bool:
+        """Кэшировать ли вызов: ответы локальной заглушки не кэшируются"""
+        if not config.LLM_CACHE_ENABLED or self.provider not in self.REMOTE_PROVIDERS:
+            return False
+        if cache is not None:
+            return cache
+        return current_command() in config.LLM_CACHE_COMMANDS
+    
+    def _cache_key(self, messages: List[dict], max_tokens: int = None, temperature: float = None) -> str:
+        """Ключ кэша по фактическим параметрам запроса (с подставленными значениями по умолчанию)"""
+        if self.provider == "yandex":
+            model = getattr(config, 'YANDEX_MODEL', 'yandexgpt')
+        else:
+            model = config.AI_MODEL
+        return LLMCache.make_key(
+            self.provider, model, messages,
+            temperature or getattr(config, "AI_TEMPERATURE", 0.7),
+            max_tokens or getattr(config, "AI_MAX_TOKENS", 800)
+        )
+    
+    async def _chat_completion(self, messages: List[dict], max_tokens: int = None,
+                               temperature: float = None) -> Tuple[Optional[str], bool]:
+        """(ответ, можно ли его кэшировать): кэшируется только ответ на исходный запрос с первой попытки"""
         try:
             logger.info(f"🔧 AI клиент: запрос к {self.provider}, сообщений: {len(messages)}")
             
             if self.provider == "yandex":
                 return await self._yandex_chat(messages, max_tokens, temperature)
             elif self.provider == "openai":
-                return await self._openai_chat(messages, max_tokens, temperature)
+                return await self._openai_chat(messages, max_tokens, temperature), True
             else:
                 logger.warning("🔧 AI клиент: использование локального fallback")
-                return await self._local_fallback(messages)
+                return await self._local_fallback(messages), False
                 
         except Exception as e:
             logger.error(f"❌ Ошибка AI клиента ({self.provider}): {e}")
-            return None
+            return None, False
 
-    async def _yandex_chat(self, messages: List[dict], max_tokens: int = None, temperature: float = None) -> str:
-        """Yandex GPT API - реализация с обработкой system messages и fallback'ами"""
+    async def _yandex_chat(self, messages: List[dict], max_tokens: int = None,
+                           temperature: float = None) -> Tuple[str, bool]:
+        """Yandex GPT API - реализация с обработкой system messages и fallback'ами.
+        
+        Возвращает (ответ, False), если ответ получен упрощенным запросом.
+        """
         logger.info(f"🔧 Yandex GPT: начало обработки запроса")
         
         # Проверяем конфигурацию
@@ -83,26 +216,30 @@ class AIClient:
         logger.debug(f"🔧 Yandex GPT запрос: {json.dumps(data, ensure_ascii=False)}")
         
         try:
-            async with aiohttp.ClientSession() as session:
-                logger.info(f"🔧 Yandex GPT: отправка запроса на {getattr(config, 'YANDEX_URL', 'YANDEX_URL_NOT_SET')}")
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
-                    logger.info(f"🔧 Yandex GPT: статус ответа {response.status}")
+            session = self._get_session()
+            logger.info(f"🔧 Yandex GPT: отправка запроса на {getattr(config, 'YANDEX_URL', 'YANDEX_URL_NOT_SET')}")
+            timeout = aiohttp.ClientTimeout(total=30)
+            async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
+                logger.info(f"🔧 Yandex GPT: статус ответа {response.status}")
                     
-                    if response.status == 200:
-                        result = await response.json()
-                        answer = result['result']['alternatives'][0]['message']['text']
-                        logger.info(f"✅ Yandex GPT: успешный ответ: {answer[:100]}...")
-                        return answer
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"❌ Yandex GPT API ошибка: {response.status} - {error_text}")
+                if response.status == 200:
+                    result = await response.json()
+                    answer = result['result']['alternatives'][0]['message']['text']
+                    usage = result['result'].get('usage') or {}
+                    if usage:
+                        report_llm_usage(int(usage.get('inputTextTokens', 0)),
+                                         int(usage.get('completionTokens', 0)))
+                    logger.info(f"✅ Yandex GPT: успешный ответ: {answer[:100]}...")
+                    return answer, True
+                else:
+                    error_text = await response.text()
+                    logger.error(f"❌ Yandex GPT API ошибка: {response.status} - {error_text}")
                         
-                        if response.status == 500:
-                            # Попробуем упрощённый запрос
-                            return await self._retry_with_simple_prompt(messages)
+                    if response.status == 500:
+                        # Попробуем упрощённый запрос (его ответ не кэшируется)
+                        return await self._retry_with_simple_prompt(messages), False
                         
-                        raise Exception(f"Yandex GPT API error: {response.status} - {error_text}")
+                    raise Exception(f"Yandex GPT API error: {response.status} - {error_text}")
                         
         except aiohttp.ClientError as e:
             logger.error(f"❌ Yandex GPT: ошибка сети: {e}")
@@ -137,20 +274,20 @@ class AIClient:
             }
             
             try:
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=30)
-                    async with session.post(
-                        getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout
-                    ) as response:
+                session = self._get_session()
+                timeout = aiohttp.ClientTimeout(total=30)
+                async with session.post(
+                    getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout
+                ) as response:
                         
-                        if response.status == 200:
-                            result = await response.json()
-                            answer = result['result']['alternatives'][0]['message']['text']
-                            logger.info(f"✅ Модель {model} РАБОТАЕТ! Ответ: {answer}")
-                            return answer
-                        else:
-                            logger.warning(f"❌ Модель {model} тоже не работает: {response.status}")
-                            continue
+                    if response.status == 200:
+                        result = await response.json()
+                        answer = result['result']['alternatives'][0]['message']['text']
+                        logger.info(f"✅ Модель {model} РАБОТАЕТ! Ответ: {answer}")
+                        return answer
+                    else:
+                        logger.warning(f"❌ Модель {model} тоже не работает: {response.status}")
+                        continue
                             
             except Exception as e:
                 logger.warning(f"❌ Модель {model} ошибка: {e}")
@@ -192,14 +329,14 @@ class AIClient:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result['result']['alternatives'][0]['message']['text']
-                    else:
-                        raise Exception(f"Retry failed: {response.status}")
+            session = self._get_session()
+            timeout = aiohttp.ClientTimeout(total=30)
+            async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    return result['result']['alternatives'][0]['message']['text']
+                else:
+                    raise Exception(f"Retry failed: {response.status}")
         except Exception as e:
             logger.error(f"❌ Yandex GPT retry failed: {e}")
             raise
@@ -221,4 +358,7 @@ class AIClient:
                 break
         if not last:
             return "🤖 Локальный fallback: нет входных сообщений."
-        return f"🤖 Локальный fallback ответ на: '{last[:200]}'"
\ No newline at end of file
+        return f"🤖 Локальный fallback ответ на: '{last[:200]}'"
+
+# Один клиент и один пул соединений на весь процесс
+ai_client = AIClient()
@@ -44,6 +44,7 @@ from dotenv import load_dotenv
 import requests
 import json
 import asyncio
+import time
 import tempfile
 import subprocess
 
@@ -61,6 +62,14 @@ from telegram.ext import (
     filters
 )
 
+from ai_client import ai_client
+from database import DatabaseManager
+from scheduler import TaskScheduler
+from telemetry import command_telemetry, mark_failed, track_llm
+from handlers.questions import QuestionsHandler
+from handlers.analysis import AnalysisHandler
+from handlers.utils_handler import UtilsHandler
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -221,41 +230,6 @@ class YandexGPT:
             logger.error(f"Unexpected error: {e}")
             return "❌ Произошла непредвиденная ошибка."
 
-class DatabaseManager:
-    """Упрощенный менеджер базы данных для демонстрации"""
-    
-    def __init__(self):
-        self.messages = []
-        
-    async def get_recent_messages(self, chat_id: int, limit: int = 100):
-        """Получение последних сообщений из чата (заглушка)"""
-        try:
-            # В реальной реализации здесь был бы запрос к БД
-            # Для демонстрации возвращаем сохраненные сообщения
-            recent_messages = self.messages[-limit:] if len(self.messages) > limit else self.messages
-            return recent_messages
-        except Exception as e:
-            logger.error(f"Error getting recent messages: {e}")
-            return []
-    
-    async def save_message(self, chat_id: int, user_id: int, username: str, text: str, message_type: str = 'text'):
-        """Сохранение сообщения (заглушка)"""
-        try:
-            message_data = {
-                'chat_id': chat_id,
-                'user_id': user_id,
-                'username': username,
-                'text': text,
-                'type': message_type,
-                'timestamp': asyncio.get_event_loop().time()
-            }
-            self.messages.append(message_data)
-            logger.info(f"Message saved: {username}: {text[:50]}...")
-            return True
-        except Exception as e:
-            logger.error(f"Error saving message: {e}")
-            return False
-
 class EnhancedAIAssistant:
     def __init__(self):
         # Конфигурация (замените на ваши реальные токены)
@@ -264,8 +238,20 @@ class EnhancedAIAssistant:
         self.YANDEX_FOLDER_ID = os.getenv('YANDEX_FOLDER_ID', 'your_yandex_folder_id')
         
         # Инициализация компонентов
-        self.application = Application.builder().token(self.TELEGRAM_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(self.TELEGRAM_TOKEN)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
+        # История чатов (разделы, архив, резервные копии) и ее фоновое обслуживание
         self.db = DatabaseManager()
+        self.scheduler = TaskScheduler(self.db, self.application)
+        # Команды истории чата из handlers/ работают с той же базой
+        self.questions_handler = QuestionsHandler(self.db)
+        self.analysis_handler = AnalysisHandler(self.db)
+        self.utils_handler = UtilsHandler(self.db)
         self.media_processor = MediaProcessor()
         self.yandex_gpt = YandexGPT(
             api_key=self.YANDEX_API_KEY,
@@ -289,6 +275,23 @@ class EnhancedAIAssistant:
         # Работа с вопросами
         self.application.add_handler(CommandHandler("yagpt", self.handle_yagpt))
         
+        # История чата
+        self.application.add_handler(CommandHandler("search", self.questions_handler.handle_search))
+        self.application.add_handler(CommandHandler("stats", self.analysis_handler.handle_stats))
+        self.application.add_handler(CommandHandler("export", self.utils_handler.handle_export))
+        
+        # Обслуживание (только для администраторов чата)
+        self.application.add_handler(CommandHandler("dbstats", self.analysis_handler.handle_dbstats))
+        self.application.add_handler(CommandHandler("perf", self.analysis_handler.handle_perf))
+        # /import - ответом на файл; файл с подписью /import - это caption, а не текст команды
+        self.application.add_handler(CommandHandler("import", self.utils_handler.handle_import))
+        self.application.add_handler(
+            MessageHandler(
+                filters.Document.ALL & filters.CaptionRegex(r'^/import(@\w+)?(\s|$)'),
+                self.utils_handler.handle_import
+            )
+        )
+        
         # Утилиты
         self.application.add_handler(CommandHandler("text", self.handle_text))
         
@@ -316,16 +319,35 @@ class EnhancedAIAssistant:
             )
         )
     
+    async def post_init(self, application: Application):
+        """Прогрев общего AI клиента и запуск обслуживания хранилища (архив, очистка, резервные копии)"""
+        await ai_client.warm()
+        self.scheduler.setup_cleanup()
+        self.scheduler.setup_backups()
+        self.scheduler.start()
+    
+    async def post_shutdown(self, application: Application):
+        """Закрытие пула соединений AI клиента, остановка планировщика и сброс буферов базы"""
+        await ai_client.close()
+        # Остановка ждет текущих задач, закрытие - сброса буферов: не на цикле событий
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.scheduler.shutdown)
+        await loop.run_in_executor(None, self.db.close)
+    
     def setup_error_handler(self):
         """Настройка обработчика ошибок"""
         self.application.add_error_handler(self.error_handler)
 
     async def save_text_to_db(self, chat_id: int, user_id: int, username: str, text: str, 
-                            is_voice: bool = False, is_photo: bool = False):
+                            is_voice: bool = False, is_photo: bool = False,
+                            message_id: int = None, reply_to_message_id: int = None):
         """Сохранение текста в базу данных"""
         try:
             message_type = 'voice' if is_voice else 'photo_text' if is_photo else 'text'
-            success = await self.db.save_message(chat_id, user_id, username, text, message_type)
+            success = await self.db.aio.save_message(
+                chat_id, user_id, username, text, message_type,
+                message_id=message_id, reply_to_message_id=reply_to_message_id
+            )
             return success
         except Exception as e:
             logger.error(f"Error saving text to DB: {e}")
@@ -478,6 +500,17 @@ class EnhancedAIAssistant:
                 reply_to_message_id=update.message.message_id
             )
 
+    async def ask_yandex_gpt(self, prompt: str) -> str:
+        """Запрос к Yandex GPT в пуле потоков; время и токены идут в телеметрию команды"""
+        started = time.perf_counter()
+        response = await asyncio.get_running_loop().run_in_executor(
+            None, self.yandex_gpt.generate_response, prompt
+        )
+        # Поток пула не видит contextvars команды - учитываем вызов здесь
+        track_llm((time.perf_counter() - started) * 1000, [{"text": prompt}], response)
+        return response
+
+    @command_telemetry('dispute')
     async def handle_dispute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /dispute - сбалансированная версия с четкой позицией"""
         try:
@@ -485,13 +518,18 @@ class EnhancedAIAssistant:
 
             await update.message.chat.send_action(action="typing")
 
-            messages = await self.db.get_recent_messages(chat_id, limit=100)
+            # Ответ на сообщение - разбираем только его ветку, а не последние сообщения чата
+            thread = update.message.reply_to_message
+            if thread:
+                messages = await self.db.aio.get_thread_messages(chat_id, thread.message_id, limit=100)
+            else:
+                messages = await self.db.aio.get_recent_messages(chat_id, limit=100)
 
             if not messages:
                 await update.message.reply_text("❌ Недостаточно сообщений для анализа.")
                 return
 
-            chat_history = "\n".join([f"{msg['username']}: {msg['text']}" for msg in messages])
+            chat_history = "\n".join([f"{msg.user}: {msg.text}" for msg in messages])
 
             prompt = f"""
             Анализируй этот чат как опытный медиатор:
@@ -521,23 +559,23 @@ class EnhancedAIAssistant:
             Будь честным и прямым. Не бойся занимать четкую позицию.
             """
 
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, self.yandex_gpt.generate_response, prompt
-            )
+            response = await self.ask_yandex_gpt(prompt)
 
             result = (
                 f"⚖️ **ЭКСПЕРТНОЕ ЗАКЛЮЧЕНИЕ**\n\n"
                 f"На основе {len(messages)} сообщений:\n\n"
                 f"{response}\n\n"
-                f"📊 _Анализ проведен на основе последних сообщений чата_"
+                f"📊 _Анализ проведен на основе {'ветки ответов' if thread else 'последних сообщений чата'}_"
             )
 
             await update.message.reply_text(result)
 
         except Exception as e:
             logger.error(f"Error in dispute handler: {e}")
+            mark_failed()
             await update.message.reply_text("❌ Ошибка при анализе чата.")
 
+    @command_telemetry('text')
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Улучшенная команда /text для извлечения текста из медиа"""
         if not update.message.reply_to_message:
@@ -559,6 +597,7 @@ class EnhancedAIAssistant:
                 "❌ Ответьте на голосовое сообщение или изображение для извлечения текста."
             )
 
+    @command_telemetry('yagpt')
     async def handle_yagpt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /yagpt - Яндекс GPT"""
         if not context.args:
@@ -574,14 +613,13 @@ class EnhancedAIAssistant:
         await update.message.chat.send_action(action="typing")
         
         try:
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, self.yandex_gpt.generate_response, question
-            )
+            response = await self.ask_yandex_gpt(question)
             await update.message.reply_text(response)
             logger.info(f"Yandex GPT request from user {update.effective_user.id}: {question[:50]}...")
             
         except Exception as e:
             logger.error(f"Error in Yandex GPT handler: {e}")
+            mark_failed()
             await update.message.reply_text("🚫 Произошла ошибка при обработке вашего запроса через Яндекс GPT.")
 
     async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -591,9 +629,12 @@ class EnhancedAIAssistant:
             chat = update.effective_chat
             text = update.message.text
             
-            # Сохраняем текстовое сообщение в базу
+            # Сохраняем текстовое сообщение в базу (с привязкой к ветке ответов)
+            reply_to = update.message.reply_to_message
             success = await self.save_text_to_db(
-                chat.id, user.id, user.first_name, text, is_voice=False, is_photo=False
+                chat.id, user.id, user.first_name, text, is_voice=False, is_photo=False,
+                message_id=update.message.message_id,
+                reply_to_message_id=reply_to.message_id if reply_to else None
             )
             
             if success:
@@ -604,6 +645,7 @@ class EnhancedAIAssistant:
         except Exception as e:
             logger.error(f"Error saving text message: {e}")
 
+    @command_telemetry('start')
     async def handle_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /start с информацией о новых функциях"""
         welcome_text = """
@@ -632,6 +674,7 @@ class EnhancedAIAssistant:
         """
         await update.message.reply_text(welcome_text) 
     
+    @command_telemetry('help')
     async def handle_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /help с информацией о медиа-функциях"""
         help_text = """
@@ -648,6 +691,16 @@ class EnhancedAIAssistant:
 **❓ Работа с вопросами:**
 • /yagpt [вопрос] - Ответ через Яндекс GPT
 
+**🗂 История чата:**
+• /search [слова] - Поиск сообщений по словам (без AI)
+• /stats [дни] - Статистика активности чата за период
+• /export [дни|all] [jsonl|csv] - Выгрузка истории файлом
+
+**🛠 Для администраторов:**
+• /dbstats - Размер базы и медленные запросы
+• /perf [12h|7d] - Время выполнения команд и кэш AI
+• /import - Загрузка истории из result.json Telegram Desktop
+
 **ℹ️ Примечания:**
 - Голосовые сообщения автоматически распознаются и сохраняются
 - Текст с изображений автоматически извлекается и сохраняется
@@ -655,6 +708,7 @@ class EnhancedAIAssistant:
         """
         await update.message.reply_text(help_text)
 
+    @command_telemetry('about')
     async def handle_about(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /about"""
         about_text = """
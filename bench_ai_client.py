@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк задержки одного запроса к AI API
+Сравнивает старую схему (новая aiohttp-сессия на каждый запрос) с общей сессией AIClient
+
+Запросы идут на локальный сервер с ответом в формате Yandex GPT, поэтому
+измеряется только накладная стоимость клиента: DNS, TCP и создание сессии.
+С настоящим API к этому добавляется TLS-рукопожатие, и выигрыш больше.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import statistics
+
+import aiohttp
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from config import config
+from ai_client import ai_client
+
+REQUESTS = 300
+MESSAGES = [{"role": "user", "content": "Привет"}]
+
+async def completion(request: web.Request) -> web.Response:
+    await request.json()
+    return web.json_response({
+        "result": {"alternatives": [{"message": {"role": "assistant", "text": "Ответ"}}]}
+    })
+
+async def start_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post("/completion", completion)
+    app.router.add_route("HEAD", "/completion", lambda request: web.Response())
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", 0).start()
+    return runner
+
+async def bench_session_per_request(url: str) -> list:
+    """Старое поведение: новая сессия (и соединение) на каждый запрос"""
+    latencies = []
+    for _ in range(REQUESTS):
+        started = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"messages": MESSAGES}) as response:
+                await response.json()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+async def bench_shared_session() -> list:
+    """Новое поведение: общий AIClient с пулом keep-alive соединений"""
+    await ai_client.warm()
+    latencies = []
+    for _ in range(REQUESTS):
+        started = time.perf_counter()
+        await ai_client.chat_completion(MESSAGES)
+        latencies.append(time.perf_counter() - started)
+    await ai_client.close()
+    return latencies
+
+async def main():
+    logging.disable(logging.CRITICAL)  # AIClient логирует каждый запрос
+
+    runner = await start_server()
+    port = runner.addresses[0][1]
+    url = f"http://localhost:{port}/completion"
+
+    config.YANDEX_URL = url
+    config.YANDEX_API_KEY = config.YANDEX_API_KEY or "bench"
+    config.YANDEX_FOLDER_ID = config.YANDEX_FOLDER_ID or "bench"
+    ai_client.provider = "yandex"
+
+    print(f"⏱️ Бенчмарк {REQUESTS} запросов к AI API (локальный сервер)")
+    print("=" * 50)
+
+    try:
+        before = statistics.median(await bench_session_per_request(url)) * 1000
+        after = statistics.median(await bench_shared_session()) * 1000
+    finally:
+        await runner.cleanup()
+
+    print(f"До (сессия на запрос):          {before:6.2f} мс/запрос (медиана)")
+    print(f"После (общая сессия + пул):     {after:6.2f} мс/запрос (медиана)")
+    print(f"Выигрыш: {before - after:.2f} мс на запрос (x{before / after:.1f})")
+
+if __name__ == "__main__":
+    asyncio.run(main())
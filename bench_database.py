@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк стоимости сохранения одного сообщения в базу данных
+Сравнивает старую схему (connect/close на каждое сообщение) с пулом соединений
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import DatabaseManager
+
+MESSAGES = 2000
+
+def make_row(i: int) -> tuple:
+    return (-100123, 1000 + i % 25, f"user{i % 25}", f"Тестовое сообщение номер {i}", 'text', None, None, False)
+
+def bench_connect_per_message(db_path: str) -> float:
+    """Старое поведение: новое соединение на каждое сообщение"""
+    conn = sqlite3.connect(db_path)  # прежняя схема: одна таблица messages
+    conn.execute('''
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            message_text TEXT,
+            message_type TEXT DEFAULT 'text',
+            media_file_id TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            reply_to_message_id INTEGER,
+            is_forwarded BOOLEAN DEFAULT 0
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_messages_chat_timestamp ON messages(chat_id, timestamp DESC)")
+    conn.close()
+    started = time.perf_counter()
+    for i in range(MESSAGES):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO messages
+            (chat_id, user_id, user_name, message_text, message_type,
+             media_file_id, reply_to_message_id, is_forwarded)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', make_row(i))
+        conn.commit()
+        conn.close()
+    return time.perf_counter() - started
+
+def bench_pooled(db_path: str, write_buffer: bool = False) -> float:
+    """Новое поведение: долгоживущие соединения пула (и буфер отложенной записи)"""
+    db = DatabaseManager(db_path, write_buffer=write_buffer)
+    started = time.perf_counter()
+    for i in range(MESSAGES):
+        db.save_message(*make_row(i))
+    db.flush_messages()
+    elapsed = time.perf_counter() - started
+    db.close()
+    return elapsed
+
+def main():
+    print(f"⏱️ Бенчмарк сохранения {MESSAGES} сообщений")
+    print("=" * 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = bench_connect_per_message(os.path.join(tmp, "before.db"))
+        after = bench_pooled(os.path.join(tmp, "after.db"))
+        buffered = bench_pooled(os.path.join(tmp, "buffered.db"), write_buffer=True)
+
+    per_before = before / MESSAGES * 1e6
+    per_after = after / MESSAGES * 1e6
+    per_buffered = buffered / MESSAGES * 1e6
+
+    print(f"До (connect/close на сообщение): {per_before:8.1f} мкс/сообщение")
+    print(f"После (пул соединений + WAL):     {per_after:8.1f} мкс/сообщение")
+    print(f"После (буфер + executemany):      {per_buffered:8.1f} мкс/сообщение")
+    print(f"Ускорение: x{per_before / per_after:.1f} (пул), x{per_before / per_buffered:.1f} (буфер)")
+
+if __name__ == "__main__":
+    main()
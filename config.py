@@ -58,6 +58,23 @@ class Config:
     # Температура для генерации (0-1)
     AI_TEMPERATURE: float = 0.7
     
+    # HTTP-соединения с AI API: одна сессия с пулом keep-alive на процесс
+    AI_HTTP_POOL_SIZE: int = 20  # всего соединений
+    AI_HTTP_POOL_PER_HOST: int = 10
+    AI_HTTP_DNS_CACHE_TTL: int = 300  # секунд
+    AI_HTTP_KEEPALIVE_SECONDS: int = 60
+    
+    # Кэш ответов AI (LRU в памяти + SQLite-файл) для команд, где одинаковый промпт - одинаковый ответ
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_COMMANDS: List[str] = ["summary", "themes", "brief", "ask", "gpt"]
+    LLM_CACHE_MEMORY_SIZE: int = 256  # ответов в памяти
+    LLM_CACHE_TTL: int = 6 * 3600  # секунд
+    LLM_CACHE_DB_PATH: str = "llm_cache.db"  # пустая строка - только память
+    LLM_CACHE_DB_MAX_ROWS: int = 5000
+    
+    # Одинаковые запросы к AI, отправленные одновременно, ждут один ответ
+    AI_SINGLE_FLIGHT_ENABLED: bool = True
+    
     # Модель для распознавания голоса
     WHISPER_MODEL: str = "whisper-1"
     
@@ -75,6 +92,15 @@ class Config:
     # Максимальное количество сообщений для анализа тем
     THEMES_MAX_MESSAGES: int = 100
     
+    # Длина одного сообщения в тексте для AI (длиннее - обрезается еще в базе)
+    SUMMARY_MESSAGE_MAX_CHARS: int = 300
+    ASK_MESSAGE_MAX_CHARS: int = 200
+    OPINION_MESSAGE_MAX_CHARS: int = 150
+    COMMENT_MESSAGE_MAX_CHARS: int = 100
+    # Бюджет истории в промпте (оценка токенов считается при записи сообщения)
+    SUMMARY_TOKEN_BUDGET: int = 6000
+    ASK_TOKEN_BUDGET: int = 4000
+    
     # Минимальная длина текста для команды /brief
     BRIEF_MIN_LENGTH: int = 100
     
@@ -92,6 +118,9 @@ class Config:
     # Максимальное количество токенов для /gpt
     GPT_MAX_TOKENS: int = 1200
     
+    # Количество результатов для /search
+    SEARCH_RESULTS_LIMIT: int = 10
+    
     # ===== НАСТРОЙКИ АНАЛИЗА =====
     
     # Количество сообщений по умолчанию для /opinion
@@ -105,6 +134,9 @@ class Config:
     
     # Количество сообщений для /comment
     COMMENT_MESSAGE_LIMIT: int = 30
+
+    # Минимальное количество сообщений в чате для /comment
+    COMMENT_MIN_MESSAGES: int = 5
     
     # Максимальное количество токенов для анализа
     ANALYSIS_MAX_TOKENS: int = 1000
@@ -136,10 +168,69 @@ class Config:
     MESSAGE_RETENTION_DAYS: int = 90
     CLEANUP_INTERVAL_HOURS: int = 24
     
+    # Пул соединений SQLite (один писатель + читатели)
+    DB_READER_POOL_SIZE: int = 4
+    DB_BUSY_TIMEOUT_MS: int = 5000
+    DB_CACHE_SIZE_KB: int = 16 * 1024  # 16MB страничного кэша на соединение
+    DB_MMAP_SIZE: int = 256 * 1024 * 1024  # 256MB
+    DB_STATEMENT_CACHE_SIZE: int = 256
+    DB_MAX_PENDING_QUERIES: int = 1000  # очередь асинхронных запросов к БД
+    
+    # Наблюдаемость запросов: гистограммы времени и журнал медленных с планом (/dbstats)
+    DB_QUERY_STATS_ENABLED: bool = True
+    DB_SLOW_QUERY_MS: int = 100
+    
+    # Телеметрия команд (пишется в command_stats пачками, отчет - /perf)
+    COMMAND_STATS_BATCH_SIZE: int = 100
+    COMMAND_STATS_FLUSH_MS: int = 5000
+    PERF_DEFAULT_HOURS: int = 24
+    PERF_MAX_HOURS: int = 30 * 24
+    
+    # Буфер отложенной записи сообщений
+    DB_WRITE_BUFFER_ENABLED: bool = True
+    DB_WRITE_BUFFER_MAX_ROWS: int = 500  # сброс по количеству строк
+    DB_WRITE_BUFFER_FLUSH_MS: int = 200  # сброс по времени
+    DB_WRITE_BUFFER_CAPACITY: int = 10000  # при заполнении отправители ждут сброса
+    
+    # Потоковое чтение истории (строк за один fetchmany)
+    DB_STREAM_CHUNK_SIZE: int = 500
+    
+    # Импорт истории из экспорта Telegram Desktop (строк в одной транзакции)
+    IMPORT_BATCH_SIZE: int = 50000
+    IMPORT_MAX_FILE_SIZE: int = 20 * 1024 * 1024  # больше бот скачать не может - только CLI
+    
+    # Фоновые миграции схемы (пачками, без остановки бота)
+    DB_MIGRATION_BATCH_SIZE: int = 5000
+    DB_MIGRATION_PAUSE_MS: int = 20  # пауза между пачками - время для записи
+    
+    # Онлайн-резервные копии (SQLite backup API)
+    DB_BACKUP_DIR: str = "backups"
+    DB_BACKUP_INTERVAL_HOURS: int = 24
+    DB_BACKUP_PAGES_PER_STEP: int = 256  # страниц за шаг копирования
+    DB_BACKUP_STEP_PAUSE_MS: int = 10  # пауза между шагами - время для записи
+    DB_BACKUP_COMPRESS: bool = True  # gzip копии
+    
+    # Холодный архив: разделы старше MESSAGE_RETENTION_DAYS сжимаются в блоки по чату и месяцу
+    MESSAGE_ARCHIVE_ENABLED: bool = True
+    MESSAGE_ARCHIVE_RETENTION_DAYS: int = 0  # 0 - хранить архив бессрочно
+    
+    # Шардирование сообщений по чатам (0 - один файл; число шардов после запуска не меняется)
+    DB_SHARD_COUNT: int = 0
+    
+    # Разделы сообщений по времени (месяцев в одном разделе)
+    DB_PARTITION_MONTHS: int = 1
+    
+    # Время жизни кэша настроек чатов (в секундах)
+    CHAT_SETTINGS_CACHE_TTL: int = 300
+    
     # Настройки статистики
     STATS_DEFAULT_DAYS: int = 30
     MAX_STATS_DAYS: int = 365
     
+    # Выгрузка истории (/export)
+    EXPORT_DEFAULT_DAYS: int = 30
+    MAX_EXPORT_FILE_SIZE: int = 50 * 1024 * 1024  # лимит Telegram на документ от бота
+    
     # ===== ПРОМПТЫ ДЛЯ AI =====
     
     # Системные промпты для разных функций
@@ -6,13 +6,19 @@ MAX_CAPTION_LENGTH = 1024
 
 # Команды бота
 COMMANDS = {
-    'summary': 'Суммаризация последних сообщений',
+    'summary': 'Суммаризация последних сообщений (ответом - только ветки)',
     'themes': 'Тезисный анализ тем',
     'comment': 'Комментарий к текущей теме',
     'brief': 'Краткое изложение сообщения',
     'ask': 'Ответ на вопрос по истории чата',
     'gpt': 'Ответ на любой вопрос',
+    'search': 'Поиск по истории чата',
     'opinion': 'Анализ пользователя',
+    'stats': 'Статистика активности чата',
+    'export': 'Выгрузка истории чата файлом',
+    'import': 'Загрузка истории из экспорта Telegram Desktop (для админов)',
+    'dbstats': 'Размеры базы данных и медленные запросы (для админов)',
+    'perf': 'Время выполнения команд: p50/p95/p99 (для админов)',
     'text': 'Извлечение текста из медиа',
     'help': 'Справка по командам'
 }
@@ -1,279 +1,2684 @@
 import sqlite3
 import logging
-from typing import List, Dict, Optional, Tuple
-from datetime import datetime, timedelta
+import queue
+import atexit
+import asyncio
+import functools
+import threading
+import contextvars
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Tuple, Iterator, Iterable, Callable, TextIO, NamedTuple
+from datetime import datetime, timedelta, timezone
+import os
+import bisect
+import csv
 import json
+import re
+import zlib
+import base64
+
+from config import config
+from telemetry import track_db
 
 logger = logging.getLogger(__name__)
 
+class MessageRecord(NamedTuple):
+    """Сообщение чата, как его возвращают методы чтения DatabaseManager.
+    
+    Кортеж без словаря атрибутов: заметно компактнее dict на больших выборках.
+    """
+    user: str
+    text: Optional[str]
+    timestamp: str
+    type: str
+    user_id: Optional[int] = None
+    id: Optional[int] = None
+    message_id: Optional[int] = None  # id сообщения в Telegram
+
+class ChatCounters(NamedTuple):
+    """Счетчики активности чата из таблицы chat_counters.
+    
+    total - все сохраненные сообщения чата (очистка старых разделов его не
+    уменьшает), поэтому "сколько сообщений с момента X" - разность двух
+    снимков total. day_count - сообщения за день day (UTC) последнего сообщения.
+    """
+    total: int = 0
+    last_id: Optional[int] = None
+    last_message_id: Optional[int] = None  # id сообщения в Telegram
+    last_timestamp: Optional[int] = None  # секунды Unix
+    day: Optional[str] = None
+    day_count: int = 0
+    
+    @property
+    def today(self) -> int:
+        """Сообщения за сегодня (UTC)"""
+        return self.day_count if self.day == datetime.now(timezone.utc).strftime('%Y-%m-%d') else 0
+
+class QueryMonitor:
+    """Время запросов к SQLite: гистограммы по именам запросов и журнал медленных.
+    
+    Имя запроса - метод DatabaseManager, который его выполнил (вспомогательные
+    методы обхода разделов пропускаются, см. named_queries). Запрос дольше DB_SLOW_QUERY_MS
+    пишется в лог вместе с EXPLAIN QUERY PLAN; план снимается один раз на
+    текст запроса. Для потоковых курсоров учитывается время до первой строки.
+    """
+    
+    # Верхние границы корзин гистограммы, мс
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+    
+    # Методы, от имени которых запрос не считается (имя - у вызвавшего их метода)
+    HELPERS = frozenset((
+        'transaction', 'reader', '_query_partitions', '_stream_partitions', '_query_budget'
+    ))
+    
+    MAX_SLOW_QUERIES = 200  # различных медленных запросов в памяти
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}  # имя -> [счетчики корзин..., всего, сумма мс, максимум мс]
+        self.slow = {}  # текст запроса -> сведения о самом медленном выполнении
+    
+    def query_name(self, sql: str) -> str:
+        """Имя выполняющегося метода (первые слова SQL вне методов базы)"""
+        return _query_name.get() or ' '.join(sql.split()[:2])
+    
+    def record(self, name: str, sql: str, elapsed_ms: float, explain: Callable = None):
+        """Учет выполнения запроса; explain() вызывается только для медленных"""
+        index = bisect.bisect_left(self.BUCKETS, elapsed_ms)
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(self.BUCKETS) + 4)
+            histogram[index] += 1
+            histogram[-3] += 1
+            histogram[-2] += elapsed_ms
+            histogram[-1] = max(histogram[-1], elapsed_ms)
+            
+            if elapsed_ms < config.DB_SLOW_QUERY_MS:
+                return
+            entry = self.slow.get(sql)
+            known_plan = entry is not None
+            if entry is None:
+                entry = self.slow[sql] = {'name': name, 'sql': sql, 'plan': None, 'count': 0, 'max_ms': 0.0}
+            entry['count'] += 1
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            if len(self.slow) > self.MAX_SLOW_QUERIES:
+                del self.slow[min(self.slow, key=lambda key: self.slow[key]['max_ms'])]
+        
+        if not known_plan and explain is not None:
+            entry['plan'] = explain()
+        logger.warning(
+            f"Slow query {name}: {elapsed_ms:.1f} ms\n{' '.join(sql.split())}"
+            + (f"\nQUERY PLAN:\n{entry['plan']}" if entry['plan'] else "")
+        )
+    
+    def percentile(self, name: str, p: float) -> Optional[float]:
+        """Оценка перцентиля по гистограмме (верхняя граница корзины), мс"""
+        histogram = self.histograms.get(name)
+        if not histogram or not histogram[-3]:
+            return None
+        rank = histogram[-3] * p / 100
+        seen = 0
+        for bound, count in zip(self.BUCKETS, histogram):
+            seen += count
+            if seen >= rank:
+                return min(float(bound), histogram[-1])
+        return histogram[-1]
+    
+    def summary(self) -> List[Dict]:
+        """Сводка по именам запросов, по убыванию суммарного времени"""
+        with self._lock:
+            names = [(name, histogram[-3], histogram[-2], histogram[-1])
+                     for name, histogram in self.histograms.items()]
+        return [
+            {'name': name, 'count': count, 'total_ms': total, 'max_ms': slowest,
+             'p50_ms': self.percentile(name, 50), 'p95_ms': self.percentile(name, 95),
+             'p99_ms': self.percentile(name, 99)}
+            for name, count, total, slowest in sorted(names, key=lambda item: -item[2])
+        ]
+    
+    def top_slow(self, limit: int = 10) -> List[Dict]:
+        """Самые медленные запросы (по максимальному времени)"""
+        with self._lock:
+            entries = [dict(entry) for entry in self.slow.values()]
+        return sorted(entries, key=lambda entry: -entry['max_ms'])[:limit]
+    
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.slow.clear()
+
+# Общий для всех баз (и шардов) процесса
+query_monitor = QueryMonitor()
+
+# Метод базы, который сейчас выполняется в этом потоке (задача, контекст)
+_query_name = contextvars.ContextVar('query_name', default=None)
+
+def named_queries(cls):
+    """Декоратор класса: запросы его методов учитываются под именем метода.
+    
+    Имя ставится один раз на вызов метода, а не ищется по стеку на каждый
+    запрос; у вложенных вызовов побеждает внутренний метод.
+    """
+    def named(name, method):
+        if inspect.isgeneratorfunction(inspect.unwrap(method)):
+            @functools.wraps(method)
+            def generator(*args, **kwargs):
+                previous = _query_name.set(name).old_value
+                try:
+                    yield from method(*args, **kwargs)
+                finally:
+                    _query_name.set(None if previous is contextvars.Token.MISSING else previous)
+            return generator
+        
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            token = _query_name.set(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                _query_name.reset(token)
+        return wrapper
+    
+    for name, member in list(vars(cls).items()):
+        if inspect.isfunction(member) and not name.startswith('__') and name not in QueryMonitor.HELPERS:
+            setattr(cls, name, named(name, member))
+    return cls
+
+class MonitoredCursor(sqlite3.Cursor):
+    """Курсор, сообщающий время каждого запроса в query_monitor"""
+    
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            query_monitor.record(
+                query_monitor.query_name(sql), sql, (time.perf_counter() - started) * 1000,
+                lambda: self._explain(sql, parameters)
+            )
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # План пачки не снимается: параметры уже прочитаны
+            query_monitor.record(
+                query_monitor.query_name(sql), sql, (time.perf_counter() - started) * 1000
+            )
+    
+    def _explain(self, sql: str, parameters) -> Optional[str]:
+        """EXPLAIN QUERY PLAN запроса обычным курсором (без повторного учета)"""
+        if sql.split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+            return None
+        try:
+            rows = self.connection.cursor(sqlite3.Cursor).execute(
+                f"EXPLAIN QUERY PLAN {sql}", parameters
+            ).fetchall()
+            return "\n".join(detail for *_, detail in rows)
+        except sqlite3.Error:
+            return None
+
+class MonitoredConnection(sqlite3.Connection):
+    """Соединение, все запросы которого идут через MonitoredCursor"""
+    
+    def cursor(self, factory=MonitoredCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+@named_queries
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite: один писатель и несколько читателей"""
+
+    def __init__(self, db_path: str, readers: int = None):
+        self.db_path = db_path
+        self._write_lock = threading.RLock()
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer.execute("PRAGMA synchronous = NORMAL")
+
+        # In-memory база видна только своему соединению - читаем через писателя
+        if readers is None:
+            readers = config.DB_READER_POOL_SIZE
+        if db_path == ":memory:":
+            readers = 0
+
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
+        self._readers_count = readers
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения с настройками производительности"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=config.DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=config.DB_STATEMENT_CACHE_SIZE,
+            factory=MonitoredConnection if config.DB_QUERY_STATS_ENABLED else sqlite3.Connection
+        )
+        conn.execute(f"PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT_MS)}")
+        conn.execute(f"PRAGMA cache_size = -{int(config.DB_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size = {int(config.DB_MMAP_SIZE)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Соединение писателя внутри транзакции (commit/rollback автоматически)"""
+        with self._write_lock:
+            with self._writer:
+                yield self._writer
+
+    @contextmanager
+    def reader(self):
+        """Соединение для чтения из пула"""
+        if not self._readers_count:
+            with self._write_lock:
+                yield self._writer
+            return
+
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def backup(self, target: sqlite3.Connection, pages: int, pause: float, progress=None):
+        """Онлайн-копия базы через соединение писателя.
+        
+        Копируется по pages страниц за шаг; между шагами блокировка писателя
+        отпускается на pause секунд, и запись сообщений продолжается. Изменения,
+        сделанные через это же соединение, сразу попадают в копию, поэтому
+        копирование не начинается заново после каждой записи.
+        """
+        def step(status, remaining, total):
+            if progress is not None:
+                progress(remaining, total)
+            if remaining:
+                self._write_lock.release()
+                try:
+                    time.sleep(pause)
+                finally:
+                    self._write_lock.acquire()
+        
+        with self._write_lock:
+            self._writer.backup(target, pages=pages, progress=step)
+
+    def close(self):
+        """Закрытие всех соединений пула"""
+        for _ in range(self._readers_count):
+            self._readers.get().close()
+        self._readers_count = 0
+        with self._write_lock:
+            self._writer.close()
+
+class AsyncDatabaseManager:
+    """Неблокирующий фасад над DatabaseManager для использования в корутинах.
+
+    Любой публичный метод DatabaseManager доступен как корутина:
+    ``await db.aio.get_recent_messages(chat_id, 50)``. Запросы выполняются
+    в отдельных потоках БД, а число ожидающих запросов ограничено, чтобы
+    цикл событий никогда не блокировался на дисковом вводе-выводе.
+    """
+
+    def __init__(self, db: 'DatabaseManager', workers: int = None, max_pending: int = None):
+        self._db = db
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or config.DB_READER_POOL_SIZE + 1,
+            thread_name_prefix="db"
+        )
+        self._max_pending = max_pending or config.DB_MAX_PENDING_QUERIES
+        self._slots = None  # Семафор создается внутри работающего цикла событий
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнение синхронной функции в потоке БД"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_pending)
+
+        started = time.perf_counter()
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, functools.partial(func, *args, **kwargs)
+                )
+        finally:
+            # Время с ожиданием очереди - столько команда ждала базу
+            track_db((time.perf_counter() - started) * 1000)
+
+    def __getattr__(self, name: str):
+        method = getattr(self._db, name)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        return call
+
+    def shutdown(self):
+        """Остановка потоков БД с ожиданием текущих запросов"""
+        self._executor.shutdown(wait=True)
+
+class MessageBuffer:
+    """Буфер отложенной записи (write-behind) входящих сообщений.
+
+    Сообщения всех чатов копятся в памяти и записываются одной транзакцией
+    каждые DB_WRITE_BUFFER_FLUSH_MS миллисекунд или по достижении
+    DB_WRITE_BUFFER_MAX_ROWS строк. Переполненный буфер блокирует
+    отправителя до ближайшего сброса.
+    """
+
+    def __init__(self, flush_func, max_rows: int = None, interval_ms: int = None,
+                 capacity: int = None):
+        self._flush_func = flush_func
+        self.max_rows = max_rows or config.DB_WRITE_BUFFER_MAX_ROWS
+        self.interval = (interval_ms or config.DB_WRITE_BUFFER_FLUSH_MS) / 1000
+        self.capacity = capacity or config.DB_WRITE_BUFFER_CAPACITY
+
+        self._rows = []
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # Сбросы выполняются строго по одному
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name="db-flusher", daemon=True)
+        self._thread.start()
+        # Не теряем накопленные сообщения при завершении процесса
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+    def put(self, row: Dict, block: bool = True) -> bool:
+        """Добавление строки в буфер.
+        
+        Если буфер заполнен, ждет сброса, а при block=False сразу возвращает
+        False (строка не добавлена).
+        """
+        with self._not_full:
+            while len(self._rows) >= self.capacity and not self._stopped:
+                self._wakeup.set()
+                if not block:
+                    return False
+                self._not_full.wait()
+
+            self._rows.append(row)
+            if len(self._rows) >= self.max_rows:
+                self._wakeup.set()
+            return True
+
+    def flush(self) -> int:
+        """Запись всех накопленных строк. Возвращает количество записанных строк"""
+        with self._flush_lock:
+            with self._not_full:
+                rows, self._rows = self._rows, []
+                self._not_full.notify_all()
+
+            if rows:
+                self._flush_func(rows)
+            return len(rows)
+
+    def _run(self):
+        """Фоновый поток периодического сброса"""
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing message buffer: {e}")
+
+    def close(self):
+        """Остановка фонового потока и финальный сброс"""
+        with self._not_full:
+            self._stopped = True
+            self._not_full.notify_all()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+class ChatSettingsService:
+    """Настройки чатов с кэшем в памяти (write-through).
+    
+    Один экземпляр на DatabaseManager (``db.settings``) используется всеми
+    обработчиками: повторные чтения в пределах CHAT_SETTINGS_CACHE_TTL
+    не обращаются к диску, а любое изменение через сервис сразу обновляет кэш.
+    """
+    
+    def __init__(self, db: 'DatabaseManager', ttl: int = None):
+        self.db = db
+        self.ttl = ttl if ttl is not None else config.CHAT_SETTINGS_CACHE_TTL
+        self._cache = {}  # chat_id -> (срок годности, настройки)
+        self._lock = threading.Lock()
+    
+    def _cached(self, chat_id: int) -> Optional[Dict]:
+        with self._lock:
+            entry = self._cache.get(chat_id)
+            if entry and entry[0] > time.monotonic():
+                return dict(entry[1])
+            return None
+    
+    def _store(self, chat_id: int, settings: Dict):
+        if settings:  # Пустой словарь - ошибка чтения, не кэшируем
+            with self._lock:
+                self._cache[chat_id] = (time.monotonic() + self.ttl, dict(settings))
+    
+    async def get(self, chat_id: int) -> Dict:
+        """Настройки чата (из кэша, при промахе - из базы)"""
+        settings = self._cached(chat_id)
+        if settings is None:
+            settings = await self.db.aio.get_chat_settings(chat_id)
+            self._store(chat_id, settings)
+        return settings
+    
+    async def update(self, chat_id: int, **kwargs) -> bool:
+        """Изменение настроек чата с обновлением кэша"""
+        self.invalidate(chat_id)
+        success = await self.db.aio.update_chat_settings(chat_id, **kwargs)
+        if success:
+            self._store(chat_id, await self.db.aio.get_chat_settings(chat_id))
+        return success
+    
+    def invalidate(self, chat_id: int = None):
+        """Сброс кэша одного чата или всех чатов"""
+        with self._lock:
+            if chat_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(chat_id, None)
+
+@named_queries
+class SchemaMigrator:
+    """Версионные миграции схемы базы данных.
+    
+    Миграция - метод DatabaseManager с номером версии. Быстрые миграции (DDL)
+    выполняются при запуске внутри транзакции инициализации. Долгие (online)
+    идут в фоновом потоке пачками, каждая пачка - отдельная короткая
+    транзакция, так что бот продолжает принимать сообщения. Примененные
+    версии записываются в таблицу schema_migrations.
+    """
+    
+    # (версия, имя, метод DatabaseManager, online)
+    MIGRATIONS = [
+        (1, 'epoch_timestamps', '_migrate_epoch_timestamps', True),
+        (2, 'telegram_message_ids', '_migrate_message_ids', False),
+        (3, 'message_threads', '_migrate_message_threads', False),
+        (4, 'enrichment_columns', '_migrate_enrichment_columns', False),
+        (5, 'enrichment_backfill', '_migrate_enrichment_backfill', True),
+        (6, 'chat_counters', '_migrate_chat_counters', False),
+        (7, 'command_telemetry', '_migrate_command_telemetry', False),
+        (8, 'archive_prefixes', '_migrate_archive_prefixes', False),
+        (9, 'archive_prefixes_backfill', '_migrate_archive_prefixes_backfill', True),
+    ]
+    
+    def __init__(self, db: 'DatabaseManager'):
+        self.db = db
+        self.applied = set()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def apply_startup(self, cursor: sqlite3.Cursor, fresh: bool = False):
+        """Создание журнала миграций и применение быстрых миграций.
+        
+        fresh - база только что создана: online-миграции переводят старые
+        данные, а их здесь нет, поэтому они сразу отмечаются примененными
+        (новая база с первой записи хранит время в секундах Unix).
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("SELECT version FROM schema_migrations")
+        self.applied = {row[0] for row in cursor.fetchall()}
+        
+        for version, name, method, online in self.MIGRATIONS:
+            if version in self.applied:
+                continue
+            if not online:
+                getattr(self.db, method)(cursor)
+                self.record(cursor, version, name)
+            elif fresh:
+                self.record(cursor, version, name)
+    
+    def record(self, cursor: sqlite3.Cursor, version: int, name: str):
+        """Отметка миграции как примененной (внутри ее последней транзакции)"""
+        cursor.execute(
+            "INSERT OR IGNORE INTO schema_migrations (version, name) VALUES (?, ?)",
+            (version, name)
+        )
+        self.applied.add(version)
+        logger.info(f"Applied schema migration {version}: {name}")
+    
+    def is_applied(self, version: int) -> bool:
+        return version in self.applied
+    
+    def start(self):
+        """Запуск ожидающих online-миграций в фоне"""
+        pending = [m for m in self.MIGRATIONS if m[3] and m[0] not in self.applied]
+        if pending:
+            self._thread = threading.Thread(
+                target=self._run, args=(pending,), name="db-migrator", daemon=True
+            )
+            self._thread.start()
+    
+    def _run(self, pending: List[Tuple]):
+        for version, name, method, _ in pending:
+            try:
+                logger.info(f"Starting online schema migration {version}: {name}")
+                # Метод выполняет миграцию пачками и сам вызывает record
+                # в последней транзакции; False - прервана остановкой
+                if not getattr(self.db, method)(version, name, self._stop):
+                    return
+            except Exception as e:
+                logger.error(f"Schema migration {version} failed, will retry on restart: {e}")
+                return
+    
+    def close(self):
+        """Остановка фоновой миграции (продолжится при следующем запуске)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+def routed_by_chat(method):
+    """Метод, работающий с сообщениями одного чата.
+    
+    В режиме шардирования вызов целиком выполняет шард, которому принадлежит
+    chat_id, - запросы никогда не расходятся по нескольким файлам.
+    """
+    @functools.wraps(method)
+    def wrapper(self, chat_id: int, *args, **kwargs):
+        if self.shards:
+            return getattr(self.shard_for(chat_id), method.__name__)(chat_id, *args, **kwargs)
+        return method(self, chat_id, *args, **kwargs)
+    return wrapper
+
+@named_queries
 class DatabaseManager:
-    """Менеджер базы данных для хранения сообщений и настроек чатов"""
+    """Менеджер базы данных для хранения сообщений и настроек чатов.
+    
+    При DB_SHARD_COUNT > 0 сообщения чатов распределяются по N файлам-шардам
+    (chat_data.shard0.db, ...), у каждого свой писатель и свой буфер записи,
+    поэтому активный чат не задерживает запись остальных. Основной файл
+    остается каталогом: настройки чатов, статистика команд, извлеченные тексты.
+    """
+
+    # Колонки телеметрии команд в command_stats (см. telemetry.py)
+    COMMAND_TELEMETRY_COLUMNS = (
+        ('wall_ms', 'REAL'), ('db_ms', 'REAL'), ('llm_ms', 'REAL'), ('llm_calls', 'INTEGER'),
+        ('prompt_tokens', 'INTEGER'), ('completion_tokens', 'INTEGER'), ('outcome', 'TEXT')
+    )
+    
+    # Признаки текста, которые считаются один раз при записи (см. _enrich)
+    ENRICHMENT_COLUMNS = ('char_len', 'token_estimate', 'has_link', 'emoji_count', 'is_noise')
     
-    def __init__(self, db_path: str = "chat_data.db"):
+    # Колонки таблиц-разделов сообщений
+    MESSAGE_COLUMNS = ('id', 'chat_id', 'user_id', 'user_name', 'message_text', 'message_type',
+                       'media_file_id', 'timestamp', 'reply_to_message_id', 'is_forwarded',
+                       'message_id') + ENRICHMENT_COLUMNS
+    
+    # Реплики без содержания: для промптов это шум
+    NOISE_WORDS = frozenset((
+        'ок', 'окей', 'ok', 'ага', 'угу', 'да', 'нет', 'не', 'ну', 'лол', 'lol', 'хах', 'хаха',
+        'ахах', 'ахаха', 'пон', 'понял', 'ясно', 'спс', 'пасиб', 'спасибо', 'норм', 'мб', 'хм',
+        'кек', 'жиза', 'плюс', 'го', 'бб', 'ладно', 'ок спс', 'да да', 'ну да', 'ну ок'
+    ))
+    URL_PATTERN = re.compile(r'(?:https?://|www\.|t\.me/)\S*', re.IGNORECASE)
+    EMOJI_PATTERN = re.compile(
+        '[\U0001F1E6-\U0001F1FF\U0001F300-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF]'
+    )
+    WORD_PATTERN = re.compile(r'[^\W\d_]{2,}')
+
+    def __init__(self, db_path: str = "chat_data.db", write_buffer: bool = None,
+                 shard_count: int = None):
         self.db_path = db_path
+        self.shards = []
+        self.pool = ConnectionPool(db_path)
+        self.aio = AsyncDatabaseManager(self)
+        self.settings = ChatSettingsService(self)
+        self._partitions = []  # (начало, конец, имя таблицы) от старых к новым
+        self.migrator = SchemaMigrator(self)
         self.init_database()
+
+        if write_buffer is None:
+            write_buffer = config.DB_WRITE_BUFFER_ENABLED
+        self.buffer = MessageBuffer(self._write_messages) if write_buffer else None
+        self._command_buffer = None  # создается при первой записи телеметрии
+        self._command_buffer_lock = threading.Lock()
+        
+        if shard_count is None:
+            shard_count = config.DB_SHARD_COUNT
+        if shard_count:
+            root, ext = os.path.splitext(db_path)
+            self.shards = [
+                DatabaseManager(f"{root}.shard{i}{ext}", write_buffer, shard_count=0)
+                for i in range(shard_count)
+            ]
+            self._move_messages_to_shards()
+        
+        self.migrator.start()
+
+    def shard_for(self, chat_id: int) -> 'DatabaseManager':
+        """Шард, в котором хранятся сообщения чата (число шардов менять нельзя)"""
+        return self.shards[chat_id % len(self.shards)]
+
+    def _move_messages_to_shards(self):
+        """Однократный перенос сообщений из основного файла в шарды.
+        
+        Выполняется при первом запуске с DB_SHARD_COUNT > 0. Каждая пачка
+        удаляется из основного файла после записи в шарды, поэтому прерванный
+        перенос продолжается при следующем запуске. Строки сохраняют свои id
+        (на них ссылаются extracted_texts и курсоры), поэтому пачка, записанная
+        до сбоя, повторно не дублируется. Архив переносится вместе со словарями.
+        """
+        with self.pool.reader() as conn:
+            archived = conn.execute("SELECT COUNT(*) FROM message_archive").fetchone()[0]
+        if not self._partitions and not archived:
+            return
+        
+        columns = ', '.join(self.MESSAGE_COLUMNS)
+        batch = config.DB_MIGRATION_BATCH_SIZE
+        moved = 0
+        
+        for _, _, table in list(self._partitions):
+            while True:
+                with self.pool.reader() as conn:
+                    cursor = conn.execute(f"SELECT {columns} FROM {table} ORDER BY id LIMIT ?", (batch,))
+                    rows = [dict(zip(self.MESSAGE_COLUMNS, row)) for row in cursor.fetchall()]
+                if not rows:
+                    break
+                
+                by_shard = {}
+                for row in rows:
+                    by_shard.setdefault(self.shard_for(row['chat_id']), []).append(dict(row))
+                for shard, shard_rows in by_shard.items():
+                    shard._write_messages(shard_rows, keep_ids=True)
+                
+                with self.pool.transaction() as conn:
+                    conn.execute(f"DELETE FROM {table} WHERE id <= ?", (rows[-1]['id'],))
+                moved += len(rows)
+        
+        # Справочник пользователей нужен каждому шарду для /opinion
+        with self.pool.reader() as conn:
+            users = conn.execute("SELECT user_id, username, first_name, last_seen FROM users").fetchall()
+            names = conn.execute("SELECT name_key, user_id, name FROM user_names").fetchall()
+        for shard in self.shards:
+            with shard.pool.transaction() as conn:
+                conn.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)", users)
+                conn.executemany("INSERT OR IGNORE INTO user_names VALUES (?, ?, ?)", names)
+        
+        self._move_archive_to_shards()
+        
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            for _, _, table in self._partitions:
+                cursor.execute(f"DROP TABLE {table}_fts")
+                cursor.execute(f"DROP TABLE {table}")
+            for table in ('message_partitions', 'message_index', 'chat_stats_hourly',
+                          'user_stats_hourly', 'chat_counters', 'users', 'user_names'):
+                cursor.execute(f"DELETE FROM {table}")
+            self._load_partitions(cursor)
+            self._refresh_messages_view(cursor)
+        
+        logger.info(f"Moved {moved} messages into {len(self.shards)} shards")
     
+    def _move_archive_to_shards(self):
+        """Перенос архивных блоков и словарей сжатия в шарды (по транзакции на чат)"""
+        with self.pool.reader() as conn:
+            chats = [row[0] for row in conn.execute("SELECT DISTINCT chat_id FROM message_archive")]
+        
+        blocks = 0
+        for chat_id in chats:
+            with self.pool.reader() as conn:
+                zdict = conn.execute(
+                    "SELECT dictionary FROM archive_dictionaries WHERE chat_id = ?", (chat_id,)
+                ).fetchone()
+                rows = conn.execute('''
+                    SELECT chat_id, month, first_ts, last_ts, message_count, data, prefixes
+                    FROM message_archive WHERE chat_id = ?
+                ''', (chat_id,)).fetchall()
+            
+            # Блоки уже есть в шарде, если прошлый перенос прервался после записи
+            with self.shard_for(chat_id).pool.transaction() as conn:
+                if zdict:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO archive_dictionaries (chat_id, dictionary) VALUES (?, ?)",
+                        (chat_id, zdict[0])
+                    )
+                conn.executemany('''
+                    INSERT OR IGNORE INTO message_archive
+                    (chat_id, month, first_ts, last_ts, message_count, data, prefixes)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+            
+            with self.pool.transaction() as conn:
+                conn.execute("DELETE FROM message_archive WHERE chat_id = ?", (chat_id,))
+                conn.execute("DELETE FROM archive_dictionaries WHERE chat_id = ?", (chat_id,))
+            blocks += len(rows)
+        
+        if blocks:
+            logger.info(f"Moved {blocks} archive blocks of {len(chats)} chats into shards")
+
+    def close(self):
+        """Закрытие соединений с базой данных (при остановке бота)"""
+        for shard in self.shards:
+            shard.close()
+        self.migrator.close()
+        self.aio.shutdown()
+        if self.buffer is not None:
+            self.buffer.close()
+        if self._command_buffer is not None:
+            self._command_buffer.close()
+        self.pool.close()
+
     def init_database(self):
         """Инициализация базы данных и создание таблиц"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                
+                # Пустой файл - новая база, а не обновление старой
+                cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+                fresh = cursor.fetchone()[0] == 0
+                
+                # Сообщения хранятся в разделах по времени (см. _init_partitions)
+                self._init_partitions(cursor)
+                
+                # Таблица настроек чата
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS chat_settings (
+                        chat_id INTEGER PRIMARY KEY,
+                        daily_summary_enabled BOOLEAN DEFAULT 1,
+                        summary_time TEXT DEFAULT '21:00',
+                        pin_summary BOOLEAN DEFAULT 1,
+                        bot_personality TEXT,
+                        language TEXT DEFAULT 'ru',
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                # Таблица для хранения извлеченного текста из медиа
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS extracted_texts (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        original_message_id INTEGER,
+                        chat_id INTEGER NOT NULL,
+                        extracted_text TEXT NOT NULL,
+                        extraction_type TEXT NOT NULL,  -- 'voice', 'image', 'document'
+                        confidence_score REAL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (original_message_id) REFERENCES messages (id)
+                    )
+                ''')
+                
+                # Таблица для статистики использования команд
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS command_stats (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        command TEXT NOT NULL,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        success BOOLEAN DEFAULT 1,
+                        wall_ms REAL,
+                        db_ms REAL,
+                        llm_ms REAL,
+                        llm_calls INTEGER,
+                        prompt_tokens INTEGER,
+                        completion_tokens INTEGER,
+                        outcome TEXT
+                    )
+                ''')
+                
+                # Индексы для оптимизации запросов
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_extracted_texts_message 
+                    ON extracted_texts(chat_id, original_message_id)
+                ''')
+                
+                cursor.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_command_stats_timestamp 
+                    ON command_stats(timestamp)
+                ''')
+                
+                self._create_users_tables(cursor)
+                self._create_stats_tables(cursor)
+                self._create_archive_tables(cursor)
+                
+                self.migrator.apply_startup(cursor, fresh)
+                # До завершения миграции 1 новые сообщения пишутся с текстовым временем
+                self._epoch_timestamps = self.migrator.is_applied(1)
             
-            # Таблица сообщений
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    user_name TEXT NOT NULL,
-                    message_text TEXT,
-                    message_type TEXT DEFAULT 'text',
-                    media_file_id TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    reply_to_message_id INTEGER,
-                    is_forwarded BOOLEAN DEFAULT 0
-                )
-            ''')
+            logger.info("Database initialized successfully")
             
-            # Таблица настроек чата
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_settings (
-                    chat_id INTEGER PRIMARY KEY,
-                    daily_summary_enabled BOOLEAN DEFAULT 1,
-                    summary_time TEXT DEFAULT '21:00',
-                    pin_summary BOOLEAN DEFAULT 1,
-                    bot_personality TEXT,
-                    language TEXT DEFAULT 'ru',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
+        except Exception as e:
+            logger.error(f"Error initializing database: {e}")
+            raise
+    
+    def _init_partitions(self, cursor: sqlite3.Cursor):
+        """Разделы сообщений по времени.
+        
+        Каждый раздел - отдельная таблица messages_pYYYYMMDD за DB_PARTITION_MONTHS
+        месяцев со своими индексами и полнотекстовым индексом. Запись и чтение
+        идут через маршрутизатор (_partition_for / _partitions_for_range),
+        представление messages объединяет все разделы для прочих запросов.
+        Очистка старых сообщений удаляет раздел целиком вместо DELETE.
+        """
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_partitions (
+                name TEXT PRIMARY KEY,
+                start_ts TEXT NOT NULL,
+                end_ts TEXT NOT NULL
+            )
+        ''')
+        
+        # id сообщений сквозные для всех разделов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_id_sequence (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_id INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO message_id_sequence (id, last_id) VALUES (1, 0)")
+        
+        # Единственный уникальный индекс (chat_id, message_id) на все разделы:
+        # по времени находится раздел, по id - строка в нем. thread_id - корень
+        # ветки ответов (NULL у сообщений, которые ни на что не отвечают)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_index (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                thread_id INTEGER,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        self._load_partitions(cursor)
+        for _, _, name in self._partitions:
+            self._create_partition_indexes(cursor, name)
+        self._migrate_legacy_messages(cursor)
+        self._refresh_messages_view(cursor)
+    
+    def _load_partitions(self, cursor: sqlite3.Cursor):
+        """Загрузка списка разделов (от старых к новым)"""
+        cursor.execute("SELECT start_ts, end_ts, name FROM message_partitions ORDER BY start_ts")
+        self._partitions = [tuple(row) for row in cursor.fetchall()]
+    
+    def _migrate_legacy_messages(self, cursor: sqlite3.Cursor):
+        """Однократный перенос старой таблицы messages в разделы"""
+        cursor.execute("SELECT type FROM sqlite_master WHERE name = 'messages'")
+        row = cursor.fetchone()
+        if not row or row[0] != 'table':
+            return
+        
+        # Старый общий FTS-индекс и его триггеры заменяются индексами разделов
+        for trigger in ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE IF EXISTS messages_fts")
+        cursor.execute("ALTER TABLE messages RENAME TO messages_legacy")
+        cursor.execute('''
+            UPDATE messages_legacy SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL
+        ''')
+        
+        cursor.execute("SELECT DISTINCT substr(timestamp, 1, 7) FROM messages_legacy")
+        for (month,) in cursor.fetchall():
+            self._partition_for(cursor, f"{month}-01 00:00:00")
+        
+        # В старой таблице нет message_id и признаков (их заполнит миграция 5)
+        columns = ', '.join(c for c in self.MESSAGE_COLUMNS
+                            if c != 'message_id' and c not in self.ENRICHMENT_COLUMNS)
+        moved = 0
+        for start, end, name in self._partitions:
+            cursor.execute(f'''
+                INSERT INTO {name} ({columns})
+                SELECT {columns} FROM messages_legacy
+                WHERE timestamp >= ? AND timestamp < ?
+            ''', (start, end))
+            moved += cursor.rowcount
+        
+        cursor.execute('''
+            UPDATE message_id_sequence
+            SET last_id = MAX(last_id, (SELECT COALESCE(MAX(id), 0) FROM messages_legacy))
+        ''')
+        cursor.execute("DROP TABLE messages_legacy")
+        logger.info(f"Moved {moved} messages into {len(self._partitions)} partitions")
+    
+    def _migrate_message_ids(self, cursor: sqlite3.Cursor):
+        """Миграция 2: колонка message_id (id сообщения в Telegram) в разделах"""
+        for _, _, name in self._partitions:
+            cursor.execute(f"PRAGMA table_info({name})")
+            if 'message_id' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute(f"ALTER TABLE {name} ADD COLUMN message_id INTEGER")
+        self._refresh_messages_view(cursor)
+    
+    def _migrate_message_threads(self, cursor: sqlite3.Cursor):
+        """Миграция 3: индекс веток ответов (thread_id в message_index)"""
+        cursor.execute("PRAGMA table_info(message_index)")
+        if 'thread_id' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE message_index ADD COLUMN thread_id INTEGER")
+        
+        # Частичный индекс: в нем только ответы, а не все сообщения
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_index_thread 
+            ON message_index(chat_id, thread_id) WHERE thread_id IS NOT NULL
+        ''')
+        
+        # Ответы, сохраненные раньше (импорт), - от старых к новым, чтобы
+        # родитель получал ветку раньше своих ответов
+        threads = {}
+        for _, _, name in self._partitions:
+            cursor.execute(f'''
+                SELECT chat_id, message_id, reply_to_message_id FROM {name}
+                WHERE message_id IS NOT NULL AND reply_to_message_id IS NOT NULL
+                ORDER BY timestamp, id
             ''')
-            
-            # Таблица для хранения извлеченного текста из медиа
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS extracted_texts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    original_message_id INTEGER,
-                    chat_id INTEGER NOT NULL,
-                    extracted_text TEXT NOT NULL,
-                    extraction_type TEXT NOT NULL,  -- 'voice', 'image', 'document'
-                    confidence_score REAL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (original_message_id) REFERENCES messages (id)
+            for chat_id, message_id, reply_to in cursor.fetchall():
+                threads[(chat_id, message_id)] = threads.get((chat_id, reply_to)) or reply_to
+        
+        cursor.executemany(
+            "UPDATE message_index SET thread_id = ? WHERE chat_id = ? AND message_id = ?",
+            [(thread_id, chat_id, message_id) for (chat_id, message_id), thread_id in threads.items()]
+        )
+    
+    def _migrate_command_telemetry(self, cursor: sqlite3.Cursor):
+        """Миграция 7: время и размеры промптов в статистике команд"""
+        cursor.execute("PRAGMA table_info(command_stats)")
+        existing = {row[1] for row in cursor.fetchall()}
+        for column, column_type in self.COMMAND_TELEMETRY_COLUMNS:
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE command_stats ADD COLUMN {column} {column_type}")
+    
+    def _migrate_archive_prefixes(self, cursor: sqlite3.Cursor):
+        """Миграция 8: начала слов архивных блоков для поиска без распаковки"""
+        cursor.execute("PRAGMA table_info(message_archive)")
+        if 'prefixes' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE message_archive ADD COLUMN prefixes TEXT")
+    
+    def _migrate_archive_prefixes_backfill(self, version: int, name: str, stop: threading.Event) -> bool:
+        """Миграция 9: начала слов для блоков, заархивированных до миграции 8.
+        
+        По блоку за транзакцию; пока миграция идет, блоки без метаданных
+        (prefixes IS NULL) поиск распаковывает, как раньше.
+        """
+        pause = config.DB_MIGRATION_PAUSE_MS / 1000
+        filled = 0
+        last_id = 0
+        while True:
+            if stop.is_set():
+                return False
+            with self.pool.transaction() as conn:
+                row = conn.execute('''
+                    SELECT a.id, a.data, d.dictionary FROM message_archive a
+                    JOIN archive_dictionaries d ON d.chat_id = a.chat_id
+                    WHERE a.id > ? AND a.prefixes IS NULL
+                    ORDER BY a.id
+                    LIMIT 1
+                ''', (last_id,)).fetchone()
+                if row is None:
+                    self.migrator.record(conn.cursor(), version, name)
+                    break
+                last_id, data, zdict = row
+                conn.execute(
+                    "UPDATE message_archive SET prefixes = ? WHERE id = ?",
+                    (self._block_prefixes(self._decompress_block(data, zdict)), last_id)
                 )
-            ''')
-            
-            # Таблица для статистики использования команд
+            filled += 1
+            time.sleep(pause)
+        
+        logger.info(f"Indexed word prefixes of {filled} archive blocks")
+        return True
+    
+    def _migrate_enrichment_columns(self, cursor: sqlite3.Cursor):
+        """Миграция 4: колонки признаков текста в разделах"""
+        for _, _, name in self._partitions:
+            cursor.execute(f"PRAGMA table_info({name})")
+            existing = {row[1] for row in cursor.fetchall()}
+            for column in self.ENRICHMENT_COLUMNS:
+                if column not in existing:
+                    cursor.execute(f"ALTER TABLE {name} ADD COLUMN {column} INTEGER")
+        self._refresh_messages_view(cursor)
+    
+    def _migrate_chat_counters(self, cursor: sqlite3.Cursor):
+        """Миграция 6: счетчики активности по уже сохраненным сообщениям"""
+        # Голые колонки рядом с MAX() берутся из строки с последним временем
+        cursor.execute('''
+            SELECT chat_id, COUNT(*), id, message_id, MAX(timestamp)
+            FROM messages
+            GROUP BY chat_id
+        ''')
+        counters = []
+        for chat_id, total, last_id, message_id, timestamp in cursor.fetchall():
+            day = self._format_ts(timestamp)[:10]
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS command_stats (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    command TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    success BOOLEAN DEFAULT 1
+                SELECT COALESCE(SUM(message_count), 0) FROM chat_stats_hourly
+                WHERE chat_id = ? AND hour >= ?
+            ''', (chat_id, f"{day} 00:00:00"))
+            counters.append((chat_id, total, last_id, message_id, self._to_epoch(timestamp),
+                             day, cursor.fetchone()[0]))
+        
+        cursor.executemany('''
+            INSERT OR REPLACE INTO chat_counters 
+            (chat_id, total_messages, last_id, last_message_id, last_timestamp, day, day_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', counters)
+    
+    def _migrate_enrichment_backfill(self, version: int, name: str, stop: threading.Event) -> bool:
+        """Миграция 5: признаки текста для сообщений, сохраненных до миграции 4.
+        
+        Раздел обходится пачками по id; чтение, расчет и запись пачки идут в
+        одной транзакции писателя, поэтому правка сообщения между ними не
+        оставит устаревших признаков. Пока миграция идет, непосчитанные строки
+        (char_len IS NULL) считаются не шумом, а токены - по длине текста.
+        """
+        batch = config.DB_MIGRATION_BATCH_SIZE
+        pause = config.DB_MIGRATION_PAUSE_MS / 1000
+        enriched = 0
+        
+        for _, _, table in list(self._partitions):
+            last_id = 0
+            while True:
+                if stop.is_set():
+                    return False
+                if table not in (p[2] for p in self._partitions):
+                    break  # Раздел удален очисткой
+                
+                with self.pool.transaction() as conn:
+                    rows = conn.execute(f'''
+                        SELECT id, message_text FROM {table}
+                        WHERE id > ? AND char_len IS NULL
+                        ORDER BY id
+                        LIMIT ?
+                    ''', (last_id, batch)).fetchall()
+                    conn.executemany(f'''
+                        UPDATE {table} SET char_len = :char_len, token_estimate = :token_estimate,
+                            has_link = :has_link, emoji_count = :emoji_count, is_noise = :is_noise
+                        WHERE id = :id
+                    ''', [dict(self._enrich(text), id=row_id) for row_id, text in rows])
+                enriched += len(rows)
+                if len(rows) < batch:
+                    break
+                last_id = rows[-1][0]
+                time.sleep(pause)
+        
+        # Новые строки пишутся уже с признаками - остается только отметка
+        with self.pool.transaction() as conn:
+            self.migrator.record(conn.cursor(), version, name)
+        
+        logger.info(f"Computed text features for {enriched} stored messages")
+        return True
+    
+    @classmethod
+    def _enrich(cls, text: Optional[str]) -> Dict:
+        """Признаки текста сообщения для колонок ENRICHMENT_COLUMNS.
+        
+        token_estimate - грубая оценка без токенизатора: около трех символов
+        на токен для русского текста. Шум - сообщение без единого слова
+        (эмодзи, знаки, стикер без подписи) или короткая реакция из NOISE_WORDS;
+        сообщение со ссылкой шумом не считается.
+        """
+        text = text or ''
+        has_link = bool(cls.URL_PATTERN.search(text))
+        normalized = ' '.join(cls.WORD_PATTERN.findall(text.lower()))
+        is_noise = not has_link and (not normalized or normalized in cls.NOISE_WORDS)
+        return {
+            'char_len': len(text),
+            'token_estimate': (len(text) + 2) // 3,
+            'has_link': has_link,
+            'emoji_count': len(cls.EMOJI_PATTERN.findall(text)),
+            'is_noise': is_noise
+        }
+    
+    def _migrate_epoch_timestamps(self, version: int, name: str, stop: threading.Event) -> bool:
+        """Миграция 1: время сообщений - целые секунды Unix вместо текста.
+        
+        Каждый чат конвертируется пачками от старых сообщений к новым. Поэтому
+        в любой момент числовое время в чате старше текстового, а SQLite
+        сортирует числа раньше строк: порядок выдачи и курсоры остаются верными.
+        Пока миграция идет, новые сообщения пишутся текстом. Последний проход и
+        переключение формата выполняются в одной транзакции, после чего индексы
+        разделов перестраиваются на компактном ключе.
+        """
+        batch = config.DB_MIGRATION_BATCH_SIZE
+        pause = config.DB_MIGRATION_PAUSE_MS / 1000
+        converted = 0
+        
+        def convert(cursor: sqlite3.Cursor, table: str, where: str, params: tuple) -> int:
+            # timestamp >= '' выбирает только текстовые значения (числа меньше строк)
+            cursor.execute(f'''
+                UPDATE {table}
+                SET timestamp = COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), 0)
+                WHERE id IN (
+                    SELECT id FROM {table}
+                    WHERE {where} AND timestamp >= ''
+                    ORDER BY timestamp
+                    LIMIT ?
                 )
+            ''', params)
+            return cursor.rowcount
+        
+        with self.pool.reader() as conn:
+            start_id = conn.execute("SELECT last_id FROM message_id_sequence").fetchone()[0]
+        
+        # Сообщения, сохраненные до начала миграции: по чатам, от старых к новым
+        for _, _, table in list(self._partitions):
+            with self.pool.reader() as conn:
+                chats = [row[0] for row in conn.execute(f"SELECT DISTINCT chat_id FROM {table}")]
+            
+            for chat_id in chats:
+                while True:
+                    if stop.is_set():
+                        return False
+                    if table not in (p[2] for p in self._partitions):
+                        break  # Раздел удален очисткой
+                    
+                    with self.pool.transaction() as conn:
+                        count = convert(conn.cursor(), table, "chat_id = ?", (chat_id, batch))
+                    converted += count
+                    if count < batch:
+                        break
+                    time.sleep(pause)
+        
+        # Сообщения, пришедшие во время миграции (id > start_id)
+        for _, _, table in list(self._partitions):
+            while True:
+                if stop.is_set():
+                    return False
+                with self.pool.transaction() as conn:
+                    count = convert(conn.cursor(), table, "id > ?", (start_id, batch))
+                converted += count
+                if count < batch:
+                    break
+                time.sleep(pause)
+        
+        # Остаток и переключение формата под блокировкой писателя
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            for _, _, table in self._partitions:
+                converted += convert(cursor, table, "id > ?", (start_id, -1))
+            self.migrator.record(cursor, version, name)
+            self._epoch_timestamps = True
+        
+        for _, _, table in list(self._partitions):
+            with self.pool.transaction() as conn:
+                conn.execute(f"REINDEX {table}")
+        
+        logger.info(f"Converted {converted} message timestamps to epoch seconds")
+        return True
+    
+    @staticmethod
+    def _format_ts(value) -> str:
+        """Время UTC текстом 'YYYY-MM-DD HH:MM:SS' (naive datetime - местное время)"""
+        if isinstance(value, datetime):
+            return value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        return str(value)
+    
+    @staticmethod
+    def _to_epoch(value) -> int:
+        """Время в секундах Unix (текст считается UTC, naive datetime - местным)"""
+        if isinstance(value, datetime):
+            return int(value.timestamp())
+        if isinstance(value, (int, float)):
+            return int(value)
+        return int(datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+                   .replace(tzinfo=timezone.utc).timestamp())
+    
+    def _storage_ts(self, value):
+        """Время сообщения в текущем формате хранения"""
+        return self._to_epoch(value) if self._epoch_timestamps else self._format_ts(value)
+    
+    @staticmethod
+    def _partition_bounds(timestamp: str) -> Tuple[str, str]:
+        """Границы [начало, конец) раздела, в который попадает timestamp"""
+        months = max(1, config.DB_PARTITION_MONTHS)
+        index = int(timestamp[:4]) * 12 + int(timestamp[5:7]) - 1
+        index -= index % months
+        
+        def month_start(i: int) -> str:
+            return f"{i // 12:04d}-{i % 12 + 1:02d}-01 00:00:00"
+        
+        return month_start(index), month_start(index + months)
+    
+    def _partition_for(self, cursor: sqlite3.Cursor, timestamp: str, deferred: List[str] = None) -> str:
+        """Раздел для сообщения с данным временем (создается при необходимости)"""
+        # Почти все сообщения попадают в последний раздел - ищем с конца
+        for start, end, name in reversed(self._partitions):
+            if start <= timestamp < end:
+                return name
+        
+        start, end = self._partition_bounds(timestamp)
+        # Не пересекаемся с разделами, созданными при другом DB_PARTITION_MONTHS
+        for p_start, p_end, _ in self._partitions:
+            if p_end <= timestamp:
+                start = max(start, p_end)
+            elif p_start > timestamp:
+                end = min(end, p_start)
+        
+        return self._create_partition(cursor, start, end, deferred)
+    
+    def _create_partition(self, cursor: sqlite3.Cursor, start: str, end: str,
+                          deferred: List[str] = None) -> str:
+        """Создание раздела с индексами и полнотекстовым индексом.
+        
+        deferred - список массовой загрузки: индексы нового раздела строятся
+        после нее (_build_deferred_partitions), а имя добавляется в список.
+        """
+        name = f"messages_p{start[:4]}{start[5:7]}{start[8:10]}"
+        
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {name} (
+                id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                user_name TEXT NOT NULL,
+                message_text TEXT,
+                message_type TEXT DEFAULT 'text',
+                media_file_id TEXT,
+                timestamp DATETIME NOT NULL,
+                reply_to_message_id INTEGER,
+                is_forwarded BOOLEAN DEFAULT 0,
+                message_id INTEGER,
+                char_len INTEGER,
+                token_estimate INTEGER,
+                has_link INTEGER,
+                emoji_count INTEGER,
+                is_noise INTEGER
+            )
+        ''')
+        
+        # unicode61 приводит кириллицу к нижнему регистру и снимает диакритику,
+        # префиксные индексы ускоряют поиск по основам слов
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {name}_fts USING fts5(
+                message_text,
+                content='{name}',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3 4'
+            )
+        ''')
+        
+        if deferred is not None:
+            # Массовая загрузка: индексы строятся один раз после вставки
+            deferred.append(name)
+        else:
+            self._create_partition_indexes(cursor, name)
+        
+        # Триггеры синхронизации индекса с разделом (триггер вставки - в индексах)
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name}_fts_delete AFTER DELETE ON {name}
+            BEGIN
+                INSERT INTO {name}_fts({name}_fts, rowid, message_text)
+                VALUES ('delete', old.id, old.message_text);
+            END
+        ''')
+        
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name}_fts_update AFTER UPDATE OF message_text ON {name}
+            BEGIN
+                INSERT INTO {name}_fts({name}_fts, rowid, message_text)
+                VALUES ('delete', old.id, old.message_text);
+                INSERT INTO {name}_fts(rowid, message_text) VALUES (new.id, new.message_text);
+            END
+        ''')
+        
+        cursor.execute('''
+            INSERT INTO message_partitions (name, start_ts, end_ts) VALUES (?, ?, ?)
+        ''', (name, start, end))
+        
+        # Список заменяется целиком: читатели работают со своим снимком
+        self._partitions = sorted(self._partitions + [(start, end, name)])
+        logger.info(f"Created message partition {name} [{start}, {end})")
+        return name
+    
+    def _create_partition_indexes(self, cursor: sqlite3.Cursor, name: str):
+        """Индексы раздела сообщений"""
+        # (chat_id, timestamp, id): обратный обход дает порядок timestamp DESC, id DESC
+        # для keyset-пагинации без дополнительной сортировки
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{name}_chat_timestamp")
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{name}_chat_time 
+            ON {name}(chat_id, timestamp)
+        ''')
+        
+        # Сообщения пользователя по времени - для /opinion
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{name}_user_timestamp 
+            ON {name}(chat_id, user_id, timestamp DESC)
+        ''')
+        
+        # Без триггера вставки раздел заполнялся массовой загрузкой (возможно,
+        # прерванной) - полнотекстовый индекс перестраивается целиком
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+            (f"{name}_fts_insert",)
+        )
+        if cursor.fetchone() is None:
+            cursor.execute(f'''
+                CREATE TRIGGER {name}_fts_insert AFTER INSERT ON {name}
+                BEGIN
+                    INSERT INTO {name}_fts(rowid, message_text) VALUES (new.id, new.message_text);
+                END
             ''')
-            
-            # Индексы для оптимизации запросов
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp 
-                ON messages(chat_id, timestamp DESC)
-            ''')
-            
+            cursor.execute(f"INSERT INTO {name}_fts({name}_fts) VALUES ('rebuild')")
+    
+    def _refresh_messages_view(self, cursor: sqlite3.Cursor):
+        """Представление messages - объединение всех разделов"""
+        cursor.execute("DROP VIEW IF EXISTS messages")
+        columns = ', '.join(self.MESSAGE_COLUMNS)
+        if self._partitions:
+            body = " UNION ALL ".join(
+                f"SELECT {columns} FROM {name}" for _, _, name in self._partitions
+            )
+        else:
+            body = "SELECT " + ", ".join(f"NULL AS {c}" for c in self.MESSAGE_COLUMNS) + " WHERE 0"
+        cursor.execute(f"CREATE VIEW messages AS {body}")
+    
+    def _partitions_for_range(self, start_time=None, end_time=None) -> List[str]:
+        """Разделы, пересекающиеся с интервалом [start_time, end_time], от старых к новым"""
+        start = self._format_ts(start_time) if start_time is not None else None
+        end = self._format_ts(end_time) if end_time is not None else None
+        return [
+            name for p_start, p_end, name in self._partitions
+            if (start is None or p_end > start) and (end is None or p_start <= end)
+        ]
+    
+    def _query_partitions(self, partitions: List[str], sql: str, params: tuple,
+                          limit: int = None) -> List[tuple]:
+        """Выполнение запроса по разделам по очереди.
+        
+        sql содержит {table} вместо имени раздела; если задан limit, запрос
+        должен заканчиваться на LIMIT ? и обход останавливается, как только
+        набрано нужное количество строк.
+        """
+        rows = []
+        with self.pool.reader() as conn:
+            for name in partitions:
+                if limit is None:
+                    rows.extend(conn.execute(sql.format(table=name), params).fetchall())
+                    continue
+                
+                need = limit - len(rows)
+                if need <= 0:
+                    break
+                rows.extend(conn.execute(sql.format(table=name), params + (need,)).fetchall())
+        return rows
+    
+    def _query_budget(self, partitions: List[str], sql: str, params: tuple,
+                      limit: int, token_budget: int) -> List[tuple]:
+        """Как _query_partitions с limit, но еще и в пределах бюджета токенов.
+        
+        sql выбирает строки от новых к старым и заканчивается на LIMIT ?; в нем
+        должны быть колонки timestamp и id, а последняя колонка - оценка токенов
+        tokens. Нарастающая сумма считается оконной функцией по уже ограниченной
+        выборке, поэтому в Python попадают только строки, которые войдут в
+        промпт, плюс одна первая не поместившаяся. Возвращает строки без tokens.
+        """
+        rows = []
+        budget = token_budget
+        with self.pool.reader() as conn:
+            for name in partitions:
+                need = limit - len(rows)
+                if need <= 0 or budget <= 0:
+                    break
+                part = conn.execute(f'''
+                    SELECT * FROM (
+                        SELECT *, SUM(tokens) OVER (ORDER BY timestamp DESC, id DESC) AS running
+                        FROM ({sql.format(table=name)})
+                    )
+                    WHERE running - tokens < ?
+                    ORDER BY timestamp DESC, id DESC
+                ''', params + (need, budget)).fetchall()
+                
+                overflow = bool(part) and part[-1][-1] > budget
+                if overflow:
+                    part.pop()
+                rows.extend(row[:-2] for row in part)
+                if overflow:
+                    break  # Следующая строка уже не помещается
+                if part:
+                    budget -= part[-1][-1]
+        return rows
+    
+    def _stream_partitions(self, partitions: List[str], sql: str, params: tuple,
+                           chunk_size: int = None) -> Iterator[tuple]:
+        """Потоковый вариант _query_partitions: строки читаются пачками через fetchmany.
+        
+        Соединение читателя занято, пока читается раздел, поэтому генератор
+        нужно дочитывать или закрывать, а не бросать на полпути.
+        """
+        chunk_size = chunk_size or config.DB_STREAM_CHUNK_SIZE
+        for name in partitions:
+            with self.pool.reader() as conn:
+                cursor = conn.execute(sql.format(table=name), params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+    
+    def _create_archive_tables(self, cursor: sqlite3.Cursor):
+        """Холодный архив: сжатые блоки сообщений по чату и месяцу"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_archive (
+                id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                first_ts INTEGER NOT NULL,
+                last_ts INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                prefixes TEXT,
+                UNIQUE (chat_id, month)
+            )
+        ''')
+        
+        # Словарь zlib строится по первым архивируемым сообщениям чата и больше
+        # не меняется: без него блоки не распаковать
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_dictionaries (
+                chat_id INTEGER PRIMARY KEY,
+                dictionary BLOB NOT NULL
+            )
+        ''')
+    
+    # Колонки строки внутри архивного блока (время - секунды Unix)
+    ARCHIVE_COLUMNS = ('id', 'user_id', 'user_name', 'message_text', 'message_type',
+                       'media_file_id', 'timestamp', 'reply_to_message_id', 'is_forwarded')
+    
+    def _archive_partition(self, table: str) -> int:
+        """Перенос раздела в холодный архив (по транзакции на чат)"""
+        columns = ', '.join(self.ARCHIVE_COLUMNS)
+        with self.pool.reader() as conn:
+            chats = [row[0] for row in conn.execute(f"SELECT DISTINCT chat_id FROM {table}")]
+        
+        archived = 0
+        for chat_id in chats:
+            with self.pool.reader() as conn:
+                rows = [list(row) for row in conn.execute(f'''
+                    SELECT {columns} FROM {table} WHERE chat_id = ? ORDER BY timestamp, id
+                ''', (chat_id,))]
+            
+            months = {}
+            for row in rows:
+                row[6] = self._to_epoch(row[6])
+                months.setdefault(self._format_ts(row[6])[:7], []).append(row)
+            
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                zdict = self._archive_dictionary(cursor, chat_id, rows)
+                for month, month_rows in months.items():
+                    self._store_archive_block(cursor, chat_id, month, month_rows, zdict)
+            archived += len(rows)
+        
+        return archived
+    
+    def _archive_dictionary(self, cursor: sqlite3.Cursor, chat_id: int, sample: List[list]) -> bytes:
+        """Словарь сжатия чата (создается по образцу сообщений при первом архивировании)"""
+        cursor.execute("SELECT dictionary FROM archive_dictionaries WHERE chat_id = ?", (chat_id,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        
+        # zlib использует последние 32KB словаря - кладем туда самые свежие строки
+        zdict = json.dumps(sample[-2000:], ensure_ascii=False).encode()[-32768:]
+        cursor.execute(
+            "INSERT INTO archive_dictionaries (chat_id, dictionary) VALUES (?, ?)",
+            (chat_id, zdict)
+        )
+        return zdict
+    
+    def _store_archive_block(self, cursor: sqlite3.Cursor, chat_id: int, month: str,
+                             rows: List[list], zdict: bytes):
+        """Запись блока месяца (с объединением, если блок уже есть)"""
+        cursor.execute(
+            "SELECT data FROM message_archive WHERE chat_id = ? AND month = ?",
+            (chat_id, month)
+        )
+        existing = cursor.fetchone()
+        if existing:
+            # Повторный запуск после сбоя не должен дублировать сообщения
+            merged = {row[0]: row for row in self._decompress_block(existing[0], zdict)}
+            merged.update((row[0], row) for row in rows)
+            rows = sorted(merged.values(), key=lambda row: (row[6], row[0]))
+        
+        compressor = zlib.compressobj(level=9, zdict=zdict)
+        data = compressor.compress(json.dumps(rows, ensure_ascii=False).encode()) + compressor.flush()
+        
+        cursor.execute('''
+            INSERT INTO message_archive (chat_id, month, first_ts, last_ts, message_count, data, prefixes)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, month) DO UPDATE SET
+                first_ts = excluded.first_ts,
+                last_ts = excluded.last_ts,
+                message_count = excluded.message_count,
+                data = excluded.data,
+                prefixes = excluded.prefixes
+        ''', (chat_id, month, rows[0][6], rows[-1][6], len(rows), data, self._block_prefixes(rows)))
+    
+    # Длина начала слова в метаданных блока: поиск по префиксу >= этой длины
+    # отсекает блок по началу термина без распаковки
+    ARCHIVE_PREFIX_LENGTH = 3
+    
+    @classmethod
+    def _block_prefixes(cls, rows: List[list]) -> str:
+        """Начала всех слов блока (" абв где ок "): по ним поиск пропускает блоки без совпадений"""
+        prefixes = {
+            word[:cls.ARCHIVE_PREFIX_LENGTH]
+            for row in rows
+            for word in re.findall(r'\w+', (row[3] or '').lower())
+        }
+        return ' ' + ' '.join(sorted(prefixes)) + ' '
+    
+    @staticmethod
+    def _decompress_block(data: bytes, zdict: bytes) -> List[list]:
+        decompressor = zlib.decompressobj(zdict=zdict)
+        return json.loads(decompressor.decompress(data) + decompressor.flush())
+    
+    def _iter_archive(self, chat_id: int, start_epoch: int = None, end_epoch: int = None,
+                      newest_first: bool = False, terms: List[str] = None) -> Iterator[list]:
+        """Строки архива чата за период, от старых к новым (в памяти один блок).
+        
+        newest_first - от новых к старым; terms - только блоки, где есть слова
+        с такими началами (по метаданным prefixes, без распаковки).
+        """
+        term_filter, term_params = '', []
+        for term in terms or ():
+            # Короткий термин - начало префикса, длинный - префикс целиком
+            if len(term) >= self.ARCHIVE_PREFIX_LENGTH:
+                term_params.append(f" {term[:self.ARCHIVE_PREFIX_LENGTH]} ")
+            else:
+                term_params.append(f" {term}")
+            term_filter += " AND (prefixes IS NULL OR instr(prefixes, ?) > 0)"
+        
+        with self.pool.reader() as conn:
+            row = conn.execute(
+                "SELECT dictionary FROM archive_dictionaries WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            if not row:
+                return
+            zdict = row[0]
+            
+            block_ids = [block_id for (block_id,) in conn.execute(f'''
+                SELECT id FROM message_archive
+                WHERE chat_id = ? AND last_ts >= ? AND first_ts <= ?{term_filter}
+                ORDER BY month {'DESC' if newest_first else ''}
+            ''', (
+                chat_id,
+                start_epoch if start_epoch is not None else 0,
+                end_epoch if end_epoch is not None else 2 ** 62,
+                *term_params
+            ))]
+        
+        for block_id in block_ids:
+            with self.pool.reader() as conn:
+                block = conn.execute(
+                    "SELECT data FROM message_archive WHERE id = ?", (block_id,)
+                ).fetchone()
+            if not block:
+                continue  # блок удален очисткой, пока шло чтение
+            
+            rows = self._decompress_block(block[0], zdict)
+            for row in (reversed(rows) if newest_first else rows):
+                if (start_epoch is None or row[6] >= start_epoch) and (end_epoch is None or row[6] <= end_epoch):
+                    yield row
+    
+    def _search_archive(self, chat_id: int, query: str, limit: int) -> List[Dict]:
+        """Поиск по архиву: те же правила, что у FTS (все слова, по префиксу основы).
+        
+        Блоки читаются от новых к старым по одному, блоки без нужных начал слов
+        не распаковываются, чтение останавливается на limit совпадений.
+        """
+        terms = [term.strip('"*') for term in self._build_fts_query(query).split(" AND ")]
+        terms = [term for term in terms if term]
+        results = []
+        for row in self._iter_archive(chat_id, newest_first=True, terms=terms):
+            words = re.findall(r'\w+', (row[3] or '').lower())
+            if all(any(word.startswith(term) for word in words) for term in terms):
+                results.append({
+                    'user': row[2],
+                    'timestamp': self._format_ts(row[6]),
+                    'snippet': self._archive_snippet(row[3], terms)
+                })
+                if len(results) >= limit:
+                    break
+        return results
+    
+    @staticmethod
+    def _archive_snippet(text: str, terms: List[str], width: int = 12) -> str:
+        """Фрагмент текста вокруг совпадений в том же виде, что snippet() FTS5"""
+        words = text.split()
+        hits = [i for i, word in enumerate(words)
+                if any(re.sub(r'\W', '', word.lower()).startswith(term) for term in terms)]
+        start = max(0, (hits[0] if hits else 0) - width // 2)
+        shown = [
+            f"«{word}»" if i in hits else word
+            for i, word in enumerate(words[start:start + width], start)
+        ]
+        prefix = '…' if start > 0 else ''
+        suffix = '…' if start + width < len(words) else ''
+        return prefix + ' '.join(shown) + suffix
+    
+    def _create_users_tables(self, cursor: sqlite3.Cursor):
+        """Таблицы пользователей и всех их известных имен"""
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+        )
+        exists = cursor.fetchone() is not None
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_seen DATETIME
+            )
+        ''')
+        
+        # name_key - имя в casefold(): NOCASE в SQLite не работает для кириллицы
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_names (
+                name_key TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (name_key, user_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        if not exists:
+            # Заполняем по уже сохраненным сообщениям
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_messages_user 
-                ON messages(chat_id, user_id)
+                SELECT user_id, user_name, MAX(timestamp) FROM messages
+                GROUP BY user_id, user_name
             ''')
-            
+            self._upsert_users(cursor, [
+                {'user_id': row[0], 'user_name': row[1], 'timestamp_text': self._format_ts(row[2])}
+                for row in cursor.fetchall()
+            ])
+    
+    def _create_stats_tables(self, cursor: sqlite3.Cursor):
+        """Почасовые сводки сообщений по чатам и пользователям для статистики"""
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_stats_hourly'"
+        )
+        exists = cursor.fetchone() is not None
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_stats_hourly (
+                chat_id INTEGER NOT NULL,
+                hour TEXT NOT NULL,
+                message_type TEXT NOT NULL,
+                message_count INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, hour, message_type)
+            ) WITHOUT ROWID
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_stats_hourly (
+                chat_id INTEGER NOT NULL,
+                hour TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                user_name TEXT NOT NULL,
+                message_count INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, hour, user_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Одна строка на чат: "есть ли новые сообщения" без COUNT по разделам
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_counters (
+                chat_id INTEGER PRIMARY KEY,
+                total_messages INTEGER NOT NULL,
+                last_id INTEGER,
+                last_message_id INTEGER,
+                last_timestamp INTEGER,
+                day TEXT,
+                day_count INTEGER NOT NULL
+            )
+        ''')
+        
+        if not exists:
+            # Заполняем по уже сохраненным сообщениям
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_messages_timestamp 
-                ON messages(timestamp)
+                INSERT INTO chat_stats_hourly (chat_id, hour, message_type, message_count)
+                SELECT chat_id, strftime('%Y-%m-%d %H:00:00', timestamp),
+                       COALESCE(message_type, 'text'), COUNT(*)
+                FROM messages
+                GROUP BY 1, 2, 3
             ''')
-            
             cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_command_stats_timestamp 
-                ON command_stats(timestamp)
+                INSERT INTO user_stats_hourly (chat_id, hour, user_id, user_name, message_count)
+                SELECT chat_id, strftime('%Y-%m-%d %H:00:00', timestamp), user_id,
+                       MAX(user_name), COUNT(*)
+                FROM messages
+                GROUP BY 1, 2, 3
             ''')
+    
+    def _update_stats(self, cursor: sqlite3.Cursor, rows: List[Dict]):
+        """Обновление почасовых сводок по пачке сообщений"""
+        chat_counts = {}
+        user_counts = {}
+        for row in rows:
+            hour = row['timestamp_text'][:13] + ':00:00'
+            key = (row['chat_id'], hour, row['message_type'] or 'text')
+            chat_counts[key] = chat_counts.get(key, 0) + 1
+            
+            key = (row['chat_id'], hour, row['user_id'])
+            previous = user_counts.get(key)
+            user_counts[key] = (row['user_name'], (previous[1] if previous else 0) + 1)
+        
+        cursor.executemany('''
+            INSERT INTO chat_stats_hourly (chat_id, hour, message_type, message_count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(chat_id, hour, message_type) DO UPDATE SET
+                message_count = message_count + excluded.message_count
+        ''', [(*key, count) for key, count in chat_counts.items()])
+        
+        cursor.executemany('''
+            INSERT INTO user_stats_hourly (chat_id, hour, user_id, user_name, message_count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, hour, user_id) DO UPDATE SET
+                user_name = excluded.user_name,
+                message_count = message_count + excluded.message_count
+        ''', [(*key, name, count) for key, (name, count) in user_counts.items()])
+    
+    def _update_counters(self, cursor: sqlite3.Cursor, rows: List[Dict]):
+        """Обновление счетчиков активности чатов по пачке новых сообщений.
+        
+        "Последнее" сообщение - самое позднее по времени, а не по порядку
+        записи: импорт истории добавляет старые сообщения после новых.
+        """
+        counters = {}
+        for row in rows:
+            epoch = self._to_epoch(row['timestamp_text'])
+            day = row['timestamp_text'][:10]
+            counter = counters.get(row['chat_id'])
+            if counter is None:
+                counters[row['chat_id']] = [1, row['id'], row['message_id'], epoch, day, 1]
+                continue
+            
+            counter[0] += 1
+            if epoch >= counter[3]:
+                counter[1:4] = [row['id'], row['message_id'], epoch]
+            if day > counter[4]:
+                counter[4:6] = [day, 1]
+            elif day == counter[4]:
+                counter[5] += 1
+        
+        cursor.executemany('''
+            INSERT INTO chat_counters 
+            (chat_id, total_messages, last_id, last_message_id, last_timestamp, day, day_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                total_messages = total_messages + excluded.total_messages,
+                last_id = CASE WHEN excluded.last_timestamp >= last_timestamp
+                               THEN excluded.last_id ELSE last_id END,
+                last_message_id = CASE WHEN excluded.last_timestamp >= last_timestamp
+                                       THEN excluded.last_message_id ELSE last_message_id END,
+                last_timestamp = MAX(last_timestamp, excluded.last_timestamp),
+                day_count = CASE WHEN excluded.day > day THEN excluded.day_count
+                                 WHEN excluded.day = day THEN day_count + excluded.day_count
+                                 ELSE day_count END,
+                day = MAX(day, excluded.day)
+        ''', [(chat_id, *counter) for chat_id, counter in counters.items()])
+    
+    def _upsert_users(self, cursor: sqlite3.Cursor, rows: List[Dict]):
+        """Обновление справочника пользователей по пачке сообщений"""
+        users = {}
+        names = set()
+        for row in rows:
+            username = row.get('username')
+            first_name = row.get('first_name')
+            
+            previous = users.get(row['user_id'], {})
+            users[row['user_id']] = {
+                'user_id': row['user_id'],
+                'username': username or previous.get('username'),
+                'first_name': first_name or previous.get('first_name'),
+                'last_seen': row['timestamp_text']
+            }
             
-            conn.commit()
-            conn.close()
-            logger.info("Database initialized successfully")
-            
-        except Exception as e:
-            logger.error(f"Error initializing database: {e}")
-            raise
+            for name in (username, first_name, row.get('user_name')):
+                if name:
+                    names.add((name.casefold(), row['user_id'], name))
+        
+        cursor.executemany('''
+            INSERT INTO users (user_id, username, first_name, last_seen)
+            VALUES (:user_id, :username, :first_name, :last_seen)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, users.username),
+                first_name = COALESCE(excluded.first_name, users.first_name),
+                last_seen = MAX(COALESCE(users.last_seen, ''), excluded.last_seen)
+        ''', list(users.values()))
+        
+        cursor.executemany('''
+            INSERT OR IGNORE INTO user_names (name_key, user_id, name)
+            VALUES (?, ?, ?)
+        ''', names)
     
+    @routed_by_chat
     def save_message(self, chat_id: int, user_id: int, user_name: str, 
                     message_text: str, message_type: str = 'text', 
                     media_file_id: str = None, reply_to_message_id: int = None,
-                    is_forwarded: bool = False) -> bool:
-        """Сохранение сообщения в базу данных"""
+                    is_forwarded: bool = False, username: str = None,
+                    first_name: str = None, message_id: int = None, edit: bool = False) -> bool:
+        """Сохранение сообщения в базу данных (через буфер отложенной записи).
+        
+        username и first_name пополняют справочник пользователей, по которому
+        /opinion находит автора под любым из его имен. Сообщение с уже
+        сохраненным message_id (правка, edited_message) обновляет текст на месте.
+        edit=True - только правка: если исходное сообщение не сохранено, ничего
+        не записывается (иначе правка легла бы в историю новым сообщением).
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            row = {
+                'chat_id': chat_id,
+                'user_id': user_id,
+                'user_name': user_name,
+                'message_text': message_text,
+                'message_type': message_type,
+                'media_file_id': media_file_id,
+                'reply_to_message_id': reply_to_message_id,
+                'is_forwarded': is_forwarded,
+                'username': username,
+                'first_name': first_name,
+                'message_id': message_id,
+                'edit': edit,
+                # Время фиксируем при получении, а не при сбросе буфера
+                'timestamp': int(time.time())
+            }
             
-            cursor.execute('''
-                INSERT INTO messages 
-                (chat_id, user_id, user_name, message_text, message_type, 
-                 media_file_id, reply_to_message_id, is_forwarded)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (chat_id, user_id, user_name, message_text, message_type, 
-                  media_file_id, reply_to_message_id, is_forwarded))
-            
-            conn.commit()
-            conn.close()
+            if self.buffer is not None:
+                self.buffer.put(row)
+            else:
+                self._write_messages([row])
             return True
             
         except Exception as e:
             logger.error(f"Error saving message: {e}")
             return False
     
-    def get_recent_messages(self, chat_id: int, limit: int = 50, 
-                           offset: int = 0) -> List[Dict]:
-        """Получение последних сообщений чата"""
+    def flush_messages(self) -> int:
+        """Принудительная запись буфера сообщений в базу"""
+        flushed = self.buffer.flush() if self.buffer is not None else 0
+        return flushed + sum(shard.flush_messages() for shard in self.shards)
+    
+    def _write_messages(self, rows: List[Dict], keep_ids: bool = False):
+        """Запись пачки сообщений одной транзакцией (с раскладкой по разделам)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.pool.transaction() as conn:
+                self._insert_messages(conn.cursor(), rows, keep_ids=keep_ids)
+        except Exception as e:
+            # Пачка откатилась целиком - пишем построчно, чтобы не потерять остальные.
+            # Ловим не только ошибки SQLite: строка с неверными полями падает
+            # раньше, при разборе, и без этого уносила бы с собой всю пачку
+            logger.error(f"Error writing message batch of {len(rows)}: {e}")
+            for row in rows:
+                try:
+                    with self.pool.transaction() as conn:
+                        self._insert_messages(conn.cursor(), [row], keep_ids=keep_ids)
+                except Exception as row_error:
+                    logger.error(f"Dropping message for chat {row.get('chat_id')}: {row_error}")
+    
+    @routed_by_chat
+    def import_messages(self, chat_id: int, messages: Iterable[Dict], batch_size: int = None,
+                        progress: Callable[[int], None] = None) -> Optional[int]:
+        """Массовая загрузка истории чата (например, из экспорта Telegram Desktop).
+        
+        messages - строки в формате save_message, timestamp в секундах Unix.
+        Пишется executemany по batch_size строк в транзакции, между пачками
+        бот продолжает запись. Разделы, созданные загрузкой, получают индексы
+        и полнотекстовый индекс один раз в конце. Сообщения не старше самого
+        раннего уже сохраненного пропускаются - эта часть истории есть в базе.
+        progress(imported) вызывается после каждой пачки.
+        Возвращает число загруженных сообщений или None при ошибке.
+        """
+        batch_size = batch_size or config.IMPORT_BATCH_SIZE
+        imported = 0
+        deferred = []  # разделы этой загрузки: индексы строятся после нее
+        try:
+            self.flush_messages()
+            
+            earliest = self._query_partitions(self._partitions_for_range(), '''
+                SELECT timestamp FROM {table} WHERE chat_id = ? ORDER BY timestamp LIMIT ?
+            ''', (chat_id,), limit=1)
+            with self.pool.reader() as conn:
+                archived = conn.execute(
+                    "SELECT MIN(first_ts) FROM message_archive WHERE chat_id = ?", (chat_id,)
+                ).fetchone()[0]
+            known = [ts for ts in (archived, earliest[0][0] if earliest else None) if ts is not None]
+            cutoff = min(self._to_epoch(ts) for ts in known) if known else None
+            
+            batch = []
+            for message in messages:
+                if cutoff is not None and message['timestamp'] >= cutoff:
+                    continue
+                
+                batch.append(dict(message, chat_id=chat_id))
+                if len(batch) >= batch_size:
+                    imported += self._import_batch(batch, deferred)
+                    batch = []
+                    if progress:
+                        progress(imported)
+            
+            if batch:
+                imported += self._import_batch(batch, deferred)
+                if progress:
+                    progress(imported)
+            
+            return imported
             
-            cursor.execute('''
-                SELECT user_name, message_text, timestamp, message_type, user_id
-                FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ? OFFSET ?
-            ''', (chat_id, limit, offset))
-            
-            messages = []
-            for row in cursor.fetchall():
-                messages.append({
-                    'user': row[0],
-                    'text': row[1],
-                    'timestamp': row[2],
-                    'type': row[3],
-                    'user_id': row[4]
-                })
+        except Exception as e:
+            logger.error(f"Error importing messages after {imported} rows: {e}")
+            return None
+        
+        finally:
+            self._build_deferred_partitions(deferred)
+    
+    def _import_batch(self, rows: List[Dict], deferred: List[str]) -> int:
+        """Пачка массовой загрузки - одна транзакция (ошибка прерывает загрузку)"""
+        with self.pool.transaction() as conn:
+            self._insert_messages(conn.cursor(), rows, deferred)
+        return len(rows)
+    
+    def _build_deferred_partitions(self, deferred: List[str]):
+        """Индексы разделов, созданных массовой загрузкой"""
+        if not deferred:
+            return
+        
+        try:
+            # Одной транзакцией с триггером: записи бота не проскочат мимо FTS
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                existing = {name for _, _, name in self._partitions}
+                for name in deferred:
+                    if name in existing:  # раздел мог откатиться вместе с пачкой
+                        self._create_partition_indexes(cursor, name)
+            logger.info(f"Built indexes for {len(deferred)} imported partitions")
+            
+        except sqlite3.Error as e:
+            # Индексы достроятся при следующем запуске в init_database
+            logger.error(f"Error building indexes for imported partitions: {e}")
+    
+    def _insert_messages(self, cursor: sqlite3.Cursor, rows: List[Dict], deferred: List[str] = None,
+                         keep_ids: bool = False):
+        """Вставка сообщений в их разделы (вызывается внутри транзакции записи).
+        
+        deferred - только для массовой загрузки: новые разделы без индексов.
+        keep_ids - только для переноса в шарды: строки сохраняют свой id, на
+        который ссылаются extracted_texts и выданные курсоры.
+        """
+        partitions_before = self._partitions
+        try:
+            rows = self._apply_known_message_ids(cursor, rows)
+            
+            cursor.execute("SELECT last_id FROM message_id_sequence WHERE id = 1")
+            last_id = cursor.fetchone()[0]
+            
+            by_partition = {}
+            for row in rows:
+                if keep_ids:
+                    last_id = max(last_id, row['id'])
+                else:
+                    last_id += 1
+                    row['id'] = last_id
+                # Раздел и сводки - по тексту UTC, в строку - в формате хранения
+                row['timestamp_text'] = self._format_ts(row['timestamp'])
+                row['timestamp'] = self._storage_ts(row['timestamp'])
+                row.update(self._enrich(row['message_text']))
+                by_partition.setdefault(
+                    self._partition_for(cursor, row['timestamp_text'], deferred), []
+                ).append(row)
+            
+            for name, partition_rows in by_partition.items():
+                cursor.executemany(f'''
+                    INSERT INTO {name} 
+                    (id, chat_id, user_id, user_name, message_text, message_type, 
+                     media_file_id, reply_to_message_id, is_forwarded, timestamp, message_id,
+                     char_len, token_estimate, has_link, emoji_count, is_noise)
+                    VALUES (:id, :chat_id, :user_id, :user_name, :message_text, :message_type,
+                            :media_file_id, :reply_to_message_id, :is_forwarded, :timestamp,
+                            :message_id, :char_len, :token_estimate, :has_link, :emoji_count,
+                            :is_noise)
+                ''', partition_rows)
+            
+            cursor.executemany('''
+                INSERT INTO message_index (chat_id, message_id, id, timestamp, thread_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (row['chat_id'], row['message_id'], row['id'], self._to_epoch(row['timestamp_text']),
+                 thread_id)
+                for row, thread_id in self._resolve_threads(cursor, rows)
+            ])
+            
+            cursor.execute("UPDATE message_id_sequence SET last_id = ? WHERE id = 1", (last_id,))
+            if self._partitions is not partitions_before:
+                self._refresh_messages_view(cursor)
+            self._upsert_users(cursor, rows)
+            self._update_stats(cursor, rows)
+            self._update_counters(cursor, rows)
+            
+        except Exception:
+            # Транзакция откатится вместе с созданными в ней разделами
+            self._partitions = partitions_before
+            raise
+    
+    def _apply_known_message_ids(self, cursor: sqlite3.Cursor, rows: List[Dict]) -> List[Dict]:
+        """Обновление уже сохраненных сообщений (по message_id); возвращает новые строки.
+        
+        Правка обновляет только текст и его признаки: время, сводки и справочник
+        пользователей остаются от исходного сообщения.
+        """
+        fresh = []
+        pending = {}  # (chat_id, message_id) -> новая строка этой же пачки
+        for row in rows:
+            row.setdefault('message_id', None)
+            if row['message_id'] is None:
+                fresh.append(row)
+                continue
+            
+            key = (row['chat_id'], row['message_id'])
+            if key in pending:
+                pending[key]['message_text'] = row['message_text']
+                continue
+            
+            cursor.execute(
+                "SELECT id, timestamp FROM message_index WHERE chat_id = ? AND message_id = ?", key
+            )
+            stored = cursor.fetchone()
+            if stored is None:
+                if row.get('edit'):
+                    continue  # Правка сообщения, которого нет в базе
+                pending[key] = row
+                fresh.append(row)
+                continue
+            
+            features = dict(self._enrich(row['message_text']),
+                            message_text=row['message_text'], id=stored[0])
+            for name in self._partitions_for_range(stored[1], stored[1]):
+                cursor.execute(f'''
+                    UPDATE {name} SET message_text = :message_text, char_len = :char_len,
+                        token_estimate = :token_estimate, has_link = :has_link,
+                        emoji_count = :emoji_count, is_noise = :is_noise
+                    WHERE id = :id
+                ''', features)
+        return fresh
+    
+    def _resolve_threads(self, cursor: sqlite3.Cursor, rows: List[Dict]) -> List[Tuple[Dict, Optional[int]]]:
+        """Ветка для каждой строки с message_id: корень ветки родителя или сам родитель.
+        
+        Родитель ищется сначала в этой же пачке (импорт пишет ветку целиком),
+        затем точечным чтением message_index.
+        """
+        batch_threads = {}
+        resolved = []
+        for row in rows:
+            if row['message_id'] is None:
+                continue
+            
+            parent = row.get('reply_to_message_id')
+            thread_id = None
+            if parent is not None:
+                key = (row['chat_id'], parent)
+                if key in batch_threads:
+                    thread_id = batch_threads[key] or parent
+                else:
+                    cursor.execute(
+                        "SELECT thread_id FROM message_index WHERE chat_id = ? AND message_id = ?", key
+                    )
+                    stored = cursor.fetchone()
+                    thread_id = (stored[0] if stored else None) or parent
+            
+            batch_threads[(row['chat_id'], row['message_id'])] = thread_id
+            resolved.append((row, thread_id))
+        return resolved
+    
+    @routed_by_chat
+    def get_message(self, chat_id: int, message_id: int) -> Optional[MessageRecord]:
+        """Сохраненная копия сообщения Telegram (точечное чтение по message_index)"""
+        try:
+            self.flush_messages()
+            
+            with self.pool.reader() as conn:
+                stored = conn.execute(
+                    "SELECT id, timestamp FROM message_index WHERE chat_id = ? AND message_id = ?",
+                    (chat_id, message_id)
+                ).fetchone()
+                if stored is None:
+                    return None
+                
+                for name in self._partitions_for_range(stored[1], stored[1]):
+                    row = conn.execute(f'''
+                        SELECT user_name, message_text, timestamp, message_type, user_id
+                        FROM {name} WHERE id = ?
+                    ''', (stored[0],)).fetchone()
+                    if row:
+                        return MessageRecord(row[0], row[1], self._format_ts(row[2]), row[3],
+                                             row[4], stored[0], message_id)
+            return None
+            
+        except Exception as e:
+            logger.error(f"Error getting message {message_id}: {e}")
+            return None
+    
+    @routed_by_chat
+    def get_chat_counters(self, chat_id: int) -> ChatCounters:
+        """Счетчики активности чата - чтение одной строки, без подсчета сообщений"""
+        try:
+            self.flush_messages()
+            
+            with self.pool.reader() as conn:
+                row = conn.execute('''
+                    SELECT total_messages, last_id, last_message_id, last_timestamp, day, day_count
+                    FROM chat_counters WHERE chat_id = ?
+                ''', (chat_id,)).fetchone()
+            
+            if row is None:
+                return ChatCounters()
+            return ChatCounters(*row)
+            
+        except Exception as e:
+            logger.error(f"Error getting chat counters: {e}")
+            return ChatCounters()
+    
+    @routed_by_chat
+    def get_thread_messages(self, chat_id: int, message_id: int, limit: int = 100,
+                            text_limit: int = None) -> List[MessageRecord]:
+        """Ветка ответов, в которую входит сообщение: корень и все ответы.
+        
+        Возвращает не больше limit последних сообщений ветки в хронологическом
+        порядке. Члены ветки находятся по индексу (chat_id, thread_id), строки -
+        по id внутри своих разделов.
+        """
+        try:
+            self.flush_messages()
+            
+            with self.pool.reader() as conn:
+                row = conn.execute(
+                    "SELECT thread_id FROM message_index WHERE chat_id = ? AND message_id = ?",
+                    (chat_id, message_id)
+                ).fetchone()
+                root = row[0] if row and row[0] is not None else message_id
+                
+                members = conn.execute('''
+                    SELECT id, timestamp, message_id FROM message_index
+                    WHERE chat_id = ? AND message_id = ?
+                    UNION ALL
+                    SELECT id, timestamp, message_id FROM message_index
+                    WHERE chat_id = ? AND thread_id = ?
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                ''', (chat_id, root, chat_id, root, limit)).fetchall()
+                
+                by_partition = {}
+                message_ids = {}
+                for row_id, timestamp, member_id in members:
+                    message_ids[row_id] = member_id
+                    for name in self._partitions_for_range(timestamp, timestamp):
+                        by_partition.setdefault(name, []).append(row_id)
+                
+                rows = []
+                for name, ids in by_partition.items():
+                    placeholders = ', '.join('?' for _ in ids)
+                    rows.extend(conn.execute(f'''
+                        SELECT user_name, {self._text_column(text_limit)}, timestamp, message_type,
+                               user_id, id
+                        FROM {name} WHERE id IN ({placeholders})
+                    ''', ids).fetchall())
+            
+            messages = [
+                MessageRecord(row[0], row[1], self._format_ts(row[2]), row[3], row[4], row[5],
+                              message_ids[row[5]])
+                for row in rows
+            ]
+            messages.sort(key=lambda message: (message.timestamp, message.id))
+            return messages
+            
+        except Exception as e:
+            logger.error(f"Error getting thread of message {message_id}: {e}")
+            return []
+    
+    @routed_by_chat
+    def get_recent_messages(self, chat_id: int, limit: int = 50, 
+                           offset: int = 0, text_limit: int = None,
+                           skip_noise: bool = False, token_budget: int = None) -> List[MessageRecord]:
+        """Получение последних сообщений чата.
+        
+        Для постраничного просмотра истории используйте get_messages_page:
+        OFFSET читает и отбрасывает все пропущенные строки.
+        text_limit обрезает длинные тексты еще в SQL (см. _text_column),
+        skip_noise отбрасывает шум, token_budget оставляет столько новых
+        сообщений, сколько помещается в бюджет токенов (см. _query_budget).
+        """
+        try:
+            self.flush_messages()
+            
+            # Разделы от новых к старым, пока не наберется limit + offset строк
+            partitions = list(reversed(self._partitions_for_range()))
+            sql = f'''
+                SELECT user_name, {self._text_column(text_limit)}, timestamp, message_type, user_id,
+                       id, message_id, {self._token_column(text_limit)} AS tokens
+                FROM {{table}} 
+                WHERE chat_id = ? {self._noise_filter(skip_noise)}
+                ORDER BY timestamp DESC, id DESC 
+                LIMIT ?
+            '''
+            if token_budget:
+                rows = self._query_budget(partitions, sql, (chat_id,), limit + offset, token_budget)
+            else:
+                rows = self._query_partitions(partitions, sql, (chat_id,), limit=limit + offset)
             
-            conn.close()
+            messages = [
+                MessageRecord(row[0], row[1], self._format_ts(row[2]), row[3], row[4], row[5], row[6])
+                for row in rows[offset:]
+            ]
+                
             return list(reversed(messages))  # Возвращаем в хронологическом порядке
             
         except Exception as e:
             logger.error(f"Error getting recent messages: {e}")
             return []
     
-    def get_user_messages(self, chat_id: int, user_name: str, 
-                         limit: int = 100) -> List[Dict]:
-        """Получение сообщений конкретного пользователя"""
+    @routed_by_chat
+    def get_messages_page(self, chat_id: int, limit: int = 50, cursor: str = None,
+                          newest_first: bool = True,
+                          text_limit: int = None) -> Tuple[List[MessageRecord], Optional[str]]:
+        """Страница истории чата по курсору (keyset-пагинация по (timestamp, id)).
+        
+        Возвращает сообщения страницы и непрозрачный токен следующей страницы
+        (None, если история закончилась). Токен хранит позицию последней строки
+        и направление обхода, поэтому любая страница читается так же быстро,
+        как первая, а сообщения с одинаковым временем не теряются и не дублируются.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            self.flush_messages()
             
-            cursor.execute('''
-                SELECT message_text, timestamp, message_type
-                FROM messages 
-                WHERE chat_id = ? AND user_name = ?
-                ORDER BY timestamp DESC 
+            position = None
+            if cursor:
+                position, newest_first = self._decode_cursor(cursor)
+            
+            if newest_first:
+                order = 'DESC'
+                partitions = list(reversed(self._partitions_for_range(end_time=position and position[0])))
+            else:
+                order = 'ASC'
+                partitions = self._partitions_for_range(start_time=position and position[0])
+            
+            keyset, params = self._keyset_filter(position, newest_first) if position else ("", ())
+            rows = self._query_partitions(partitions, f'''
+                SELECT id, user_name, {self._text_column(text_limit)}, timestamp, message_type, user_id,
+                       message_id
+                FROM {{table}} 
+                WHERE chat_id = ? {keyset}
+                ORDER BY timestamp {order}, id {order} 
                 LIMIT ?
-            ''', (chat_id, user_name, limit))
+            ''', (chat_id, *params), limit=limit)
             
             messages = [
-                {
-                    'text': row[0],
-                    'timestamp': row[1],
-                    'type': row[2]
-                } 
-                for row in cursor.fetchall()
+                MessageRecord(row[1], row[2], self._format_ts(row[3]), row[4], row[5], row[0], row[6])
+                for row in rows
             ]
             
-            conn.close()
+            next_cursor = None
+            if len(rows) == limit:
+                next_cursor = self._encode_cursor(rows[-1][3], rows[-1][0], newest_first)
+            
+            return messages, next_cursor
+            
+        except Exception as e:
+            logger.error(f"Error getting messages page: {e}")
+            return [], None
+    
+    def _keyset_filter(self, position: Tuple, newest_first: bool) -> Tuple[str, tuple]:
+        """Условие "после позиции курсора" в порядке обхода.
+        
+        Во время миграции на epoch числовые строки сравниваются с позицией
+        в секундах, текстовые - с ней же в виде текста (числа меньше строк,
+        поэтому без проверки вида одна из ветвей захватила бы чужие строки).
+        """
+        epoch, message_id = position
+        if self._epoch_timestamps:
+            compare = '<' if newest_first else '>'
+            return f"AND (timestamp, id) {compare} (?, ?)", (epoch, message_id)
+        
+        text = self._format_ts(epoch)
+        if newest_first:
+            condition = "AND ((timestamp, id) < (?, ?) OR (timestamp >= '' AND (timestamp, id) < (?, ?)))"
+        else:
+            condition = "AND ((timestamp < '' AND (timestamp, id) > (?, ?)) OR (timestamp, id) > (?, ?))"
+        return condition, (epoch, message_id, text, message_id)
+    
+    def _encode_cursor(self, timestamp, message_id: int, newest_first: bool) -> str:
+        """Непрозрачный токен позиции в истории"""
+        payload = json.dumps([self._to_epoch(timestamp), message_id, newest_first], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+    
+    def _decode_cursor(self, cursor: str) -> Tuple[Tuple, bool]:
+        """Разбор токена: ((timestamp, id), newest_first)"""
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, message_id, newest_first = json.loads(base64.urlsafe_b64decode(padded))
+        return (self._to_epoch(timestamp), int(message_id)), bool(newest_first)
+    
+    def find_user_ids(self, name: str, chat_id: int = None) -> List[int]:
+        """Поиск user_id по любому известному имени пользователя (без учета регистра).
+        
+        В режиме шардирования ищет в шарде чата chat_id (без него - во всех).
+        """
+        if self.shards:
+            shards = [self.shard_for(chat_id)] if chat_id is not None else self.shards
+            return sorted({user_id for shard in shards for user_id in shard.find_user_ids(name)})
+        
+        try:
+            self.flush_messages()
+            
+            with self.pool.reader() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT DISTINCT user_id FROM user_names WHERE name_key = ?
+                ''', (name.lstrip('@').casefold(),))
+                
+                return [row[0] for row in cursor.fetchall()]
+            
+        except Exception as e:
+            logger.error(f"Error finding user ids: {e}")
+            return []
+    
+    @routed_by_chat
+    def get_user_messages(self, chat_id: int, user_name: str, 
+                         limit: int = 100, text_limit: int = None,
+                         skip_noise: bool = False) -> List[MessageRecord]:
+        """Получение сообщений конкретного пользователя (по username или имени)"""
+        user_ids = self.find_user_ids(user_name, chat_id)
+        if not user_ids:
+            return []
+        return self.get_messages_by_user_ids(chat_id, user_ids, limit, text_limit, skip_noise)
+    
+    @routed_by_chat
+    def get_messages_by_user_ids(self, chat_id: int, user_ids: List[int], 
+                                 limit: int = 100, text_limit: int = None,
+                                 skip_noise: bool = False) -> List[MessageRecord]:
+        """Последние сообщения пользователей по индексу (chat_id, user_id, timestamp)"""
+        try:
+            self.flush_messages()
+            
+            placeholders = ', '.join('?' for _ in user_ids)
+            rows = self._query_partitions(list(reversed(self._partitions_for_range())), f'''
+                SELECT user_name, {self._text_column(text_limit)}, timestamp, message_type, user_id,
+                       id, message_id
+                FROM {{table}} 
+                WHERE chat_id = ? AND user_id IN ({placeholders}) {self._noise_filter(skip_noise)}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (chat_id, *user_ids), limit=limit)
+            
+            messages = [
+                MessageRecord(row[0], row[1], self._format_ts(row[2]), row[3], row[4], row[5], row[6])
+                for row in rows
+            ]
+                
             return messages
             
         except Exception as e:
             logger.error(f"Error getting user messages: {e}")
             return []
     
+    @routed_by_chat
     def get_messages_by_time_range(self, chat_id: int, 
                                  start_time: datetime, 
-                                 end_time: datetime) -> List[Dict]:
-        """Получение сообщений за определенный период времени"""
+                                 end_time: datetime,
+                                 text_limit: int = None,
+                                 skip_noise: bool = False) -> List[MessageRecord]:
+        """Получение сообщений за определенный период времени (включая архив)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            return list(self.iter_messages_by_time_range(chat_id, start_time, end_time,
+                                                         text_limit=text_limit, skip_noise=skip_noise))
             
-            cursor.execute('''
-                SELECT user_name, message_text, timestamp, message_type
-                FROM messages 
-                WHERE chat_id = ? AND timestamp BETWEEN ? AND ?
-                ORDER BY timestamp ASC
-            ''', (chat_id, start_time, end_time))
+        except Exception as e:
+            logger.error(f"Error getting messages by time range: {e}")
+            return []
+    
+    @routed_by_chat
+    def iter_messages_by_time_range(self, chat_id: int, start_time: datetime, end_time: datetime,
+                                    chunk_size: int = None, text_limit: int = None,
+                                    skip_noise: bool = False) -> Iterator[MessageRecord]:
+        """Потоковое чтение сообщений за период, от старых к новым.
+        
+        В памяти одновременно не больше пачки строк (или одного архивного
+        блока), поэтому подходит для периодов любой длины. Ошибки не
+        перехватываются: прерванный поток не должен выглядеть полным.
+        """
+        self.flush_messages()
+        
+        # Архив старше всех разделов - читаем его, только если период туда заходит
+        if not self._partitions or self._format_ts(start_time) < self._partitions[0][0]:
+            for row in self._iter_archive(chat_id, self._to_epoch(start_time), self._to_epoch(end_time)):
+                if skip_noise and self._enrich(row[3])['is_noise']:
+                    continue  # В архиве признаков нет - считаем при чтении
+                yield MessageRecord(row[2], self._truncate_text(row[3], text_limit),
+                                    self._format_ts(row[6]), row[4], row[1], row[0])
+        
+        # Только разделы, пересекающиеся с периодом, от старых к новым
+        time_filter, params = self._time_range_filter(start_time, end_time)
+        rows = self._stream_partitions(self._partitions_for_range(start_time, end_time), f'''
+            SELECT user_name, {self._text_column(text_limit)}, timestamp, message_type, user_id,
+                   id, message_id
+            FROM {{table}} 
+            WHERE chat_id = ? AND {time_filter} {self._noise_filter(skip_noise)}
+            ORDER BY timestamp ASC
+        ''', (chat_id, *params), chunk_size)
+        
+        for row in rows:
+            yield MessageRecord(row[0], row[1], self._format_ts(row[2]), row[3], row[4], row[5], row[6])
+    
+    @staticmethod
+    def _token_column(text_limit: int = None) -> str:
+        """Оценка токенов сообщения в SELECT с учетом обрезки text_limit.
+        
+        Строки, которые миграция 5 еще не обработала, оцениваются по длине текста.
+        """
+        tokens = "COALESCE(token_estimate, (length(message_text) + 2) / 3, 0)"
+        if not text_limit:
+            return tokens
+        return f"MIN({tokens}, {(int(text_limit) + 2) // 3})"
+    
+    @staticmethod
+    def _noise_filter(skip_noise: bool) -> str:
+        """Условие WHERE, отбрасывающее шум (непосчитанные строки шумом не считаются)"""
+        return "AND COALESCE(is_noise, 0) = 0" if skip_noise else ""
+    
+    @staticmethod
+    def _text_column(text_limit: int = None) -> str:
+        """Текст сообщения в SELECT; с text_limit длинные тексты обрезаются в SQL.
+        
+        Из базы в Python копируется только нужная часть текста, поэтому
+        обработчикам не нужно резать каждое сообщение заново.
+        """
+        if not text_limit:
+            return "message_text"
+        text_limit = int(text_limit)
+        return (f"CASE WHEN length(message_text) > {text_limit} "
+                f"THEN substr(message_text, 1, {max(text_limit - 3, 1)}) || '...' "
+                f"ELSE message_text END")
+    
+    @staticmethod
+    def _truncate_text(text: Optional[str], text_limit: int = None) -> Optional[str]:
+        """То же, что _text_column, для строк из архива"""
+        if not text_limit or not text or len(text) <= text_limit:
+            return text
+        return text[:max(text_limit - 3, 1)] + '...'
+    
+    # Поля выгрузки истории в порядке колонок CSV
+    EXPORT_FIELDS = ('timestamp', 'user', 'type', 'text')
+    
+    @routed_by_chat
+    def export_messages(self, chat_id: int, start_time: datetime, end_time: datetime,
+                        output: TextIO, export_format: str = 'jsonl') -> Optional[int]:
+        """Выгрузка истории чата в файл (JSONL или CSV) потоком.
+        
+        Возвращает число записанных сообщений или None при ошибке.
+        """
+        try:
+            messages = self.iter_messages_by_time_range(chat_id, start_time, end_time)
+            count = 0
+            
+            if export_format == 'csv':
+                writer = csv.writer(output)
+                writer.writerow(self.EXPORT_FIELDS)
+                for message in messages:
+                    writer.writerow([getattr(message, field) for field in self.EXPORT_FIELDS])
+                    count += 1
+            else:
+                for message in messages:
+                    record = {field: getattr(message, field) for field in self.EXPORT_FIELDS}
+                    output.write(json.dumps(record, ensure_ascii=False))
+                    output.write('\n')
+                    count += 1
             
-            messages = [
+            return count
+            
+        except Exception as e:
+            logger.error(f"Error exporting messages: {e}")
+            return None
+    
+    def _time_range_filter(self, start_time, end_time) -> Tuple[str, tuple]:
+        """Условие по времени для запроса к разделу.
+        
+        Пока идет миграция на epoch, в разделе встречаются и числа, и строки:
+        число никогда не попадает в диапазон строк и наоборот, поэтому
+        проверяем оба диапазона.
+        """
+        epoch = (self._to_epoch(start_time), self._to_epoch(end_time))
+        if self._epoch_timestamps:
+            return "timestamp BETWEEN ? AND ?", epoch
+        text = (self._format_ts(start_time), self._format_ts(end_time))
+        return "(timestamp BETWEEN ? AND ? OR timestamp BETWEEN ? AND ?)", epoch + text
+    
+    @routed_by_chat
+    def search_messages(self, chat_id: int, query: str, limit: int = 10) -> List[Dict]:
+        """Полнотекстовый поиск по истории чата (лучшие совпадения первыми)"""
+        try:
+            self.flush_messages()
+            
+            match = self._build_fts_query(query)
+            if not match:
+                return []
+            
+            # Лучшие совпадения каждого раздела, затем общий отбор по рангу bm25
+            rows = []
+            with self.pool.reader() as conn:
+                for name in reversed(self._partitions_for_range()):
+                    rows.extend(conn.execute(f'''
+                        SELECT m.user_name, m.timestamp,
+                               snippet({name}_fts, 0, '«', '»', '…', 12),
+                               {name}_fts.rank
+                        FROM {name}_fts
+                        JOIN {name} m ON m.id = {name}_fts.rowid
+                        WHERE {name}_fts MATCH ? AND m.chat_id = ?
+                        ORDER BY {name}_fts.rank
+                        LIMIT ?
+                    ''', (match, chat_id, limit)).fetchall())
+            
+            rows.sort(key=lambda row: row[3])
+            results = [
                 {
                     'user': row[0],
-                    'text': row[1],
-                    'timestamp': row[2],
-                    'type': row[3]
+                    'timestamp': self._format_ts(row[1]),
+                    'snippet': row[2]
                 }
-                for row in cursor.fetchall()
+                for row in rows[:limit]
             ]
             
-            conn.close()
-            return messages
+            # Недостающие результаты - из холодного архива, новые первыми
+            if len(results) < limit:
+                results += self._search_archive(chat_id, query, limit - len(results))
+                
+            return results
             
         except Exception as e:
-            logger.error(f"Error getting messages by time range: {e}")
+            logger.error(f"Error searching messages: {e}")
             return []
     
+    @staticmethod
+    def _build_fts_query(query: str) -> str:
+        """Построение запроса FTS5 из пользовательского текста.
+        
+        Длинные слова обрезаются до основы и ищутся по префиксу, чтобы
+        находить разные падежи и формы: "проекта" -> "проек*".
+        """
+        terms = []
+        for word in re.findall(r'\w+', query.lower()):
+            if len(word) > 5:
+                word = word[:max(5, len(word) - 2)]
+            terms.append(f'"{word}"*')
+        return " AND ".join(terms)
+    
+    @routed_by_chat
     def get_chat_statistics(self, chat_id: int, days: int = 7) -> Dict:
-        """Получение статистики чата"""
+        """Получение статистики чата (по почасовым сводкам, а не по сообщениям)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            self.flush_messages()
             
-            start_date = datetime.now() - timedelta(days=days)
-            
-            # Общее количество сообщений
-            cursor.execute('''
-                SELECT COUNT(*) FROM messages 
-                WHERE chat_id = ? AND timestamp > ?
-            ''', (chat_id, start_date))
-            total_messages = cursor.fetchone()[0]
-            
-            # Количество активных пользователей
-            cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) FROM messages 
-                WHERE chat_id = ? AND timestamp > ?
-            ''', (chat_id, start_date))
-            active_users = cursor.fetchone()[0]
-            
-            # Самые активные пользователи
-            cursor.execute('''
-                SELECT user_name, COUNT(*) as message_count 
-                FROM messages 
-                WHERE chat_id = ? AND timestamp > ?
-                GROUP BY user_name 
-                ORDER BY message_count DESC 
-                LIMIT 10
-            ''', (chat_id, start_date))
-            
-            top_users = [
-                {'user': row[0], 'count': row[1]}
-                for row in cursor.fetchall()
-            ]
-            
-            # Распределение по типам сообщений
-            cursor.execute('''
-                SELECT message_type, COUNT(*) 
-                FROM messages 
-                WHERE chat_id = ? AND timestamp > ?
-                GROUP BY message_type
-            ''', (chat_id, start_date))
-            
-            message_types = {
-                row[0]: row[1] for row in cursor.fetchall()
-            }
+            start_hour = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:00:00')
             
-            conn.close()
+            with self.pool.reader() as conn:
+                cursor = conn.cursor()
+                
+                # Распределение по типам сообщений
+                cursor.execute('''
+                    SELECT message_type, SUM(message_count) 
+                    FROM chat_stats_hourly 
+                    WHERE chat_id = ? AND hour >= ?
+                    GROUP BY message_type
+                ''', (chat_id, start_hour))
+                
+                message_types = {
+                    row[0]: row[1] for row in cursor.fetchall()
+                }
+                
+                # Общее количество сообщений
+                total_messages = sum(message_types.values())
+                
+                # Сообщения по пользователям; имя - из последнего часа активности
+                cursor.execute('''
+                    SELECT user_name, SUM(message_count) as message_count, MAX(hour) 
+                    FROM user_stats_hourly 
+                    WHERE chat_id = ? AND hour >= ?
+                    GROUP BY user_id 
+                    ORDER BY message_count DESC
+                ''', (chat_id, start_hour))
+                
+                users = cursor.fetchall()
+                
+                # Количество активных пользователей
+                active_users = len(users)
+                
+                # Самые активные пользователи
+                top_users = [
+                    {'user': row[0], 'count': row[1]}
+                    for row in users[:10]
+                ]
+                
             
             return {
                 'total_messages': total_messages,
@@ -292,77 +2697,163 @@ class DatabaseManager:
                           confidence_score: float = None) -> bool:
         """Сохранение извлеченного текста из медиа"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO extracted_texts 
-                (original_message_id, chat_id, extracted_text, extraction_type, confidence_score)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (original_message_id, chat_id, extracted_text, extraction_type, confidence_score))
-            
-            conn.commit()
-            conn.close()
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    INSERT INTO extracted_texts 
+                    (original_message_id, chat_id, extracted_text, extraction_type, confidence_score)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (original_message_id, chat_id, extracted_text, extraction_type, confidence_score))
+                
             return True
             
         except Exception as e:
             logger.error(f"Error saving extracted text: {e}")
             return False
     
-    def log_command_usage(self, chat_id: int, user_id: int, 
-                         command: str, success: bool = True) -> bool:
-        """Логирование использования команд"""
+    def get_extracted_text(self, chat_id: int, original_message_id: int) -> Optional[str]:
+        """Последний извлеченный текст сохраненного сообщения (None, если не извлекался)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO command_stats 
-                (chat_id, user_id, command, success)
-                VALUES (?, ?, ?, ?)
-            ''', (chat_id, user_id, command, success))
+            with self.pool.reader() as conn:
+                row = conn.execute('''
+                    SELECT extracted_text FROM extracted_texts
+                    WHERE chat_id = ? AND original_message_id = ?
+                    ORDER BY id DESC LIMIT 1
+                ''', (chat_id, original_message_id)).fetchone()
+            return row[0] if row else None
             
-            conn.commit()
-            conn.close()
+        except Exception as e:
+            logger.error(f"Error getting extracted text: {e}")
+            return None
+    
+    def log_command_usage(self, chat_id: int, user_id: int, 
+                         command: str, success: bool = True, **telemetry) -> bool:
+        """Логирование использования команд.
+        
+        Запись не ждет диска: строка попадает в буфер и пишется в command_stats
+        пачкой (COMMAND_STATS_BATCH_SIZE строк или раз в COMMAND_STATS_FLUSH_MS).
+        Вызывается из цикла событий, поэтому при заполненном буфере строка
+        отбрасывается (False), а не ждет сброса.
+        telemetry - колонки COMMAND_TELEMETRY_COLUMNS (wall_ms, db_ms, ...).
+        """
+        try:
+            row = {column: telemetry.get(column) for column, _ in self.COMMAND_TELEMETRY_COLUMNS}
+            row.update(
+                chat_id=chat_id, user_id=user_id, command=command, success=success,
+                timestamp=datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            )
+            
+            if self._command_buffer is None:
+                with self._command_buffer_lock:
+                    if self._command_buffer is None:
+                        self._command_buffer = MessageBuffer(
+                            self._write_command_stats,
+                            max_rows=config.COMMAND_STATS_BATCH_SIZE,
+                            interval_ms=config.COMMAND_STATS_FLUSH_MS
+                        )
+            if not self._command_buffer.put(row, block=False):
+                logger.warning(f"Command stats buffer is full, dropped telemetry for /{command}")
+                return False
             return True
             
         except Exception as e:
             logger.error(f"Error logging command usage: {e}")
             return False
     
+    def _write_command_stats(self, rows: List[Dict]):
+        """Запись пачки телеметрии команд одной транзакцией"""
+        columns = ('chat_id', 'user_id', 'command', 'success', 'timestamp') + tuple(
+            column for column, _ in self.COMMAND_TELEMETRY_COLUMNS
+        )
+        with self.pool.transaction() as conn:
+            conn.executemany(f'''
+                INSERT INTO command_stats ({', '.join(columns)})
+                VALUES ({', '.join(':' + column for column in columns)})
+            ''', rows)
+    
+    def flush_command_stats(self) -> int:
+        """Немедленная запись буфера телеметрии команд"""
+        return self._command_buffer.flush() if self._command_buffer is not None else 0
+    
+    def get_command_performance(self, hours: int = 24) -> List[Dict]:
+        """Перцентили времени команд за последние hours часов.
+        
+        p50/p95/p99 полного времени считаются в SQL оконными функциями
+        (ближайший ранг), в Python приходит по строке на команду.
+        """
+        try:
+            self.flush_command_stats()
+            start = (datetime.now(timezone.utc) - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+            
+            with self.pool.reader() as conn:
+                rows = conn.execute('''
+                    WITH ranked AS (
+                        SELECT command, wall_ms, db_ms, llm_ms, prompt_tokens, completion_tokens,
+                               outcome,
+                               ROW_NUMBER() OVER (PARTITION BY command ORDER BY wall_ms) AS rank,
+                               COUNT(*) OVER (PARTITION BY command) AS total
+                        FROM command_stats
+                        WHERE timestamp >= ? AND wall_ms IS NOT NULL
+                    )
+                    SELECT command, total,
+                           MAX(CASE WHEN rank = (total * 50 + 99) / 100 THEN wall_ms END),
+                           MAX(CASE WHEN rank = (total * 95 + 99) / 100 THEN wall_ms END),
+                           MAX(CASE WHEN rank = (total * 99 + 99) / 100 THEN wall_ms END),
+                           AVG(db_ms), AVG(llm_ms), AVG(prompt_tokens), AVG(completion_tokens),
+                           SUM(outcome != 'ok')
+                    FROM ranked
+                    GROUP BY command
+                    ORDER BY total DESC
+                ''', (start,)).fetchall()
+            
+            return [
+                {
+                    'command': row[0], 'count': row[1],
+                    'p50_ms': row[2], 'p95_ms': row[3], 'p99_ms': row[4],
+                    'avg_db_ms': row[5] or 0, 'avg_llm_ms': row[6] or 0,
+                    'avg_prompt_tokens': row[7] or 0, 'avg_completion_tokens': row[8] or 0,
+                    'errors': row[9] or 0
+                }
+                for row in rows
+            ]
+            
+        except Exception as e:
+            logger.error(f"Error getting command performance: {e}")
+            return []
+    
     def get_command_stats(self, chat_id: int = None, days: int = 30) -> Dict:
         """Получение статистики использования команд"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            start_date = datetime.now() - timedelta(days=days)
-            
-            if chat_id:
-                cursor.execute('''
-                    SELECT command, COUNT(*) as usage_count 
-                    FROM command_stats 
-                    WHERE chat_id = ? AND timestamp > ?
-                    GROUP BY command 
-                    ORDER BY usage_count DESC
-                ''', (chat_id, start_date))
-            else:
-                cursor.execute('''
-                    SELECT command, COUNT(*) as usage_count 
-                    FROM command_stats 
-                    WHERE timestamp > ?
-                    GROUP BY command 
-                    ORDER BY usage_count DESC
-                ''', (start_date,))
-            
-            command_stats = {
-                row[0]: row[1] for row in cursor.fetchall()
-            }
-            
-            # Общее количество команд
-            total_commands = sum(command_stats.values())
-            
-            conn.close()
+            with self.pool.reader() as conn:
+                cursor = conn.cursor()
+                
+                start_date = datetime.now() - timedelta(days=days)
+                
+                if chat_id:
+                    cursor.execute('''
+                        SELECT command, COUNT(*) as usage_count 
+                        FROM command_stats 
+                        WHERE chat_id = ? AND timestamp > ?
+                        GROUP BY command 
+                        ORDER BY usage_count DESC
+                    ''', (chat_id, start_date))
+                else:
+                    cursor.execute('''
+                        SELECT command, COUNT(*) as usage_count 
+                        FROM command_stats 
+                        WHERE timestamp > ?
+                        GROUP BY command 
+                        ORDER BY usage_count DESC
+                    ''', (start_date,))
+                
+                command_stats = {
+                    row[0]: row[1] for row in cursor.fetchall()
+                }
+                
+                # Общее количество команд
+                total_commands = sum(command_stats.values())
+                
             
             return {
                 'total_commands': total_commands,
@@ -374,31 +2865,70 @@ class DatabaseManager:
             logger.error(f"Error getting command stats: {e}")
             return {}
     
-    def cleanup_old_messages(self, days: int = 90) -> int:
-        """Очистка старых сообщений (для экономии места)"""
+    def cleanup_old_messages(self, days: int = None) -> int:
+        """Очистка старых сообщений (для экономии места).
+        
+        Удаляются только разделы, целиком вышедшие за срок хранения: DROP TABLE
+        не блокирует запись надолго и не фрагментирует файл, как DELETE по
+        всей таблице. Сообщения живут не дольше срока плюс один раздел.
+        При MESSAGE_ARCHIVE_ENABLED раздел перед удалением переносится в
+        сжатый архив, откуда блоки удаляются через MESSAGE_ARCHIVE_RETENTION_DAYS.
+        Почасовые сводки хранятся MAX_STATS_DAYS - самый длинный период /stats.
+        """
         try:
-            cutoff_date = datetime.now() - timedelta(days=days)
-            
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                DELETE FROM messages 
-                WHERE timestamp < ?
-            ''', (cutoff_date,))
-            
-            deleted_count = cursor.rowcount
-            
-            # Также очищаем связанные извлеченные тексты
-            cursor.execute('''
-                DELETE FROM extracted_texts 
-                WHERE created_at < ?
-            ''', (cutoff_date,))
-            
-            conn.commit()
-            conn.close()
+            if days is None:
+                days = config.MESSAGE_RETENTION_DAYS
+            cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+            cutoff_ts = self._format_ts(cutoff)
+            
+            deleted_count = sum(shard.cleanup_old_messages(days) for shard in self.shards)
+            
+            expired = [name for _, end, name in self._partitions if end <= cutoff_ts]
+            if config.MESSAGE_ARCHIVE_ENABLED:
+                for name in expired:
+                    archived = self._archive_partition(name)
+                    logger.info(f"Archived {archived} messages from {name}")
+            
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                
+                for name in expired:
+                    cursor.execute(f'''
+                        DELETE FROM message_index WHERE (chat_id, message_id) IN (
+                            SELECT chat_id, message_id FROM {name} WHERE message_id IS NOT NULL
+                        )
+                    ''')
+                    cursor.execute(f"SELECT COUNT(*) FROM {name}")
+                    deleted_count += cursor.fetchone()[0]
+                    
+                    cursor.execute(f"DROP TABLE {name}_fts")
+                    cursor.execute(f"DROP TABLE {name}")
+                    cursor.execute("DELETE FROM message_partitions WHERE name = ?", (name,))
+                
+                if expired:
+                    self._load_partitions(cursor)
+                    self._refresh_messages_view(cursor)
+                
+                if config.MESSAGE_ARCHIVE_RETENTION_DAYS:
+                    archive_cutoff = datetime.now(timezone.utc) - timedelta(days=config.MESSAGE_ARCHIVE_RETENTION_DAYS)
+                    cursor.execute(
+                        "DELETE FROM message_archive WHERE last_ts < ?",
+                        (self._to_epoch(archive_cutoff),)
+                    )
+                
+                stats_cutoff = datetime.now(timezone.utc) - timedelta(days=config.MAX_STATS_DAYS)
+                stats_hour = stats_cutoff.strftime('%Y-%m-%d %H:00:00')
+                cursor.execute("DELETE FROM chat_stats_hourly WHERE hour < ?", (stats_hour,))
+                cursor.execute("DELETE FROM user_stats_hourly WHERE hour < ?", (stats_hour,))
+                
+                # Также очищаем связанные извлеченные тексты
+                cursor.execute('''
+                    DELETE FROM extracted_texts 
+                    WHERE created_at < ?
+                ''', (cutoff_ts,))
+                
             
-            logger.info(f"Cleaned up {deleted_count} messages older than {days} days")
+            logger.info(f"Dropped {len(expired)} partitions with {deleted_count} messages older than {days} days")
             return deleted_count
             
         except Exception as e:
@@ -408,47 +2938,182 @@ class DatabaseManager:
     def get_database_size(self) -> int:
         """Получение размера базы данных в байтах"""
         try:
-            import os
-            return os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
+            size = os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
+            return size + sum(shard.get_database_size() for shard in self.shards)
         except Exception as e:
             logger.error(f"Error getting database size: {e}")
             return 0
     
-    def backup_database(self, backup_path: str = None) -> bool:
-        """Создание резервной копии базы данных"""
+    def get_storage_stats(self) -> List[Dict]:
+        """Размеры таблиц и индексов, число строк и размер WAL по каждому файлу базы.
+        
+        Размеры берутся из виртуальной таблицы dbstat (если SQLite собран без
+        нее - None). Полнотекстовый индекс раздела считается индексом раздела.
+        Строки считаются COUNT(*) - команда для администраторов, не для горячего пути.
+        """
         try:
+            wal_path = self.db_path + "-wal"
+            stats = {
+                'path': self.db_path,
+                'size': os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0,
+                'wal_size': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+                'tables': []
+            }
+            
+            with self.pool.reader() as conn:
+                objects = conn.execute('''
+                    SELECT name, type, tbl_name, sql FROM sqlite_master
+                    WHERE type IN ('table', 'index') AND name NOT LIKE 'sqlite_stat%'
+                ''').fetchall()
+                
+                try:
+                    sizes = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"))
+                except sqlite3.Error:
+                    sizes = None
+                
+                tables = {}
+                fts = {name for name, _, _, sql in objects if (sql or '').startswith('CREATE VIRTUAL')}
+                for name, kind, table, sql in objects:
+                    # Служебные таблицы FTS5: messages_pX_fts_data и т. п.
+                    base = next((v for v in fts if name.startswith(v + '_')), None)
+                    if kind == 'table' and base is None and name not in fts:
+                        tables[name] = {
+                            'name': name,
+                            'rows': conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0],
+                            'size': sizes.get(name, 0) if sizes is not None else None,
+                            'index_size': 0 if sizes is not None else None
+                        }
+                
+                if sizes is not None:
+                    for name, kind, table, _ in objects:
+                        base = next((v for v in fts if name.startswith(v + '_')), None)
+                        owner = base[:-len('_fts')] if base and base.endswith('_fts') else table
+                        if (kind == 'index' or base) and owner in tables:
+                            tables[owner]['index_size'] += sizes.get(name, 0)
+                            
+            stats['tables'] = sorted(
+                tables.values(), key=lambda table: -((table['size'] or 0) + (table['index_size'] or 0))
+            )
+            return [stats] + [shard_stats for shard in self.shards for shard_stats in shard.get_storage_stats()]
+            
+        except Exception as e:
+            logger.error(f"Error getting storage stats: {e}")
+            return []
+    
+    def backup_database(self, backup_path: str = None, compress: bool = None) -> bool:
+        """Онлайн-резервная копия базы данных через SQLite backup API.
+        
+        Копия снимается постранично, не мешая записи, и всегда согласована
+        (в отличие от копирования файла работающей базы). Без backup_path копия
+        кладется в DB_BACKUP_DIR, а копии старше DATABASE_BACKUP_DAYS удаляются.
+        Шарды копируются рядом, в файлы с суффиксом .shardN. Перед копией
+        буферы записи сбрасываются: в нее попадает все, что бот уже получил.
+        """
+        try:
+            import gzip
             import shutil
-            import datetime
             
-            if backup_path is None:
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                backup_path = f"chat_data_backup_{timestamp}.db"
+            if compress is None:
+                compress = config.DB_BACKUP_COMPRESS
             
-            shutil.copy2(self.db_path, backup_path)
-            logger.info(f"Database backed up to: {backup_path}")
-            return True
+            self.flush_messages()
+            self.flush_command_stats()
+            
+            shards_ok = True
+            for i, shard in enumerate(self.shards):
+                shard_path = None
+                if backup_path is not None:
+                    root, ext = os.path.splitext(backup_path[:-3] if backup_path.endswith('.gz') else backup_path)
+                    shard_path = f"{root}.shard{i}{ext}"
+                shards_ok = shard.backup_database(shard_path, compress) and shards_ok
+            
+            rotate = backup_path is None
+            if backup_path is None:
+                os.makedirs(config.DB_BACKUP_DIR, exist_ok=True)
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                backup_path = os.path.join(config.DB_BACKUP_DIR, f"{self._backup_stem()}_backup_{timestamp}.db")
+            if compress and not backup_path.endswith('.gz'):
+                backup_path += '.gz'
+            
+            raw_path = backup_path[:-3] if compress else backup_path
+            started = time.perf_counter()
+            
+            target = sqlite3.connect(raw_path)
+            try:
+                self.pool.backup(
+                    target,
+                    pages=config.DB_BACKUP_PAGES_PER_STEP,
+                    pause=config.DB_BACKUP_STEP_PAUSE_MS / 1000
+                )
+                page_size = target.execute("PRAGMA page_size").fetchone()[0]
+                page_count = target.execute("PRAGMA page_count").fetchone()[0]
+            finally:
+                target.close()
+            
+            if compress:
+                with open(raw_path, 'rb') as source, gzip.open(backup_path, 'wb', compresslevel=6) as output:
+                    shutil.copyfileobj(source, output, 1024 * 1024)
+                os.remove(raw_path)
+            
+            elapsed = time.perf_counter() - started
+            size_mb = page_size * page_count / (1024 * 1024)
+            logger.info(
+                f"Database backed up to: {backup_path} "
+                f"({size_mb:.1f} MB in {elapsed:.2f} s, {size_mb / max(elapsed, 1e-6):.1f} MB/s)"
+            )
+            
+            if rotate:
+                self.rotate_backups()
+            return shards_ok
             
         except Exception as e:
             logger.error(f"Error backing up database: {e}")
             return False
     
+    def _backup_stem(self) -> str:
+        """Имя файла базы без расширения: chat_data, chat_data.shard0, ..."""
+        return os.path.splitext(os.path.basename(self.db_path))[0]
+    
+    def rotate_backups(self, keep_days: int = None) -> int:
+        """Удаление резервных копий старше DATABASE_BACKUP_DAYS"""
+        try:
+            import glob
+            
+            if keep_days is None:
+                keep_days = config.DATABASE_BACKUP_DAYS
+            cutoff = time.time() - keep_days * 86400
+            
+            removed = 0
+            pattern = f"{glob.escape(self._backup_stem())}_backup_*.db*"
+            for path in glob.glob(os.path.join(config.DB_BACKUP_DIR, pattern)):
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            
+            if removed:
+                logger.info(f"Removed {removed} backups older than {keep_days} days")
+            return removed
+            
+        except Exception as e:
+            logger.error(f"Error rotating backups: {e}")
+            return 0
+    
     # Методы для работы с настройками чата
     
     def get_chat_settings(self, chat_id: int) -> Dict:
         """Получение настроек чата"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT daily_summary_enabled, summary_time, pin_summary, 
-                       bot_personality, language, created_at, updated_at
-                FROM chat_settings 
-                WHERE chat_id = ?
-            ''', (chat_id,))
-            
-            result = cursor.fetchone()
-            conn.close()
+            with self.pool.reader() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute('''
+                    SELECT daily_summary_enabled, summary_time, pin_summary, 
+                           bot_personality, language, created_at, updated_at
+                    FROM chat_settings 
+                    WHERE chat_id = ?
+                ''', (chat_id,))
+                
+                result = cursor.fetchone()
             
             if result:
                 return {
@@ -479,37 +3144,37 @@ class DatabaseManager:
     def update_chat_settings(self, chat_id: int, **kwargs) -> bool:
         """Обновление настроек чата"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            allowed_fields = {
-                'daily_summary_enabled', 'summary_time', 'pin_summary',
-                'bot_personality', 'language'
-            }
-            
-            update_fields = []
-            update_values = []
-            
-            for field, value in kwargs.items():
-                if field in allowed_fields:
-                    update_fields.append(f"{field} = ?")
-                    update_values.append(value)
-            
-            if not update_fields:
-                return False
-            
-            update_values.append(chat_id)
-            
-            query = f'''
-                INSERT OR REPLACE INTO chat_settings 
-                (chat_id, {', '.join(kwargs.keys())}, updated_at)
-                VALUES (?, {', '.join(['?' for _ in kwargs])}, CURRENT_TIMESTAMP)
-            '''
-            
-            cursor.execute(query, [chat_id] + list(kwargs.values()))
-            
-            conn.commit()
-            conn.close()
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                
+                allowed_fields = {
+                    'daily_summary_enabled', 'summary_time', 'pin_summary',
+                    'bot_personality', 'language'
+                }
+                
+                fields = []
+                values = []
+                
+                for field, value in kwargs.items():
+                    if field in allowed_fields:
+                        fields.append(field)
+                        values.append(value)
+                
+                if not fields:
+                    return False
+                
+                # UPSERT меняет только переданные поля, остальные настройки сохраняются
+                query = f'''
+                    INSERT INTO chat_settings 
+                    (chat_id, {', '.join(fields)}, updated_at)
+                    VALUES (?, {', '.join(['?' for _ in fields])}, CURRENT_TIMESTAMP)
+                    ON CONFLICT(chat_id) DO UPDATE SET
+                        {', '.join(f"{field} = excluded.{field}" for field in fields)},
+                        updated_at = CURRENT_TIMESTAMP
+                '''
+                
+                cursor.execute(query, [chat_id] + values)
+                
             return True
             
         except Exception as e:
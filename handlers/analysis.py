@@ -5,8 +5,9 @@ from datetime import datetime, timedelta
 from telegram import Update
 from telegram.ext import ContextTypes
 from config import config
-from database import DatabaseManager
-from ai_client import AIClient  # Добавляем импорт универсального клиента
+from database import DatabaseManager, MessageRecord, query_monitor
+from telemetry import command_telemetry, mark_failed
+from ai_client import ai_client  # Общий клиент с пулом соединений
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +16,9 @@ class AnalysisHandler:
     
     def __init__(self, db: DatabaseManager):
         self.db = db
-        self.ai_client = AIClient()  # Заменяем OpenAI клиент на универсальный
+        self.ai_client = ai_client
     
+    @command_telemetry('opinion')
     async def handle_opinion(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /opinion - характеристика пользователя по сообщениям"""
         try:
@@ -42,8 +44,14 @@ class AnalysisHandler:
                 await message.reply_text("❌ Укажите имя пользователя для анализа.")
                 return
             
-            # Получаем сообщения пользователя
-            user_messages = self.db.get_user_messages(chat_id, username, message_limit)
+            # Находим пользователя по любому из его имен, затем берем сообщения по индексу
+            user_ids = await self.db.aio.find_user_ids(username, chat_id)
+            user_messages = []
+            if user_ids:
+                user_messages = await self.db.aio.get_messages_by_user_ids(
+                    chat_id, user_ids, message_limit, text_limit=config.OPINION_MESSAGE_MAX_CHARS,
+                    skip_noise=True
+                )
             
             if not user_messages:
                 await message.reply_text(
@@ -61,7 +69,7 @@ class AnalysisHandler:
             )
             
             # Получаем личность бота
-            personality = self._get_bot_personality(chat_id)
+            personality = await self._get_bot_personality(chat_id)
             
             # Анализируем пользователя
             analysis = await self._analyze_user_behavior(username, user_messages, personality)
@@ -77,14 +85,21 @@ class AnalysisHandler:
             logger.error(f"Error in handle_opinion: {e}")
             await self._send_error_message(update, "при анализе пользователя")
     
+    @command_telemetry('comment')
     async def handle_comment(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /comment - анализ и комментарий к текущей теме"""
         try:
             chat_id = update.effective_chat.id
             message = update.effective_message
             
-            # Получаем последние сообщения для анализа текущей темы
-            messages = self.db.get_recent_messages(chat_id, config.COMMENT_MESSAGE_LIMIT)
+            # Получаем последние сообщения для анализа текущей темы; если в чате
+            # их меньше порога, история не читается вовсе (счетчик - одна строка)
+            messages = []
+            if (await self.db.aio.get_chat_counters(chat_id)).total >= config.COMMENT_MIN_MESSAGES:
+                messages = await self.db.aio.get_recent_messages(
+                    chat_id, config.COMMENT_MESSAGE_LIMIT, text_limit=config.COMMENT_MESSAGE_MAX_CHARS,
+                    skip_noise=True
+                )
             
             if not messages:
                 await message.reply_text(
@@ -99,7 +114,7 @@ class AnalysisHandler:
             )
             
             # Получаем личность бота
-            personality = self._get_bot_personality(chat_id)
+            personality = await self._get_bot_personality(chat_id)
             
             # Создаем комментарий к текущей теме
             comment = await self._create_topic_comment(messages, personality)
@@ -115,7 +130,200 @@ class AnalysisHandler:
             logger.error(f"Error in handle_comment: {e}")
             await self._send_error_message(update, "при анализе текущей темы")
     
-    async def _analyze_user_behavior(self, username: str, messages: List[Dict], personality: str = "") -> str:
+    @command_telemetry('stats')
+    async def handle_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /stats - статистика активности чата за период"""
+        try:
+            chat_id = update.effective_chat.id
+            message = update.effective_message
+            
+            days = config.STATS_DEFAULT_DAYS
+            if context.args:
+                if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= config.MAX_STATS_DAYS:
+                    await message.reply_text(
+                        f"❌ Укажите период в днях от 1 до {config.MAX_STATS_DAYS}:\n"
+                        "/stats 7\n"
+                        "/stats 30"
+                    )
+                    return
+                days = int(context.args[0])
+            
+            stats = await self.db.aio.get_chat_statistics(chat_id, days)
+            
+            if not stats or not stats['total_messages']:
+                await message.reply_text(f"📊 За последние {days} дн. сообщений нет.")
+                return
+            
+            # Без Markdown: имена участников могут содержать служебные символы
+            await message.reply_text(self._format_stats_response(stats))
+            
+        except Exception as e:
+            logger.error(f"Error in handle_stats: {e}")
+            await self._send_error_message(update, "при получении статистики")
+    
+    @command_telemetry('dbstats')
+    async def handle_dbstats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /dbstats - размеры базы и медленные запросы (только для админов)"""
+        try:
+            chat = update.effective_chat
+            message = update.effective_message
+            
+            # Проверяем права администратора
+            try:
+                member = await chat.get_member(update.effective_user.id)
+                if member.status not in ['administrator', 'creator']:
+                    await message.reply_text("❌ Эта команда только для администраторов!")
+                    return
+            except Exception as e:
+                logger.error(f"Ошибка проверки прав: {e}")
+                await message.reply_text("❌ Не удалось проверить права!")
+                return
+            
+            storage = await self.db.aio.get_storage_stats()
+            if not storage:
+                await message.reply_text("❌ Не удалось получить статистику базы данных.")
+                return
+            
+            # Без Markdown: в тексте запросов есть служебные символы
+            response = self._format_dbstats_response(storage, query_monitor.summary(), query_monitor.top_slow(5))
+            await message.reply_text(response[:4000])
+            
+        except Exception as e:
+            logger.error(f"Error in handle_dbstats: {e}")
+            await self._send_error_message(update, "при получении статистики базы данных")
+    
+    @command_telemetry('perf')
+    async def handle_perf(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /perf [12h|7d] - перцентили времени команд (только для админов)"""
+        try:
+            chat = update.effective_chat
+            message = update.effective_message
+            
+            # Проверяем права администратора
+            try:
+                member = await chat.get_member(update.effective_user.id)
+                if member.status not in ['administrator', 'creator']:
+                    await message.reply_text("❌ Эта команда только для администраторов!")
+                    return
+            except Exception as e:
+                logger.error(f"Ошибка проверки прав: {e}")
+                await message.reply_text("❌ Не удалось проверить права!")
+                return
+            
+            hours = self._parse_perf_window(context.args[0]) if context.args else config.PERF_DEFAULT_HOURS
+            if hours is None:
+                await message.reply_text(
+                    f"❌ Укажите окно в часах или днях (не больше {config.PERF_MAX_HOURS // 24} дн.):\n"
+                    "/perf 12h\n"
+                    "/perf 7d"
+                )
+                return
+            
+            performance = await self.db.aio.get_command_performance(hours)
+            if not performance:
+                await message.reply_text(f"⏱ За последние {hours} ч. команд не было.")
+                return
+            
+            await message.reply_text(
+                self._format_perf_response(performance, hours, self.ai_client.cache.stats())
+            )
+            
+        except Exception as e:
+            logger.error(f"Error in handle_perf: {e}")
+            await self._send_error_message(update, "при получении статистики производительности")
+    
+    @staticmethod
+    def _parse_perf_window(value: str) -> Optional[int]:
+        """Окно отчета в часах из "12", "12h" или "7d" (None - неверное значение)"""
+        match = re.fullmatch(r'(\d+)([hdчд]?)', value.lower())
+        if not match:
+            return None
+        hours = int(match.group(1)) * (24 if match.group(2) in ('d', 'д') else 1)
+        return hours if 1 <= hours <= config.PERF_MAX_HOURS else None
+    
+    def _format_perf_response(self, performance: List[Dict], hours: int, cache: Dict) -> str:
+        """Форматирование отчета о производительности команд"""
+        lines = [f"⏱ Время команд за {hours} ч. (p50 / p95 / p99)\n"]
+        for item in performance:
+            lines.append(
+                f"/{item['command']}: {item['count']} шт., "
+                f"{item['p50_ms'] / 1000:.1f} / {item['p95_ms'] / 1000:.1f} / {item['p99_ms'] / 1000:.1f} с"
+            )
+            lines.append(
+                f"   БД {item['avg_db_ms']:.0f} мс, AI {item['avg_llm_ms'] / 1000:.1f} с, "
+                f"токены {item['avg_prompt_tokens']:.0f} → {item['avg_completion_tokens']:.0f}"
+                + (f", ошибок {item['errors']}" if item['errors'] else "")
+            )
+        
+        lookups = cache['memory_hits'] + cache['disk_hits'] + cache['misses']
+        if lookups:
+            lines.append(
+                f"\n💾 Кэш AI с запуска: {cache['hit_rate']:.0%} попаданий из {lookups} "
+                f"(память {cache['memory_hits']}, диск {cache['disk_hits']}, промахов {cache['misses']})"
+            )
+        return "\n".join(lines)
+    
+    def _format_dbstats_response(self, storage: List[Dict], queries: List[Dict], slow: List[Dict]) -> str:
+        """Форматирование статистики базы данных"""
+        lines = ["🗄 Статистика базы данных"]
+        
+        for database in storage:
+            lines.append(f"\n📁 {database['path']}: {self._format_size(database['size'])}, "
+                         f"WAL {self._format_size(database['wal_size'])}")
+            for table in database['tables'][:10]:
+                lines.append(f"• {table['name']}: {table['rows']} строк, "
+                             f"данные {self._format_size(table['size'])}, "
+                             f"индексы {self._format_size(table['index_size'])}")
+        
+        if queries:
+            lines.append("\n⏱ Запросы (по суммарному времени):")
+            for query in queries[:8]:
+                lines.append(f"• {query['name']}: {query['count']} шт., "
+                             f"p50 ≤{query['p50_ms']:.0f} мс, p95 ≤{query['p95_ms']:.0f} мс, "
+                             f"макс {query['max_ms']:.0f} мс")
+        
+        if slow:
+            lines.append(f"\n🐢 Медленные запросы (> {config.DB_SLOW_QUERY_MS} мс):")
+            for query in slow:
+                sql = ' '.join(query['sql'].split())
+                lines.append(f"• {query['name']}: {query['max_ms']:.0f} мс ×{query['count']}\n  {sql[:200]}")
+                if query['plan']:
+                    lines.append("  " + query['plan'].replace("\n", "\n  "))
+        
+        return "\n".join(lines)
+    
+    @staticmethod
+    def _format_size(size: Optional[int]) -> str:
+        """Размер в байтах для человека"""
+        if size is None:
+            return "н/д"
+        for unit in ("Б", "КБ", "МБ"):
+            if size < 1024:
+                return f"{size:.0f} {unit}"
+            size /= 1024
+        return f"{size:.1f} ГБ"
+    
+    def _format_stats_response(self, stats: Dict) -> str:
+        """Форматирование статистики чата"""
+        lines = [
+            f"📊 Статистика за {stats['period_days']} дн.\n",
+            f"💬 Сообщений: {stats['total_messages']}",
+            f"👥 Активных участников: {stats['active_users']}",
+        ]
+        
+        if stats['top_users']:
+            lines.append("\n🏆 Самые активные:")
+            for i, user in enumerate(stats['top_users'], 1):
+                lines.append(f"{i}. {user['user']} - {user['count']}")
+        
+        if stats['message_types']:
+            lines.append("\n📎 По типам:")
+            for message_type, count in sorted(stats['message_types'].items(), key=lambda item: -item[1]):
+                lines.append(f"• {message_type}: {count}")
+        
+        return "\n".join(lines)
+    
+    async def _analyze_user_behavior(self, username: str, messages: List[MessageRecord], personality: str = "") -> str:
         """Анализ поведения и характеристик пользователя с помощью Yandex GPT"""
         messages_text = self._format_user_messages_for_analysis(messages)
         
@@ -189,7 +397,7 @@ class AnalysisHandler:
         
         return self._validate_analysis_tone(analysis)
     
-    async def _create_topic_comment(self, messages: List[Dict], personality: str = "") -> str:
+    async def _create_topic_comment(self, messages: List[MessageRecord], personality: str = "") -> str:
         """Создание комментария к текущей теме обсуждения с помощью Yandex GPT"""
         conversation_text = self._format_messages_for_topic_analysis(messages)
         
@@ -278,33 +486,21 @@ class AnalysisHandler:
         
         return username, message_limit
     
-    def _format_user_messages_for_analysis(self, messages: List[Dict]) -> str:
-        """Форматирование сообщений пользователя для анализа"""
+    def _format_user_messages_for_analysis(self, messages: List[MessageRecord]) -> str:
+        """Форматирование сообщений пользователя для анализа (тексты уже обрезаны базой)"""
         formatted = []
         for i, msg in enumerate(messages, 1):
-            text = msg.get('text', '')
-            timestamp = msg.get('timestamp', '')
-            
-            if text and len(text.strip()) > 0:
-                # Обрезаем очень длинные сообщения
-                if len(text) > 150:
-                    text = text[:147] + "..."
-                formatted.append(f"{i}. [{timestamp}] {text}")
+            if msg.text and msg.text.strip():
+                formatted.append(f"{i}. [{msg.timestamp}] {msg.text}")
         
         return "\n".join(formatted[:50])  # Ограничиваем 50 сообщениями для анализа
     
-    def _format_messages_for_topic_analysis(self, messages: List[Dict]) -> str:
-        """Форматирование сообщений для анализа темы"""
+    def _format_messages_for_topic_analysis(self, messages: List[MessageRecord]) -> str:
+        """Форматирование сообщений для анализа темы (тексты уже обрезаны базой)"""
         formatted = []
         for msg in messages:
-            user = msg.get('user', 'Unknown')
-            text = msg.get('text', '')
-            
-            if text and len(text.strip()) > 0:
-                # Обрезаем длинные сообщения
-                if len(text) > 100:
-                    text = text[:97] + "..."
-                formatted.append(f"{user}: {text}")
+            if msg.text and msg.text.strip():
+                formatted.append(f"{msg.user or 'Unknown'}: {msg.text}")
         
         return "\n".join(formatted)
     
@@ -345,10 +541,10 @@ class AnalysisHandler:
 ---
 *Анализ основан на последних сообщениях чата.*"""
     
-    def _get_bot_personality(self, chat_id: int) -> str:
+    async def _get_bot_personality(self, chat_id: int) -> str:
         """Получение личности бота для чата"""
         try:
-            settings = self.db.get_chat_settings(chat_id)
+            settings = await self.db.settings.get(chat_id)
             return settings.get('bot_personality', '')
         except Exception as e:
             logger.error(f"Error getting bot personality: {e}")
@@ -362,6 +558,7 @@ class AnalysisHandler:
     
     async def _send_error_message(self, update: Update, action: str):
         """Отправка сообщения об ошибке"""
+        mark_failed()
         try:
             await update.effective_message.reply_text(
                 f"❌ Произошла ошибка {action}. "
@@ -6,8 +6,9 @@ from typing import List, Dict, Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 from config import config
-from database import DatabaseManager
-from ai_client import AIClient  # Импортируем наш универсальный клиент
+from database import DatabaseManager, MessageRecord
+from telemetry import command_telemetry, mark_failed
+from ai_client import ai_client  # Общий клиент с пулом соединений
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +17,9 @@ class QuestionsHandler:
     
     def __init__(self, db: DatabaseManager):
         self.db = db
-        self.ai_client = AIClient()  # Используем универсальный AI клиент
+        self.ai_client = ai_client
     
+    @command_telemetry('ask')
     async def handle_ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /ask - ответ на вопрос по истории чата"""
         try:
@@ -37,8 +39,13 @@ class QuestionsHandler:
             
             question = " ".join(context.args)
             
-            # Получаем историю сообщений для контекста
-            messages = self.db.get_recent_messages(chat_id, config.MAX_MESSAGES_FOR_ANALYSIS)
+            # Получаем историю сообщений для контекста (пустой чат - по счетчику, без чтения)
+            messages = []
+            if (await self.db.aio.get_chat_counters(chat_id)).total:
+                messages = await self.db.aio.get_recent_messages(
+                    chat_id, config.MAX_MESSAGES_FOR_ANALYSIS, text_limit=config.ASK_MESSAGE_MAX_CHARS,
+                    skip_noise=True, token_budget=config.ASK_TOKEN_BUDGET
+                )
             
             if not messages:
                 await message.reply_text(
@@ -53,7 +60,7 @@ class QuestionsHandler:
             )
             
             # Получаем личность бота
-            personality = self._get_bot_personality(chat_id)
+            personality = await self._get_bot_personality(chat_id)
             
             # Получаем ответ на вопрос
             answer = await self._answer_question_based_on_chat(question, messages, personality)
@@ -69,6 +76,7 @@ class QuestionsHandler:
             logger.error(f"Error in handle_ask: {e}")
             await self._send_error_message(update, "при поиске ответа в истории чата")
     
+    @command_telemetry('gpt')
     async def handle_gpt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /gpt - ответ на любой вопрос с помощью Yandex GPT"""
         try:
@@ -116,7 +124,42 @@ class QuestionsHandler:
             logger.error(f"Error in handle_gpt: {e}")
             await self._send_error_message(update, "при обработке вопроса")
     
-    async def _answer_question_based_on_chat(self, question: str, messages: List[Dict], personality: str = "") -> str:
+    @command_telemetry('search')
+    async def handle_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /search - полнотекстовый поиск по истории чата без AI"""
+        try:
+            chat_id = update.effective_chat.id
+            message = update.effective_message
+            
+            if not context.args:
+                await message.reply_text(
+                    "🔎 Как использовать /search:\n\n"
+                    "Найдите сообщения по словам:\n"
+                    "/search дедлайн проекта\n"
+                    "/search отпуск"
+                )
+                return
+            
+            query = " ".join(context.args)
+            
+            if len(query) > config.MAX_QUESTION_LENGTH:
+                await message.reply_text(f"📏 Запрос слишком длинный. Максимум {config.MAX_QUESTION_LENGTH} символов.")
+                return
+            
+            results = await self.db.aio.search_messages(chat_id, query, config.SEARCH_RESULTS_LIMIT)
+            
+            if not results:
+                await message.reply_text(f"🔍 По запросу «{query}» ничего не найдено.")
+                return
+            
+            # Без Markdown: фрагменты сообщений могут содержать служебные символы
+            await message.reply_text(self._format_search_response(query, results))
+            
+        except Exception as e:
+            logger.error(f"Error in handle_search: {e}")
+            await self._send_error_message(update, "при поиске по истории чата")
+    
+    async def _answer_question_based_on_chat(self, question: str, messages: List[MessageRecord], personality: str = "") -> str:
         """Ответ на вопрос на основе истории чата"""
         conversation_text = self._format_messages_for_qa(messages)
         
@@ -316,19 +359,12 @@ class QuestionsHandler:
         
         return answer
     
-    def _format_messages_for_qa(self, messages: List[Dict]) -> str:
-        """Форматирование сообщений для вопросов-ответов"""
+    def _format_messages_for_qa(self, messages: List[MessageRecord]) -> str:
+        """Форматирование сообщений для вопросов-ответов (тексты уже обрезаны базой)"""
         formatted = []
         for i, msg in enumerate(messages, 1):
-            user = msg.get('user', 'Unknown')
-            text = msg.get('text', '')
-            timestamp = msg.get('timestamp', '')
-            
-            if text and len(text.strip()) > 0:
-                # Обрезаем очень длинные сообщения
-                if len(text) > 200:
-                    text = text[:197] + "..."
-                formatted.append(f"{i}. {user} ({timestamp}): {text}")
+            if msg.text and msg.text.strip():
+                formatted.append(f"{i}. {msg.user or 'Unknown'} ({msg.timestamp}): {msg.text}")
         
         return "\n".join(formatted)
     
@@ -379,10 +415,22 @@ class QuestionsHandler:
 ---
 *Ответ сгенерирован искусственным интеллектом*"""
     
-    def _get_bot_personality(self, chat_id: int) -> str:
+    def _format_search_response(self, query: str, results: List[Dict]) -> str:
+        """Форматирование результатов /search"""
+        lines = [f"🔎 Результаты поиска: {query}\n"]
+        for i, result in enumerate(results, 1):
+            lines.append(f"{i}. {result['user']} ({result['timestamp']}):\n{result['snippet']}")
+        
+        return "\n\n".join(lines)
+    
+    async def _get_bot_personality(self, chat_id: int) -> str:
         """Получение личности бота для чата"""
-        # Временная реализация - позже интегрируем с базой данных
-        return ""
+        try:
+            settings = await self.db.settings.get(chat_id)
+            return settings.get('bot_personality', '')
+        except Exception as e:
+            logger.error(f"Error getting bot personality: {e}")
+            return ""
     
     def _build_system_message(self, base_role: str, personality: str = "") -> str:
         """Построение системного сообщения с учетом личности"""
@@ -392,6 +440,7 @@ class QuestionsHandler:
     
     async def _send_error_message(self, update: Update, action: str):
         """Отправка сообщения об ошибке"""
+        mark_failed()
         try:
             await update.effective_message.reply_text(
                 f"❌ Произошла ошибка {action}. "
@@ -3,8 +3,9 @@ from typing import List, Dict, Optional
 from telegram import Update, Message
 from telegram.ext import ContextTypes
 from config import config
-from database import DatabaseManager
-from ai_client import AIClient  # Добавляем импорт универсального клиента
+from database import DatabaseManager, MessageRecord
+from telemetry import command_telemetry, mark_failed
+from ai_client import ai_client  # Общий клиент с пулом соединений
 
 logger = logging.getLogger(__name__)
 
@@ -13,10 +14,11 @@ class SummaryHandler:
     
     def __init__(self, db: DatabaseManager):
         self.db = db
-        self.ai_client = AIClient()  # Заменяем OpenAI клиент на универсальный
+        self.ai_client = ai_client
     
+    @command_telemetry('summary')
     async def handle_summary(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработка команды /summary [n]"""
+        """Обработка команды /summary [n] (ответом на сообщение - суммаризация его ветки)"""
         try:
             chat_id = update.effective_chat.id
             message = update.effective_message
@@ -32,20 +34,34 @@ class SummaryHandler:
                 )
                 n_messages = config.MAX_MESSAGES_FOR_ANALYSIS
             
-            # Получаем сообщения из базы данных
-            messages = self.db.get_recent_messages(chat_id, n_messages)
+            # Ответ на сообщение - суммаризация только его ветки, а не всего чата
+            thread = message.reply_to_message
+            if thread:
+                messages = await self.db.aio.get_thread_messages(
+                    chat_id, thread.message_id, n_messages, text_limit=config.SUMMARY_MESSAGE_MAX_CHARS
+                )
+                scope = f"ветки из {len(messages)} сообщений"
+            else:
+                messages = []
+                if (await self.db.aio.get_chat_counters(chat_id)).total:
+                    messages = await self.db.aio.get_recent_messages(
+                        chat_id, n_messages, text_limit=config.SUMMARY_MESSAGE_MAX_CHARS,
+                        skip_noise=True, token_budget=config.SUMMARY_TOKEN_BUDGET
+                    )
+                scope = f"последних {len(messages)} сообщений"
             
             if not messages:
-                await message.reply_text("📭 Нет сообщений для суммаризации.")
+                await message.reply_text(
+                    "📭 В этой ветке нет сохраненных сообщений." if thread
+                    else "📭 Нет сообщений для суммаризации."
+                )
                 return
             
             # Отправляем сообщение о начале обработки
-            processing_msg = await message.reply_text(
-                f"🔄 Анализирую последние {len(messages)} сообщений..."
-            )
+            processing_msg = await message.reply_text(f"🔄 Анализирую {scope}...")
             
             # Получаем личность бота для контекста
-            personality = self._get_bot_personality(chat_id)
+            personality = await self._get_bot_personality(chat_id)
             
             # Создаем суммаризацию
             summary = await self._create_summary(messages, personality)
@@ -54,10 +70,10 @@ class SummaryHandler:
             await processing_msg.delete()
             
             # Отправляем результат
-            response_text = f"📋 **Суммаризация последних {len(messages)} сообщений:**\n\n{summary}"
+            response_text = f"📋 **Суммаризация {scope}:**\n\n{summary}"
             
             # Если включен закреп, закрепляем сообщение
-            if self._should_pin_summary(chat_id):
+            if await self._should_pin_summary(chat_id):
                 sent_message = await message.reply_text(response_text)
                 try:
                     await sent_message.pin(disable_notification=True)
@@ -70,6 +86,7 @@ class SummaryHandler:
             logger.error(f"Error in handle_summary: {e}")
             await self._send_error_message(update, "при создании суммаризации")
     
+    @command_telemetry('themes')
     async def handle_themes(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /themes [n]"""
         try:
@@ -85,8 +102,13 @@ class SummaryHandler:
                 )
                 n_messages = config.MAX_MESSAGES_FOR_ANALYSIS
             
-            # Получаем сообщения
-            messages = self.db.get_recent_messages(chat_id, n_messages)
+            # Получаем сообщения (пустой чат - по счетчику, без чтения)
+            messages = []
+            if (await self.db.aio.get_chat_counters(chat_id)).total:
+                messages = await self.db.aio.get_recent_messages(
+                    chat_id, n_messages, text_limit=config.SUMMARY_MESSAGE_MAX_CHARS,
+                    skip_noise=True, token_budget=config.SUMMARY_TOKEN_BUDGET
+                )
             
             if not messages:
                 await message.reply_text("📭 Нет сообщений для анализа тем.")
@@ -98,7 +120,7 @@ class SummaryHandler:
             )
             
             # Получаем личность бота
-            personality = self._get_bot_personality(chat_id)
+            personality = await self._get_bot_personality(chat_id)
             
             # Анализируем темы
             themes = await self._analyze_themes(messages, personality)
@@ -114,6 +136,7 @@ class SummaryHandler:
             logger.error(f"Error in handle_themes: {e}")
             await self._send_error_message(update, "при анализе тем")
     
+    @command_telemetry('brief')
     async def handle_brief(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /brief - краткое изложение длинного сообщения"""
         try:
@@ -131,6 +154,10 @@ class SummaryHandler:
             target_message = message.reply_to_message
             text_to_summarize = self._extract_text_from_message(target_message)
             
+            # У медиа без подписи берем текст сохраненной копии (распознанный /text)
+            if not text_to_summarize:
+                text_to_summarize = await self._get_stored_text(update.effective_chat.id, target_message)
+            
             if not text_to_summarize:
                 await message.reply_text("❌ Не удалось извлечь текст из сообщения.")
                 return
@@ -165,7 +192,7 @@ class SummaryHandler:
             logger.error(f"Error in handle_brief: {e}")
             await self._send_error_message(update, "при создании краткого изложения")
     
-    async def _create_summary(self, messages: List[Dict], personality: str = "") -> str:
+    async def _create_summary(self, messages: List[MessageRecord], personality: str = "") -> str:
         """Создание суммаризации сообщений с помощью Yandex GPT"""
         conversation_text = self._format_messages_for_ai(messages)
         
@@ -215,7 +242,7 @@ class SummaryHandler:
         
         return summary
     
-    async def _analyze_themes(self, messages: List[Dict], personality: str = "") -> str:
+    async def _analyze_themes(self, messages: List[MessageRecord], personality: str = "") -> str:
         """Анализ основных тем в сообщениях с помощью Yandex GPT"""
         conversation_text = self._format_messages_for_ai(messages)
         
@@ -317,17 +344,12 @@ class SummaryHandler:
         except (ValueError, TypeError):
             return default
     
-    def _format_messages_for_ai(self, messages: List[Dict]) -> str:
-        """Форматирование сообщений для передачи в AI"""
+    def _format_messages_for_ai(self, messages: List[MessageRecord]) -> str:
+        """Форматирование сообщений для передачи в AI (тексты уже обрезаны базой)"""
         formatted = []
         for msg in messages:
-            user = msg.get('user', 'Unknown')
-            text = msg.get('text', '')
-            if text and len(text.strip()) > 0:  # Игнорируем пустые сообщения
-                # Обрезаем слишком длинные сообщения
-                if len(text) > 300:
-                    text = text[:297] + "..."
-                formatted.append(f"{user}: {text}")
+            if msg.text and msg.text.strip():  # Игнорируем пустые сообщения
+                formatted.append(f"{msg.user or 'Unknown'}: {msg.text}")
         
         return "\n".join(formatted)
     
@@ -340,11 +362,19 @@ class SummaryHandler:
         else:
             return ""
     
-    def _get_bot_personality(self, chat_id: int) -> str:
+    async def _get_stored_text(self, chat_id: int, target_message: Message) -> str:
+        """Текст сохраненной копии сообщения (точечное чтение по message_id)"""
+        stored = await self.db.aio.get_message(chat_id, target_message.message_id)
+        if not stored:
+            return ""
+        extracted = await self.db.aio.get_extracted_text(chat_id, stored.id)
+        return extracted or stored.text or ""
+    
+    async def _get_bot_personality(self, chat_id: int) -> str:
         """Получение личности бота для чата"""
         # Временная реализация - позже интегрируем с базой данных
         try:
-            settings = self.db.get_chat_settings(chat_id)
+            settings = await self.db.settings.get(chat_id)
             return settings.get('bot_personality', '')
         except:
             return ""
@@ -355,16 +385,17 @@ class SummaryHandler:
             return f"{base_role}\n\nТвоя личность: {personality}"
         return base_role
     
-    def _should_pin_summary(self, chat_id: int) -> bool:
+    async def _should_pin_summary(self, chat_id: int) -> bool:
         """Проверка, нужно ли закреплять суммаризацию"""
         try:
-            settings = self.db.get_chat_settings(chat_id)
+            settings = await self.db.settings.get(chat_id)
             return settings.get('pin_summary', config.DEFAULT_PIN_SUMMARY)
         except:
             return config.DEFAULT_PIN_SUMMARY
     
     async def _send_error_message(self, update: Update, action: str):
         """Отправка сообщения об ошибке"""
+        mark_failed()
         try:
             await update.effective_message.reply_text(
                 f"❌ Произошла ошибка {action}. "
@@ -4,7 +4,6 @@ import tempfile
 import asyncio
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime, time
-import sqlite3
 
 from telegram import Update, Message
 from telegram.ext import ContextTypes, filters
@@ -15,6 +14,7 @@ from pydub import AudioSegment
 
 from config import config
 from database import DatabaseManager
+from telemetry import command_telemetry, mark_failed
 
 
 logger = logging.getLogger(__name__)
@@ -26,6 +26,7 @@ class UtilsHandler:
         self.db = db
         self.openai_client = openai.AsyncOpenAI(api_key=config.OPENAI_API_KEY)
     
+    @command_telemetry('text')
     async def handle_text_extraction(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /text - извлечение текста из голосовых и изображений"""
         try:
@@ -52,7 +53,7 @@ class UtilsHandler:
             
             if extracted_text:
                 # Сохраняем извлеченный текст в базу
-                self._save_extracted_text(update, target_message, extracted_text)
+                await self._save_extracted_text(update, target_message, extracted_text)
                 
                 response_text = self._format_extracted_text_response(extracted_text, target_message)
                 await message.reply_text(response_text, parse_mode='Markdown')
@@ -69,6 +70,7 @@ class UtilsHandler:
             logger.error(f"Error in handle_text_extraction: {e}")
             await self._send_error_message(update, "при извлечении текста")
     
+    @command_telemetry('settings_summary_time')
     async def handle_settings_summary_time(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /settings_summary_time - настройка времени ежедневной суммаризации"""
         try:
@@ -76,7 +78,7 @@ class UtilsHandler:
             message = update.effective_message
             
             if not context.args:
-                current_time = self._get_summary_time(chat_id)
+                current_time = await self._get_summary_time(chat_id)
                 await message.reply_text(
                     f"⏰ **Текущее время ежедневной суммаризации:** {current_time}\n\n"
                     "Чтобы изменить время, используйте:\n"
@@ -99,7 +101,7 @@ class UtilsHandler:
                 return
             
             # Сохраняем настройку
-            if self._set_summary_time(chat_id, time_str):
+            if await self._set_summary_time(chat_id, time_str):
                 await message.reply_text(
                     f"✅ Время ежедневной суммаризации установлено на **{time_str}**\n\n"
                     f"Бот будет отправлять суммаризацию каждый день в {time_str}"
@@ -111,13 +113,14 @@ class UtilsHandler:
             logger.error(f"Error in handle_settings_summary_time: {e}")
             await self._send_error_message(update, "при настройке времени")
     
+    @command_telemetry('settings_daily_summary')
     async def handle_settings_daily_summary(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /settings_daily_summary - вкл/выкл ежедневной суммаризации"""
         try:
             chat_id = update.effective_chat.id
             message = update.effective_message
             
-            current_setting = self._get_daily_summary_setting(chat_id)
+            current_setting = await self._get_daily_summary_setting(chat_id)
             
             if not context.args:
                 status = "включена" if current_setting else "выключена"
@@ -146,11 +149,11 @@ class UtilsHandler:
                 )
                 return
             
-            if self._set_daily_summary_setting(chat_id, new_setting):
+            if await self._set_daily_summary_setting(chat_id, new_setting):
                 await message.reply_text(
                     f"✅ Ежедневная суммаризация **{status_text}**\n\n"
                     f"Суммаризация будет {'отправляться' if new_setting else 'отключена'} "
-                    f"в {self._get_summary_time(chat_id)} каждый день."
+                    f"в {await self._get_summary_time(chat_id)} каждый день."
                 )
             else:
                 await message.reply_text("❌ Не удалось сохранить настройки.")
@@ -159,13 +162,14 @@ class UtilsHandler:
             logger.error(f"Error in handle_settings_daily_summary: {e}")
             await self._send_error_message(update, "при настройке ежедневной суммаризации")
     
+    @command_telemetry('settings_pin')
     async def handle_settings_pin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /settings_pin - вкл/выкл закрепления суммаризации"""
         try:
             chat_id = update.effective_chat.id
             message = update.effective_message
             
-            current_setting = self._get_pin_setting(chat_id)
+            current_setting = await self._get_pin_setting(chat_id)
             
             if not context.args:
                 status = "включено" if current_setting else "выключено"
@@ -194,7 +198,7 @@ class UtilsHandler:
                 )
                 return
             
-            if self._set_pin_setting(chat_id, new_setting):
+            if await self._set_pin_setting(chat_id, new_setting):
                 await message.reply_text(
                     f"✅ Закрепление суммаризации **{status_text}**\n\n"
                     f"Суммаризации будут {'закрепляться' if new_setting else 'отправляться без закрепления'}."
@@ -206,6 +210,7 @@ class UtilsHandler:
             logger.error(f"Error in handle_settings_pin: {e}")
             await self._send_error_message(update, "при настройке закрепления")
     
+    @command_telemetry('set_personality')
     async def handle_set_personality(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /set_personality - установка личности бота"""
         try:
@@ -213,7 +218,7 @@ class UtilsHandler:
             message = update.effective_message
             
             if not context.args:
-                current_personality = self._get_bot_personality(chat_id)
+                current_personality = await self._get_bot_personality(chat_id)
                 if current_personality:
                     await message.reply_text(
                         f"🎭 **Текущая личность бота:**\n{current_personality}\n\n"
@@ -247,7 +252,7 @@ class UtilsHandler:
                 )
                 return
             
-            if self._set_bot_personality(chat_id, personality):
+            if await self._set_bot_personality(chat_id, personality):
                 await message.reply_text(
                     f"✅ **Личность бота установлена:**\n\n{personality}\n\n"
                     "Теперь бот будет использовать эту личность при:\n"
@@ -264,12 +269,13 @@ class UtilsHandler:
             logger.error(f"Error in handle_set_personality: {e}")
             await self._send_error_message(update, "при установке личности")
     
+    @command_telemetry('clear_personality')
     async def handle_clear_personality(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /clear_personality - очистка личности бота"""
         try:
             chat_id = update.effective_chat.id
             
-            if self._clear_bot_personality(chat_id):
+            if await self._clear_bot_personality(chat_id):
                 await update.effective_message.reply_text(
                     "✅ **Личность бота очищена**\n\n"
                     "Бот вернулся к стандартному стилю общения."
@@ -294,12 +300,16 @@ class UtilsHandler:
             user = message.from_user
             chat_id = message.chat_id
             
-            success = self.db.save_message(
+            success = await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=message.text,
-                message_type='text'
+                message_type='text',
+                reply_to_message_id=message.reply_to_message.message_id if message.reply_to_message else None,
+                message_id=message.message_id
             )
             
             if not success:
@@ -340,13 +350,17 @@ class UtilsHandler:
                 if message.caption:
                     media_text = message.caption
             
-            success = self.db.save_message(
+            success = await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=media_text,
                 message_type=media_type,
-                media_file_id=file_id
+                media_file_id=file_id,
+                reply_to_message_id=message.reply_to_message.message_id if message.reply_to_message else None,
+                message_id=message.message_id
             )
             
             if not success:
@@ -470,16 +484,18 @@ class UtilsHandler:
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
     
-    def _save_extracted_text(self, update: Update, original_message: Message, extracted_text: str):
+    async def _save_extracted_text(self, update: Update, original_message: Message, extracted_text: str):
         """Сохранение извлеченного текста в базу"""
         try:
             user = update.effective_user
             chat_id = update.effective_chat.id
             
-            self.db.save_message(
+            await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=f"[Извлеченный текст] {extracted_text}",
                 message_type='extracted_text'
             )
@@ -505,190 +521,103 @@ class UtilsHandler:
         except ValueError:
             return False
     
-    # Методы работы с настройками в базе данных
+    # Методы работы с настройками чата (через кэширующий сервис db.settings)
     
-    def _get_summary_time(self, chat_id: int) -> str:
+    async def _get_summary_time(self, chat_id: int) -> str:
         """Получение времени суммаризации для чата"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'SELECT summary_time FROM chat_settings WHERE chat_id = ?',
-                (chat_id,)
-            )
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            return result[0] if result else config.DEFAULT_SUMMARY_TIME
+            settings = await self.db.settings.get(chat_id)
+            value = settings.get('summary_time')
+            return value or config.DEFAULT_SUMMARY_TIME
             
         except Exception as e:
             logger.error(f"Error getting summary time: {e}")
             return config.DEFAULT_SUMMARY_TIME
     
-    def _set_summary_time(self, chat_id: int, time_str: str) -> bool:
+    async def _set_summary_time(self, chat_id: int, time_str: str) -> bool:
         """Установка времени суммаризации для чата"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_settings 
-                (chat_id, summary_time, updated_at) 
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (chat_id, time_str))
-            
-            conn.commit()
-            conn.close()
-            return True
+            return await self.db.settings.update(chat_id, summary_time=time_str)
             
         except Exception as e:
             logger.error(f"Error setting summary time: {e}")
             return False
     
-    def _get_daily_summary_setting(self, chat_id: int) -> bool:
+    async def _get_daily_summary_setting(self, chat_id: int) -> bool:
         """Получение настройки ежедневной суммаризации"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'SELECT daily_summary_enabled FROM chat_settings WHERE chat_id = ?',
-                (chat_id,)
-            )
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            return bool(result[0]) if result else config.DEFAULT_SUMMARY_ENABLED
+            settings = await self.db.settings.get(chat_id)
+            value = settings.get('daily_summary_enabled')
+            return bool(value) if value is not None else config.DEFAULT_SUMMARY_ENABLED
             
         except Exception as e:
             logger.error(f"Error getting daily summary setting: {e}")
             return config.DEFAULT_SUMMARY_ENABLED
     
-    def _set_daily_summary_setting(self, chat_id: int, enabled: bool) -> bool:
+    async def _set_daily_summary_setting(self, chat_id: int, enabled: bool) -> bool:
         """Установка настройки ежедневной суммаризации"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_settings 
-                (chat_id, daily_summary_enabled, updated_at) 
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (chat_id, enabled))
-            
-            conn.commit()
-            conn.close()
-            return True
+            return await self.db.settings.update(chat_id, daily_summary_enabled=enabled)
             
         except Exception as e:
             logger.error(f"Error setting daily summary: {e}")
             return False
     
-    def _get_pin_setting(self, chat_id: int) -> bool:
+    async def _get_pin_setting(self, chat_id: int) -> bool:
         """Получение настройки закрепления"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'SELECT pin_summary FROM chat_settings WHERE chat_id = ?',
-                (chat_id,)
-            )
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            return bool(result[0]) if result else config.DEFAULT_PIN_SUMMARY
+            settings = await self.db.settings.get(chat_id)
+            value = settings.get('pin_summary')
+            return bool(value) if value is not None else config.DEFAULT_PIN_SUMMARY
             
         except Exception as e:
             logger.error(f"Error getting pin setting: {e}")
             return config.DEFAULT_PIN_SUMMARY
     
-    def _set_pin_setting(self, chat_id: int, enabled: bool) -> bool:
+    async def _set_pin_setting(self, chat_id: int, enabled: bool) -> bool:
         """Установка настройки закрепления"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_settings 
-                (chat_id, pin_summary, updated_at) 
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (chat_id, enabled))
-            
-            conn.commit()
-            conn.close()
-            return True
+            return await self.db.settings.update(chat_id, pin_summary=enabled)
             
         except Exception as e:
             logger.error(f"Error setting pin: {e}")
             return False
     
-    def _get_bot_personality(self, chat_id: int) -> Optional[str]:
+    async def _get_bot_personality(self, chat_id: int) -> Optional[str]:
         """Получение личности бота"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'SELECT bot_personality FROM chat_settings WHERE chat_id = ?',
-                (chat_id,)
-            )
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            return result[0] if result else None
+            settings = await self.db.settings.get(chat_id)
+            return settings.get('bot_personality')
             
         except Exception as e:
             logger.error(f"Error getting bot personality: {e}")
             return None
     
-    def _set_bot_personality(self, chat_id: int, personality: str) -> bool:
+    async def _set_bot_personality(self, chat_id: int, personality: str) -> bool:
         """Установка личности бота"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_settings 
-                (chat_id, bot_personality, updated_at) 
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (chat_id, personality))
-            
-            conn.commit()
-            conn.close()
-            return True
+            return await self.db.settings.update(chat_id, bot_personality=personality)
             
         except Exception as e:
             logger.error(f"Error setting bot personality: {e}")
             return False
     
-    def _clear_bot_personality(self, chat_id: int) -> bool:
+    async def _clear_bot_personality(self, chat_id: int) -> bool:
         """Очистка личности бота"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
+            settings = await self.db.settings.get(chat_id)
+            if not settings.get('bot_personality'):
+                return False
             
-            cursor.execute('''
-                UPDATE chat_settings 
-                SET bot_personality = NULL, updated_at = CURRENT_TIMESTAMP
-                WHERE chat_id = ?
-            ''', (chat_id,))
-            
-            conn.commit()
-            conn.close()
-            return cursor.rowcount > 0
+            return await self.db.settings.update(chat_id, bot_personality=None)
             
         except Exception as e:
             logger.error(f"Error clearing bot personality: {e}")
             return False
-    
+
     async def _send_error_message(self, update: Update, action: str):
         """Отправка сообщения об ошибке"""
+        mark_failed()
         try:
             await update.effective_message.reply_text(
                 f"❌ Произошла ошибка {action}. "
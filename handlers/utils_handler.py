@@ -2,16 +2,19 @@ import logging
 import os
 import tempfile
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
-from datetime import datetime, time
-import sqlite3
+from datetime import datetime, time, timedelta
 
 from telegram import Update, Message
 from telegram.ext import ContextTypes, filters
 
 # ИСПРАВЛЕННЫЕ ИМПОРТЫ
 from ai_client import ai_client
-from database import DatabaseManager
+from database import DatabaseManager, MessageRecord
+from history_import import import_telegram_export
+from telemetry import command_telemetry, mark_failed
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -24,6 +27,7 @@ class UtilsHandler:
         self.db = db
         # Убираем OpenAI клиент, используем наш универсальный AI клиент
     
+    @command_telemetry('text')
     async def handle_text_extraction(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /text - извлечение текста из голосовых и изображений"""
         try:
@@ -60,14 +64,22 @@ class UtilsHandler:
             
             processing_msg = await message.reply_text("🔍 Извлекаю текст...")
             
-            extracted_text = await self._extract_text_from_media(target_message, context)
+            # Сохраненная копия сообщения - точечное чтение по (chat_id, message_id);
+            # если текст из нее уже извлекали, повторно API не вызываем
+            stored = await self.db.aio.get_message(update.effective_chat.id, target_message.message_id)
+            extracted_text = None
+            if stored:
+                extracted_text = await self.db.aio.get_extracted_text(update.effective_chat.id, stored.id)
+            
+            if not extracted_text:
+                extracted_text = await self._extract_text_from_media(target_message, context)
+                if extracted_text:
+                    # Сохраняем извлеченный текст в базу
+                    await self._save_extracted_text(update, target_message, extracted_text, stored)
             
             await processing_msg.delete()
             
             if extracted_text:
-                # Сохраняем извлеченный текст в базу
-                self._save_extracted_text(update, target_message, extracted_text)
-                
                 response_text = self._format_extracted_text_response(extracted_text, target_message)
                 await message.reply_text(response_text, parse_mode='Markdown')
             else:
@@ -116,7 +128,7 @@ class UtilsHandler:
                 
                 if recognized_text:
                     # Сохраняем распознанный текст
-                    self._save_recognized_voice_text(message, recognized_text)
+                    await self._save_recognized_voice_text(message, recognized_text)
                     
                     # Отправляем распознанный текст
                     response = config.VOICE_RECOGNITION_TEMPLATE.format(text=recognized_text)
@@ -170,7 +182,7 @@ class UtilsHandler:
                 
                 if analysis_result:
                     # Сохраняем результат анализа
-                    self._save_image_analysis(message, analysis_result)
+                    await self._save_image_analysis(message, analysis_result)
                     
                     # Отправляем результат анализа
                     response = config.IMAGE_ANALYSIS_TEMPLATE.format(analysis=analysis_result)
@@ -187,6 +199,7 @@ class UtilsHandler:
             logger.error(f"Error in handle_photo_message: {e}")
             # Не отправляем сообщение об ошибке, чтобы не спамить
 
+    @command_telemetry('capabilities')
     async def handle_capabilities(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать возможности бота"""
         try:
@@ -205,7 +218,154 @@ class UtilsHandler:
             logger.error(f"Error in handle_capabilities: {e}")
             await self._send_error_message(update, "при получении информации о возможностях")
 
+    @command_telemetry('export')
+    async def handle_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /export [дни|all] [jsonl|csv] - выгрузка истории чата файлом"""
+        try:
+            chat_id = update.effective_chat.id
+            message = update.effective_message
+            
+            days, export_format = self._parse_export_arguments(context.args or [])
+            if export_format is None:
+                await message.reply_text(
+                    "📦 **Как использовать /export:**\n\n"
+                    "`/export` - история за последние "
+                    f"{config.EXPORT_DEFAULT_DAYS} дн. в JSONL\n"
+                    "`/export 7 csv` - за неделю в CSV\n"
+                    "`/export all` - вся история чата"
+                )
+                return
+            
+            end_time = datetime.now()
+            start_time = datetime.fromtimestamp(0) if days is None else end_time - timedelta(days=days)
+            
+            # История пишется во временный файл пачками - память не зависит от размера чата
+            fd, export_path = tempfile.mkstemp(suffix=f".{export_format}")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8', newline='') as output:
+                    count = await self.db.aio.export_messages(chat_id, start_time, end_time, output, export_format)
+                
+                if count is None:
+                    await self._send_error_message(update, "при выгрузке истории")
+                    return
+                
+                if not count:
+                    await message.reply_text("📭 За выбранный период сообщений нет.")
+                    return
+                
+                if os.path.getsize(export_path) > config.MAX_EXPORT_FILE_SIZE:
+                    await message.reply_text(
+                        "❌ Файл выгрузки слишком большой для отправки. "
+                        "Укажите период короче, например `/export 30`."
+                    )
+                    return
+                
+                period = "всю историю" if days is None else f"{days} дн."
+                with open(export_path, 'rb') as document:
+                    await message.reply_document(
+                        document=document,
+                        filename=f"chat_{chat_id}_{end_time:%Y%m%d}.{export_format}",
+                        caption=f"📦 Выгрузка за {period}: {count} сообщений"
+                    )
+            finally:
+                os.unlink(export_path)
+                
+        except Exception as e:
+            logger.error(f"Error in handle_export: {e}")
+            await self._send_error_message(update, "при выгрузке истории")
+    
+    @command_telemetry('import')
+    async def handle_import(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /import - загрузка истории из result.json Telegram Desktop (только для админов)"""
+        try:
+            chat = update.effective_chat
+            message = update.effective_message
+            
+            # Проверяем права администратора
+            try:
+                member = await chat.get_member(update.effective_user.id)
+                if member.status not in ['administrator', 'creator']:
+                    await message.reply_text("❌ Эта команда только для администраторов!")
+                    return
+            except Exception as e:
+                logger.error(f"Ошибка проверки прав: {e}")
+                await message.reply_text("❌ Не удалось проверить права!")
+                return
+            
+            # Файл - во вложении к команде или в сообщении, на которое ответили
+            document = message.document
+            if not document and message.reply_to_message:
+                document = message.reply_to_message.document
+            
+            if not document:
+                await message.reply_text(
+                    "📥 **Как использовать /import:**\n\n"
+                    "1. Экспортируйте историю в Telegram Desktop в формате JSON\n"
+                    "2. Отправьте `result.json` в чат с подписью /import\n"
+                    "   или ответьте на сообщение с файлом командой /import\n\n"
+                    "💡 *Сообщения, которые бот уже сохранил, повторно не загружаются*"
+                )
+                return
+            
+            if document.file_size and document.file_size > config.IMPORT_MAX_FILE_SIZE:
+                await message.reply_text(
+                    f"❌ Файл больше {config.IMPORT_MAX_FILE_SIZE // (1024 * 1024)}MB - бот не может его скачать.\n"
+                    "Загрузите его на сервере: `python history_import.py result.json`"
+                )
+                return
+            
+            status = await message.reply_text("📥 Загружаю историю чата...")
+            
+            fd, import_path = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            try:
+                telegram_file = await context.bot.get_file(document.file_id)
+                await telegram_file.download_to_drive(import_path)
+                
+                # Загрузка может идти минутами - в своем потоке, а не в пуле db.aio,
+                # чтобы не занимать его потоки запросами остальных команд
+                with ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-import") as executor:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        executor, functools.partial(
+                            import_telegram_export, self.db, import_path, chat.id, same_chat_only=True
+                        )
+                    )
+            except ValueError as e:
+                await status.edit_text(f"❌ {e}")
+                return
+            finally:
+                os.unlink(import_path)
+            
+            if result['imported'] is None:
+                await status.edit_text("❌ Импорт прерван из-за ошибки базы данных.")
+                return
+            
+            await status.edit_text(
+                f"✅ Загружено сообщений: {result['imported']} "
+                f"за {result['seconds']:.1f} с ({result['rows_per_second']:.0f} строк/с)"
+            )
+                
+        except Exception as e:
+            logger.error(f"Error in handle_import: {e}")
+            await self._send_error_message(update, "при импорте истории")
+    
+    def _parse_export_arguments(self, args: List[str]) -> Tuple[Optional[int], Optional[str]]:
+        """Разбор аргументов /export: (дни или None для всей истории, формат или None при ошибке)"""
+        days, export_format = config.EXPORT_DEFAULT_DAYS, 'jsonl'
+        for arg in args:
+            arg = arg.lower()
+            if arg in ('jsonl', 'csv'):
+                export_format = arg
+            elif arg == 'all':
+                days = None
+            elif arg.isdigit() and int(arg) > 0:
+                days = int(arg)
+            else:
+                return None, None
+        return days, export_format
+
     # Существующие методы настроек (оставляем без изменений)
+    @command_telemetry('settings_summary_time')
     async def handle_settings_summary_time(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /settings_summary_time - настройка времени ежедневной суммаризации"""
         try:
@@ -213,7 +373,7 @@ class UtilsHandler:
             message = update.effective_message
             
             if not context.args:
-                current_time = self._get_summary_time(chat_id)
+                current_time = await self._get_summary_time(chat_id)
                 await message.reply_text(
                     f"⏰ **Текущее время ежедневной суммаризации:** {current_time}\n\n"
                     "Чтобы изменить время, используйте:\n"
@@ -236,7 +396,7 @@ class UtilsHandler:
                 return
             
             # Сохраняем настройку
-            if self._set_summary_time(chat_id, time_str):
+            if await self._set_summary_time(chat_id, time_str):
                 await message.reply_text(
                     f"✅ Время ежедневной суммаризации установлено на **{time_str}**\n\n"
                     f"Бот будет отправлять суммаризацию каждый день в {time_str}"
@@ -346,32 +506,56 @@ class UtilsHandler:
         else:
             return "Прикреплен документ (текст недоступен для автоматического извлечения)"
 
-    def _save_recognized_voice_text(self, message: Message, recognized_text: str):
+    async def _save_extracted_text(self, update: Update, original_message: Message,
+                                   extracted_text: str, stored: Optional[MessageRecord]):
+        """Сохранение извлеченного текста с привязкой к сохраненной копии сообщения"""
+        try:
+            if original_message.voice:
+                extraction_type = 'voice'
+            elif original_message.photo:
+                extraction_type = 'image'
+            else:
+                extraction_type = 'document'
+            
+            await self.db.aio.save_extracted_text(
+                stored.id if stored else None,
+                update.effective_chat.id,
+                extracted_text,
+                extraction_type
+            )
+        except Exception as e:
+            logger.error(f"Error saving extracted text: {e}")
+
+    async def _save_recognized_voice_text(self, message: Message, recognized_text: str):
         """Сохранение распознанного текста из голосового сообщения"""
         try:
             user = message.from_user
             chat_id = message.chat_id
             
-            self.db.save_message(
+            await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=f"[Распознанный голос] {recognized_text}",
                 message_type='voice_text'
             )
         except Exception as e:
             logger.error(f"Error saving recognized voice text: {e}")
 
-    def _save_image_analysis(self, message: Message, analysis_result: str):
+    async def _save_image_analysis(self, message: Message, analysis_result: str):
         """Сохранение результата анализа изображения"""
         try:
             user = message.from_user
             chat_id = message.chat_id
             
-            self.db.save_message(
+            await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=f"[Анализ изображения] {analysis_result}",
                 message_type='image_analysis'
             )
@@ -403,43 +587,23 @@ class UtilsHandler:
         except ValueError:
             return False
 
-    # Методы работы с настройками в базе данных (оставляем без изменений)
+    # Методы работы с настройками чата (через кэширующий сервис db.settings)
     
-    def _get_summary_time(self, chat_id: int) -> str:
+    async def _get_summary_time(self, chat_id: int) -> str:
         """Получение времени суммаризации для чата"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'SELECT summary_time FROM chat_settings WHERE chat_id = ?',
-                (chat_id,)
-            )
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            return result[0] if result else config.DEFAULT_SUMMARY_TIME
+            settings = await self.db.settings.get(chat_id)
+            value = settings.get('summary_time')
+            return value or config.DEFAULT_SUMMARY_TIME
             
         except Exception as e:
             logger.error(f"Error getting summary time: {e}")
             return config.DEFAULT_SUMMARY_TIME
 
-    def _set_summary_time(self, chat_id: int, time_str: str) -> bool:
+    async def _set_summary_time(self, chat_id: int, time_str: str) -> bool:
         """Установка времени суммаризации для чата"""
         try:
-            conn = sqlite3.connect('chat_data.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO chat_settings 
-                (chat_id, summary_time, updated_at) 
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (chat_id, time_str))
-            
-            conn.commit()
-            conn.close()
-            return True
+            return await self.db.settings.update(chat_id, summary_time=time_str)
             
         except Exception as e:
             logger.error(f"Error setting summary time: {e}")
@@ -449,6 +613,7 @@ class UtilsHandler:
 
     async def _send_error_message(self, update: Update, action: str):
         """Отправка сообщения об ошибке"""
+        mark_failed()
         try:
             await update.effective_message.reply_text(
                 f"❌ Произошла ошибка {action}. "
@@ -468,12 +633,16 @@ class UtilsHandler:
             user = message.from_user
             chat_id = message.chat_id
             
-            success = self.db.save_message(
+            success = await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=message.text,
-                message_type='text'
+                message_type='text',
+                reply_to_message_id=message.reply_to_message.message_id if message.reply_to_message else None,
+                message_id=message.message_id
             )
             
             if not success:
@@ -482,6 +651,35 @@ class UtilsHandler:
         except Exception as e:
             logger.error(f"Error saving text message: {e}")
 
+    async def save_edited_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обновление сохраненной копии отредактированного сообщения (edited_message)"""
+        try:
+            message = update.edited_message
+            if not message or not message.from_user:
+                return
+            
+            user = message.from_user
+            
+            # Тот же message_id: текст обновляется на месте, время остается исходным;
+            # правка несохраненного сообщения пропускается
+            success = await self.db.aio.save_message(
+                chat_id=message.chat_id,
+                user_id=user.id,
+                user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
+                message_text=message.text or message.caption or '',
+                message_type='text',
+                message_id=message.message_id,
+                edit=True
+            )
+            
+            if not success:
+                logger.warning(f"Failed to save edited message {message.message_id} in chat {message.chat_id}")
+                
+        except Exception as e:
+            logger.error(f"Error saving edited message: {e}")
+
     async def save_media_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Сохранение медиа-сообщений в базу данных"""
         try:
@@ -513,13 +711,17 @@ class UtilsHandler:
                 if message.caption:
                     media_text = message.caption
             
-            success = self.db.save_message(
+            success = await self.db.aio.save_message(
                 chat_id=chat_id,
                 user_id=user.id,
                 user_name=user.username or user.first_name,
+                username=user.username,
+                first_name=user.first_name,
                 message_text=media_text,
                 message_type=media_type,
-                media_file_id=file_id
+                media_file_id=file_id,
+                reply_to_message_id=message.reply_to_message.message_id if message.reply_to_message else None,
+                message_id=message.message_id
             )
             
             if not success:
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Импорт истории чата из экспорта Telegram Desktop (result.json)
+Файл читается потоком: в памяти только текущий фрагмент и пачка строк
+
+Использование:
+    python history_import.py result.json
+    python history_import.py result.json --chat-id -1001234567890 --db chat_data.db
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import DatabaseManager
+
+logger = logging.getLogger(__name__)
+
+# Типы медиа экспорта -> типы сообщений бота
+MEDIA_TYPES = {
+    'voice_message': 'voice',
+    'video_message': 'video_note',
+    'video_file': 'video',
+    'audio_file': 'audio',
+    'animation': 'animation',
+    'sticker': 'sticker',
+}
+
+# Экспорт хранит id супергрупп и каналов без префикса -100
+SUPERGROUP_TYPES = ('private_supergroup', 'public_supergroup', 'private_channel', 'public_channel')
+
+class TelegramExportReader:
+    """Потоковый разбор result.json.
+
+    Поля заголовка (тип и id чата) разбираются по одному до ключа messages,
+    затем объекты сообщений по одному декодируются json.JSONDecoder.raw_decode
+    из буфера, который дочитывается фрагментами по мере необходимости.
+    """
+
+    # Один объект экспорта больше не бывает: дальше буфер не растет
+    # (поврежденный JSON иначе дочитывался бы в память до конца файла)
+    MAX_OBJECT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chat_type = None
+        self.chat_id = None
+        self.chat_name = None
+        self._decoder = json.JSONDecoder()
+
+    @property
+    def bot_chat_id(self) -> Optional[int]:
+        """id чата в том виде, в каком его видит бот"""
+        if self.chat_id is None:
+            return None
+        if self.chat_type in SUPERGROUP_TYPES:
+            return -1000000000000 - self.chat_id
+        if self.chat_type == 'private_group':
+            return -self.chat_id
+        return self.chat_id
+
+    def __iter__(self) -> Iterator[Dict]:
+        with open(self.path, 'r', encoding='utf-8') as source:
+            buffer, pos = self._read_header(source)
+
+            while True:
+                buffer, pos = self._skip(source, buffer, pos, ' \t\r\n,')
+                if buffer[pos] == ']':
+                    return
+
+                message, buffer, pos = self._decode(source, buffer, pos)
+                yield message
+
+    def _read_header(self, source) -> tuple:
+        """Разбор полей верхнего объекта до ключа messages (значения - целиком, через raw_decode)"""
+        buffer, pos = self._skip(source, '', 0)
+        if buffer[pos] != '{':
+            raise ValueError("Файл не JSON-объект - это не экспорт Telegram Desktop")
+        pos += 1
+
+        while True:
+            buffer, pos = self._skip(source, buffer, pos, ' \t\r\n,')
+            if buffer[pos] == '}':
+                raise ValueError("В файле нет массива messages - это не экспорт Telegram Desktop")
+
+            key, buffer, pos = self._decode(source, buffer, pos)
+            buffer, pos = self._skip(source, buffer, pos)
+            if not isinstance(key, str) or buffer[pos] != ':':
+                raise ValueError("Поврежденный JSON в заголовке экспорта")
+            buffer, pos = self._skip(source, buffer, pos + 1)
+
+            if key == 'messages':
+                if buffer[pos] != '[':
+                    raise ValueError("Поле messages в экспорте - не массив")
+                return buffer, pos + 1
+
+            value, buffer, pos = self._decode(source, buffer, pos)
+            if key == 'type':
+                self.chat_type = value
+            elif key == 'id':
+                self.chat_id = value
+            elif key == 'name':
+                self.chat_name = value
+
+    def _fill(self, source, buffer: str, pos: int) -> tuple:
+        """Дочитывание фрагмента: неразобранный остаток буфера плюс новый фрагмент"""
+        if len(buffer) - pos > self.MAX_OBJECT_SIZE:
+            raise ValueError(
+                f"Поврежденный JSON: объект экспорта больше {self.MAX_OBJECT_SIZE // (1024 * 1024)}MB"
+            )
+        chunk = source.read(self.chunk_size)
+        if not chunk:
+            raise ValueError("Неожиданный конец файла экспорта")
+        return buffer[pos:] + chunk, 0
+
+    def _skip(self, source, buffer: str, pos: int, separators: str = ' \t\r\n') -> tuple:
+        """Пропуск разделителей: буфер и позиция первого значимого символа"""
+        while True:
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos < len(buffer):
+                return buffer, pos
+            buffer, pos = self._fill(source, buffer, pos)
+
+    def _decode(self, source, buffer: str, pos: int) -> tuple:
+        """Одно JSON-значение с позиции pos: (значение, буфер, позиция после него)"""
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(buffer, pos)
+                # Число на границе фрагмента могло оборваться - дочитываем
+                if end < len(buffer) or isinstance(value, (dict, list, str)):
+                    return value, buffer, end
+            except json.JSONDecodeError:
+                pass  # Значение не уместилось во фрагмент
+            buffer, pos = self._fill(source, buffer, pos)
+
+def message_text(message: Dict) -> str:
+    """Текст сообщения: в экспорте это строка или список строк и фрагментов разметки"""
+    text = message.get('text', '')
+    if isinstance(text, list):
+        text = ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text
+
+def message_type(message: Dict) -> str:
+    """Тип сообщения в терминах бота"""
+    if 'photo' in message:
+        return 'photo'
+    if message.get('media_type') in MEDIA_TYPES:
+        return MEDIA_TYPES[message['media_type']]
+    if 'file' in message:
+        return 'document'
+    return 'text'
+
+def sender_id(from_id: str) -> int:
+    """id отправителя из "user123" / "channel123" (0, если не распознан)"""
+    from_id = from_id or ''
+    if from_id.startswith('user') and from_id[4:].isdigit():
+        return int(from_id[4:])
+    if from_id.startswith('channel') and from_id[7:].isdigit():
+        return -1000000000000 - int(from_id[7:])
+    return 0
+
+def to_message_row(message: Dict) -> Optional[Dict]:
+    """Строка для DatabaseManager.import_messages (None для служебных сообщений)"""
+    if message.get('type') != 'message':
+        return None
+
+    if 'date_unixtime' in message:
+        timestamp = int(message['date_unixtime'])
+    else:
+        # Старые экспорты - только местное время без зоны
+        timestamp = int(datetime.fromisoformat(message['date']).timestamp())
+
+    return {
+        'user_id': sender_id(message.get('from_id')),
+        'user_name': message.get('from') or 'Unknown',
+        'message_text': message_text(message),
+        'message_type': message_type(message),
+        'media_file_id': None,
+        'reply_to_message_id': message.get('reply_to_message_id'),
+        'is_forwarded': 'forwarded_from' in message,
+        'message_id': message.get('id'),
+        'timestamp': timestamp,
+    }
+
+def import_telegram_export(db: DatabaseManager, path: str, chat_id: int = None,
+                           progress=None, same_chat_only: bool = False) -> Dict:
+    """Импорт result.json в базу.
+
+    chat_id по умолчанию берется из экспорта; при same_chat_only экспорт
+    другого чата отклоняется. Возвращает словарь с числом загруженных
+    сообщений (None при ошибке), временем и скоростью.
+    """
+    reader = TelegramExportReader(path)
+    rows = (row for row in map(to_message_row, reader) if row is not None)
+
+    # Заголовок читается при первом обращении к генератору
+    first = next(rows, None)
+    if same_chat_only and reader.bot_chat_id != chat_id:
+        raise ValueError("Экспорт относится к другому чату")
+    chat_id = chat_id if chat_id is not None else reader.bot_chat_id
+    if chat_id is None:
+        raise ValueError("В экспорте нет id чата - укажите его явно")
+
+    started = time.perf_counter()
+    imported = 0
+    if first is not None:
+        imported = db.import_messages(chat_id, _prepend(first, rows), progress=progress)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'chat_id': chat_id,
+        'chat_name': reader.chat_name,
+        'imported': imported,
+        'seconds': elapsed,
+        'rows_per_second': (imported or 0) / elapsed if elapsed else 0
+    }
+
+def _prepend(first: Dict, rows: Iterator[Dict]) -> Iterator[Dict]:
+    yield first
+    yield from rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт истории из экспорта Telegram Desktop")
+    parser.add_argument('path', help="путь к result.json")
+    parser.add_argument('--chat-id', type=int, help="id чата в боте (по умолчанию - из экспорта)")
+    parser.add_argument('--db', default="chat_data.db", help="файл базы данных")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"📥 Импорт истории из {args.path}")
+    print("=" * 50)
+
+    db = DatabaseManager(args.db, write_buffer=False)
+    started = time.perf_counter()
+
+    def report(imported: int):
+        rate = imported / (time.perf_counter() - started)
+        print(f"   {imported:>10} сообщений, {rate:,.0f} строк/с", flush=True)
+
+    try:
+        result = import_telegram_export(db, args.path, args.chat_id, progress=report)
+    except (OSError, ValueError) as e:
+        print(f"❌ Ошибка чтения экспорта: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+    if result['imported'] is None:
+        print("❌ Импорт прерван, подробности в логе")
+        sys.exit(1)
+
+    print(f"✅ Чат {result['chat_name'] or ''} ({result['chat_id']}): "
+          f"{result['imported']} сообщений за {result['seconds']:.1f} с "
+          f"({result['rows_per_second']:,.0f} строк/с)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Кэш ответов AI: LRU в памяти и SQLite-файл, который переживает перезапуск
+
+Ключ - SHA-256 от канонического JSON: провайдер, модель, сообщения (роль и
+текст), температура и max_tokens. Промпты команд содержат сами сообщения
+чата, поэтому новая переписка дает новый ключ - отдельная инвалидация не нужна,
+а устаревшее вытесняется по TTL и размеру.
+
+Обращения к SQLite идут в отдельном потоке (один поток - одно соединение),
+чтобы не блокировать цикл событий.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class LLMCache:
+    """Двухуровневый кэш ответов AI со счетчиками попаданий"""
+
+    # Проверка лимита строк на диске - раз в столько записей
+    PRUNE_EVERY = 100
+
+    def __init__(self, path: str = None, memory_size: int = None, ttl: int = None,
+                 max_rows: int = None):
+        self.path = path if path is not None else config.LLM_CACHE_DB_PATH
+        self.memory_size = memory_size if memory_size is not None else config.LLM_CACHE_MEMORY_SIZE
+        self.ttl = ttl if ttl is not None else config.LLM_CACHE_TTL
+        self.max_rows = max_rows if max_rows is not None else config.LLM_CACHE_DB_MAX_ROWS
+
+        self._memory = OrderedDict()  # ключ -> (срок годности, ответ)
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0}
+        self._connection = None  # открывается при первом обращении к диску
+        self._disk_enabled = bool(self.path)  # отключается, если файл не открылся
+        self._writes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-cache")
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[dict], temperature: float,
+                 max_tokens: int) -> str:
+        """Канонический хэш запроса (content и text считаются одним полем)"""
+        payload = {
+            'provider': provider,
+            'model': model,
+            'messages': [[msg.get("role") or "user", msg.get("content") or msg.get("text") or ""]
+                         for msg in messages],
+            'temperature': round(float(temperature), 4),
+            'max_tokens': int(max_tokens),
+        }
+        canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Ответ из памяти, при промахе - с диска (найденное поднимается в память)"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return entry[1]
+            if entry:
+                del self._memory[key]
+
+        entry = await self._run(self._disk_get, key, now) if self._disk_enabled else None
+        with self._lock:
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['disk_hits'] += 1
+        self._remember(key, *entry)
+        return entry[1]
+
+    async def set(self, key: str, answer: str):
+        """Сохранение ответа в оба уровня"""
+        expires = time.time() + self.ttl
+        self._remember(key, expires, answer)
+        with self._lock:
+            self._counters['stores'] += 1
+        if self._disk_enabled:
+            await self._run(self._disk_set, key, expires, answer)
+
+    def stats(self) -> Dict:
+        """Счетчики с запуска процесса и размер уровней"""
+        with self._lock:
+            stats = dict(self._counters, memory_entries=len(self._memory))
+        hits = stats['memory_hits'] + stats['disk_hits']
+        stats['hit_rate'] = hits / (hits + stats['misses']) if hits + stats['misses'] else 0.0
+        return stats
+
+    def clear(self):
+        """Очистка обоих уровней"""
+        with self._lock:
+            self._memory.clear()
+        if self._disk_enabled:
+            self._executor.submit(self._disk_clear).result()
+
+    def close(self):
+        """Закрытие файла кэша (при следующем обращении он откроется снова)"""
+        def _close():
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+        self._executor.submit(_close).result()
+
+    def _remember(self, key: str, expires: float, answer: str):
+        with self._lock:
+            self._memory[key] = (expires, answer)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    async def _run(self, func, *args):
+        """Вызов в потоке кэша; ошибка диска - это промах, а не ошибка команды"""
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except Exception as e:
+            logger.error(f"Ошибка дискового кэша AI: {e}")
+            return None
+
+    # ===== ДИСКОВЫЙ УРОВЕНЬ (только в потоке кэша) =====
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if self._connection is None and self._disk_enabled:
+            self._open()
+        return self._connection
+
+    def _open(self):
+        try:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    expires INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache(expires)")
+            connection.commit()
+            self._connection = connection
+        except sqlite3.Error as e:
+            self._disk_enabled = False
+            logger.error(f"Дисковый кэш AI отключен, не удалось открыть {self.path}: {e}")
+
+    def _disk_get(self, key: str, now: float) -> Optional[tuple]:
+        connection = self._db()
+        if connection is None:
+            return None
+        return connection.execute(
+            "SELECT expires, answer FROM llm_cache WHERE key = ? AND expires > ?", (key, int(now))
+        ).fetchone()
+
+    def _disk_set(self, key: str, expires: float, answer: str):
+        connection = self._db()
+        if connection is None:
+            return
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, answer, expires) VALUES (?, ?, ?)",
+                (key, answer, int(expires))
+            )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._prune()
+
+    def _prune(self):
+        """Удаление просроченных записей и самых старых сверх max_rows"""
+        with self._connection:
+            self._connection.execute("DELETE FROM llm_cache WHERE expires <= ?", (int(time.time()),))
+            self._connection.execute('''
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY expires DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_rows,))
+
+    def _disk_clear(self):
+        connection = self._db()
+        if connection is not None:
+            with connection:
+                connection.execute("DELETE FROM llm_cache")
@@ -1,7 +1,9 @@
 import logging
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from datetime import datetime
+from config import config
 from database import DatabaseManager
 from handlers.summary import SummaryHandler
 
@@ -18,15 +20,22 @@ class TaskScheduler:
         """Отправка ежедневной суммаризации"""
         try:
             # Получаем настройки чата
-            settings = self.db.get_chat_settings(int(chat_id))
+            settings = await self.db.settings.get(int(chat_id))
             if not settings.get('daily_summary_enabled', True):
                 return
                 
             # Получаем сообщения за последние 24 часа
             from datetime import datetime, timedelta
             start_time = datetime.now() - timedelta(hours=24)
-            messages = self.db.get_messages_by_time_range(
-                int(chat_id), start_time, datetime.now()
+            
+            # Чат без новых сообщений пропускается по счетчику, без запроса истории
+            counters = await self.db.aio.get_chat_counters(int(chat_id))
+            if not counters.last_timestamp or counters.last_timestamp < start_time.timestamp():
+                return
+            
+            messages = await self.db.aio.get_messages_by_time_range(
+                int(chat_id), start_time, datetime.now(), text_limit=config.SUMMARY_MESSAGE_MAX_CHARS,
+                skip_noise=True
             )
             
             if not messages:
@@ -52,6 +61,28 @@ class TaskScheduler:
         except Exception as e:
             logger.error(f"Error setting up daily summaries: {e}")
     
+    def setup_cleanup(self):
+        """Периодическое удаление разделов сообщений старше MESSAGE_RETENTION_DAYS"""
+        try:
+            self.scheduler.add_job(
+                self.db.cleanup_old_messages,
+                trigger=IntervalTrigger(hours=config.CLEANUP_INTERVAL_HOURS),
+                id='cleanup_old_messages'
+            )
+        except Exception as e:
+            logger.error(f"Error setting up cleanup: {e}")
+    
+    def setup_backups(self):
+        """Периодическое онлайн-резервное копирование с ротацией старых копий"""
+        try:
+            self.scheduler.add_job(
+                self.db.backup_database,
+                trigger=IntervalTrigger(hours=config.DB_BACKUP_INTERVAL_HOURS),
+                id='backup_database'
+            )
+        except Exception as e:
+            logger.error(f"Error setting up backups: {e}")
+    
     async def send_daily_summaries(self):
         """Отправка суммаризаций всем активным чатам"""
         # Логика получения всех чатов с включенными ежедневными суммаризациями
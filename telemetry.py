@@ -0,0 +1,117 @@
+"""
+Телеметрия команд бота: полное время, время БД и AI, размеры промптов и результат
+
+Обработчик команды оборачивается декоратором command_telemetry. Пока команда
+выполняется, ее метрики лежат в contextvars: AsyncDatabaseManager и AIClient
+добавляют к ним свое время, не зная, какая команда их вызвала. По завершении
+запись уходит в буфер DatabaseManager и пишется в command_stats пачкой.
+"""
+
+import time
+import logging
+import functools
+import contextvars
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+class CommandMetrics:
+    """Метрики одного выполнения команды"""
+
+    __slots__ = ('command', 'db_ms', 'llm_ms', 'llm_calls', 'prompt_tokens',
+                 'completion_tokens', 'outcome', 'llm_usage')
+
+    def __init__(self, command: str):
+        self.command = command
+        self.db_ms = 0.0
+        self.llm_ms = 0.0
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.outcome = 'ok'  # ok / error (ответ об ошибке) / exception
+        self.llm_usage = None  # токены, которые вернул провайдер для текущего вызова
+
+_current = contextvars.ContextVar('command_metrics', default=None)
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Грубая оценка токенов - как token_estimate в разделах сообщений"""
+    return (len(text) + 2) // 3 if text else 0
+
+def current_command() -> Optional[str]:
+    """Команда, внутри которой выполняется код (None - вне обработчика команды)"""
+    metrics = _current.get()
+    return metrics.command if metrics is not None else None
+
+def track_db(elapsed_ms: float):
+    """Время ожидания запроса к БД внутри команды"""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.db_ms += elapsed_ms
+
+def report_llm_usage(prompt_tokens: int, completion_tokens: int):
+    """Точное число токенов из ответа провайдера (вместо оценки по длине)"""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.llm_usage = (prompt_tokens, completion_tokens)
+
+def track_llm(elapsed_ms: float, messages: List[dict], answer: Optional[str], billed: bool = True):
+    """Завершенный запрос к AI внутри команды.
+
+    billed=False - ответ получен из чужого такого же запроса: время ожидания
+    учитывается, токены - нет.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return
+
+    metrics.llm_ms += elapsed_ms
+    metrics.llm_calls += 1
+    if not billed:
+        return
+    if metrics.llm_usage is not None:
+        prompt_tokens, completion_tokens = metrics.llm_usage
+        metrics.llm_usage = None
+    else:
+        prompt_tokens = sum(estimate_tokens(msg.get("content") or msg.get("text")) for msg in messages)
+        completion_tokens = estimate_tokens(answer)
+    metrics.prompt_tokens += prompt_tokens
+    metrics.completion_tokens += completion_tokens
+
+def mark_failed():
+    """Команда ответила пользователю сообщением об ошибке"""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.outcome = 'error'
+
+def command_telemetry(command: str):
+    """Декоратор метода-обработчика команды (self.db - DatabaseManager).
+
+    Запись телеметрии не должна мешать ответу: ошибки записи только логируются.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, update, context):
+            metrics = CommandMetrics(command)
+            token = _current.set(metrics)
+            started = time.perf_counter()
+            try:
+                return await handler(self, update, context)
+            except Exception:
+                metrics.outcome = 'exception'
+                raise
+            finally:
+                wall_ms = (time.perf_counter() - started) * 1000
+                _current.reset(token)
+                try:
+                    chat, user = update.effective_chat, update.effective_user
+                    self.db.log_command_usage(
+                        chat.id if chat else 0, user.id if user else 0, command,
+                        success=metrics.outcome == 'ok', wall_ms=wall_ms, db_ms=metrics.db_ms,
+                        llm_ms=metrics.llm_ms, llm_calls=metrics.llm_calls,
+                        prompt_tokens=metrics.prompt_tokens,
+                        completion_tokens=metrics.completion_tokens, outcome=metrics.outcome
+                    )
+                except Exception as e:
+                    logger.error(f"Error recording telemetry for /{command}: {e}")
+        return wrapper
+    return decorator
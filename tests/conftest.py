@@ -0,0 +1,64 @@
+"""
+Общие фикстуры тестов: модули бота лежат в корне репозитория,
+база данных и кэш AI создаются во временном каталоге теста
+"""
+
+import os
+import sys
+import calendar
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config
+from database import DatabaseManager
+
+@pytest.fixture(autouse=True)
+def test_config(monkeypatch):
+    """Быстрые миграции без пауз и без шардов, запись сразу в базу"""
+    monkeypatch.setattr(config, "DB_SHARD_COUNT", 0)
+    monkeypatch.setattr(config, "DB_WRITE_BUFFER_ENABLED", False)
+    monkeypatch.setattr(config, "DB_MIGRATION_PAUSE_MS", 0)
+    monkeypatch.setattr(config, "MESSAGE_ARCHIVE_ENABLED", True)
+    monkeypatch.setattr(config, "MESSAGE_ARCHIVE_RETENTION_DAYS", 0)
+    return config
+
+@pytest.fixture
+def open_db(tmp_path):
+    """Фабрика DatabaseManager во временном каталоге (закрываются после теста)"""
+    opened = []
+
+    def _open(name: str = "chat_data.db", **kwargs) -> DatabaseManager:
+        db = DatabaseManager(str(tmp_path / name), **kwargs)
+        opened.append(db)
+        return db
+
+    yield _open
+    for db in opened:
+        db.close()
+
+def wait_migrations(db: DatabaseManager):
+    """Ожидание фоновых online-миграций базы и ее шардов"""
+    for manager in [db] + db.shards:
+        if manager.migrator._thread is not None:
+            manager.migrator._thread.join()
+
+def epoch(*args) -> int:
+    """Секунды Unix для времени UTC"""
+    return calendar.timegm(datetime(*args).timetuple())
+
+def history_row(message_id: int, timestamp: int, text: str) -> dict:
+    """Строка в формате import_messages"""
+    return {
+        'user_id': 100 + message_id % 2,
+        'user_name': f"user{message_id % 2}",
+        'message_text': text,
+        'message_type': 'text',
+        'media_file_id': None,
+        'reply_to_message_id': None,
+        'is_forwarded': False,
+        'message_id': message_id,
+        'timestamp': timestamp,
+    }
@@ -0,0 +1,112 @@
+"""
+AIClient: кэширование ответов и объединение одинаковых запросов (single-flight)
+"""
+
+import asyncio
+
+import pytest
+
+from ai_client import AIClient
+from llm_cache import LLMCache
+
+MESSAGES = [{"role": "system", "content": "Ты бот"}, {"role": "user", "content": "Итоги дня"}]
+
+@pytest.fixture
+def client(tmp_path, test_config, monkeypatch):
+    """AIClient с подмененным запросом к API: считает вызовы и отвечает с задержкой"""
+    monkeypatch.setattr(test_config, "AI_SINGLE_FLIGHT_ENABLED", True)
+    monkeypatch.setattr(test_config, "LLM_CACHE_ENABLED", True)
+    client = AIClient()
+    client.provider = "yandex"
+    client.cache = LLMCache(path=str(tmp_path / "llm_cache.db"))
+    client.calls = []
+    client.cacheable = True
+
+    async def fake_completion(messages, max_tokens=None, temperature=None):
+        client.calls.append(messages[-1]["content"])
+        await asyncio.sleep(0.05)
+        return f"ответ на {messages[-1]['content']}", client.cacheable
+
+    client._chat_completion = fake_completion
+    return client
+
+def test_single_flight_coalesces(client):
+    async def scenario():
+        answers = await asyncio.gather(*(client.chat_completion(MESSAGES) for _ in range(10)))
+        assert answers == ["ответ на Итоги дня"] * 10
+        assert client.calls == ["Итоги дня"]
+        assert client._inflight == {}
+
+        # Завершенный запрос не объединяется со следующим
+        await client.chat_completion(MESSAGES)
+        assert len(client.calls) == 2
+
+        # Разные запросы идут в API независимо
+        other = [{"role": "user", "content": "Другое"}]
+        await asyncio.gather(client.chat_completion(MESSAGES), client.chat_completion(other))
+        assert sorted(client.calls[2:]) == ["Другое", "Итоги дня"]
+        await client.close()
+
+    asyncio.run(scenario())
+
+def test_single_flight_survives_cancel(client):
+    async def scenario():
+        leader = asyncio.ensure_future(client.chat_completion(MESSAGES))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(client.chat_completion(MESSAGES))
+        await asyncio.sleep(0.01)
+
+        # Отмена первого вызова не отменяет запрос, которого ждет второй
+        leader.cancel()
+        assert await follower == "ответ на Итоги дня"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert client.calls == ["Итоги дня"]
+        assert client._inflight == {}
+        await client.close()
+
+    asyncio.run(scenario())
+
+def test_cache_opt_in(client):
+    async def scenario():
+        # Вне команды из LLM_CACHE_COMMANDS ответ не кэшируется
+        await client.chat_completion(MESSAGES)
+        await client.chat_completion(MESSAGES)
+        assert len(client.calls) == 2
+
+        assert await client.chat_completion(MESSAGES, cache=True) == "ответ на Итоги дня"
+        assert await client.chat_completion(MESSAGES, cache=True) == "ответ на Итоги дня"
+        assert len(client.calls) == 3
+        assert client.cache.stats()['memory_hits'] == 1
+
+        # Объединенные вызовы сохраняют ответ один раз
+        other = [{"role": "user", "content": "Другое"}]
+        await asyncio.gather(*(client.chat_completion(other, cache=True) for _ in range(5)))
+        assert client.cache.stats()['stores'] == 2
+        await client.close()
+
+    asyncio.run(scenario())
+
+def test_degraded_answer_not_cached(client):
+    async def scenario():
+        # Ответ упрощенного запроса после ошибки API не попадает в кэш
+        client.cacheable = False
+        await client.chat_completion(MESSAGES, cache=True)
+        client.cacheable = True
+        await client.chat_completion(MESSAGES, cache=True)
+        assert len(client.calls) == 2
+        await client.chat_completion(MESSAGES, cache=True)
+        assert len(client.calls) == 2
+        await client.close()
+
+    asyncio.run(scenario())
+
+def test_local_provider_not_cached_or_coalesced(client):
+    async def scenario():
+        client.provider = "local"
+        await asyncio.gather(*(client.chat_completion(MESSAGES, cache=True) for _ in range(3)))
+        assert len(client.calls) == 3
+        assert client.cache.stats()['stores'] == 0
+        await client.close()
+
+    asyncio.run(scenario())
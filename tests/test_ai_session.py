@@ -0,0 +1,113 @@
+"""
+Общая aiohttp-сессия AIClient: одно соединение на все запросы, закрытие и смена цикла
+"""
+
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from ai_client import AIClient
+from llm_cache import LLMCache
+
+MESSAGES = [{"role": "user", "content": "Итоги дня"}]
+
+class FakeYandex:
+    """Локальный API Yandex GPT: запоминает, через какие соединения шли запросы"""
+
+    def __init__(self):
+        self.peers = []
+        self.methods = []
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        self.methods.append(request.method)
+        self.peers.append(request.transport.get_extra_info('peername'))
+        if request.method != 'POST':
+            # Как у настоящего API: ответ с длиной тела, иначе соединение не переиспользуется
+            return web.Response(status=405, text="Method Not Allowed")
+        return web.json_response({'result': {'alternatives': [{'message': {'text': "ответ"}}]}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route('*', '/completion', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/completion"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+@pytest.fixture
+def client(tmp_path, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "LLM_CACHE_ENABLED", False)
+    monkeypatch.setattr(test_config, "YANDEX_API_KEY", "test-key")
+    monkeypatch.setattr(test_config, "YANDEX_FOLDER_ID", "test-folder")
+    client = AIClient()
+    client.provider = "yandex"
+    client.cache = LLMCache(path=str(tmp_path / "llm_cache.db"))
+    return client
+
+def test_warm_connection_is_reused(client, test_config, monkeypatch):
+    api = FakeYandex()
+
+    async def scenario():
+        await api.start()
+        monkeypatch.setattr(test_config, "YANDEX_URL", api.url)
+        try:
+            await client.warm()
+            session = client._get_session()
+            for _ in range(3):
+                assert await client.chat_completion(MESSAGES) == "ответ"
+            assert client._get_session() is session
+        finally:
+            await client.close()
+            await api.stop()
+
+    asyncio.run(scenario())
+    # HEAD при запуске открыл соединение, запросы пошли через него же
+    assert api.methods == ['HEAD', 'POST', 'POST', 'POST']
+    assert len(set(api.peers)) == 1
+
+def test_warm_does_not_fail_startup(client, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "YANDEX_URL", "http://127.0.0.1:9/completion")
+
+    async def scenario():
+        try:
+            await client.warm()
+        finally:
+            await client.close()
+
+    asyncio.run(scenario())
+
+def test_close_and_reopen_in_another_loop(client, test_config):
+    async def open_session():
+        return client._get_session()
+
+    loop = asyncio.new_event_loop()
+    try:
+        session = loop.run_until_complete(open_session())
+        assert session.connector.limit == test_config.AI_HTTP_POOL_SIZE
+
+        # Открытую сессию чужого цикла не подменяем - ее соединения остались бы открытыми
+        with pytest.raises(RuntimeError):
+            asyncio.run(open_session())
+        assert client._session is session
+
+        loop.run_until_complete(client.close())
+        assert session.closed
+        assert client._session is None
+    finally:
+        loop.close()
+
+    async def reopen():
+        try:
+            return client._get_session()
+        finally:
+            await client.close()
+
+    assert asyncio.run(reopen()) is not session
@@ -0,0 +1,88 @@
+"""
+Холодный архив: сжатые блоки по чату и месяцу, чтение и поиск по ним
+"""
+
+from datetime import datetime
+
+from conftest import wait_migrations, epoch, history_row
+
+CHAT_ID = 7
+
+def archived_db(open_db):
+    """Два месяца истории (март - яблоки, апрель - груши), перенесенные в архив"""
+    db = open_db()
+    wait_migrations(db)
+    rows = [history_row(i, epoch(2025, 3, 1) + i * 3600, f"яблоко номер {i}") for i in range(20)]
+    rows += [history_row(100 + i, epoch(2025, 4, 1) + i * 3600, f"груша номер {i}") for i in range(30)]
+    assert db.import_messages(CHAT_ID, rows, batch_size=16) == 50
+    assert db.cleanup_old_messages(days=90) == 50
+    assert db._partitions == []
+    return db
+
+def test_iter_archive_order(open_db):
+    db = archived_db(open_db)
+
+    rows = list(db._iter_archive(CHAT_ID))
+    assert len(rows) == 50
+    assert [row[6] for row in rows] == sorted(row[6] for row in rows)
+    assert rows[0][3] == "яблоко номер 0"
+    assert rows[-1][3] == "груша номер 29"
+
+    newest = list(db._iter_archive(CHAT_ID, newest_first=True))
+    assert newest == list(reversed(rows))
+
+    # Границы периода применяются к строкам, а не только к блокам
+    window = list(db._iter_archive(CHAT_ID, epoch(2025, 3, 1, 5), epoch(2025, 4, 1, 2)))
+    assert [row[3] for row in window] == (
+        [f"яблоко номер {i}" for i in range(5, 20)] + [f"груша номер {i}" for i in range(3)]
+    )
+
+    assert list(db._iter_archive(CHAT_ID + 1)) == []
+
+def test_iter_archive_skips_blocks_by_prefix(open_db):
+    db = archived_db(open_db)
+
+    # Блок марта не содержит слов на "груш" и не распаковывается
+    pears = list(db._iter_archive(CHAT_ID, terms=['груш']))
+    assert {row[3].split()[0] for row in pears} == {"груша"}
+    assert len(pears) == 30
+
+    # Короткий термин сравнивается с началом префикса
+    assert len(list(db._iter_archive(CHAT_ID, terms=['ябл', 'но']))) == 20
+    assert list(db._iter_archive(CHAT_ID, terms=['слива'])) == []
+
+def test_search_falls_back_to_archive(open_db):
+    db = archived_db(open_db)
+
+    results = db.search_messages(CHAT_ID, "груша", limit=3)
+    assert [r['snippet'] for r in results] == [
+        "«груша» номер 29", "«груша» номер 28", "«груша» номер 27"
+    ]
+    assert results[0]['timestamp'] == "2025-04-02 05:00:00"
+    assert db.search_messages(CHAT_ID, "слива") == []
+
+def test_archived_history_keeps_ids(open_db):
+    db = archived_db(open_db)
+
+    messages = list(db.iter_messages_by_time_range(
+        CHAT_ID, datetime(2025, 3, 1), datetime(2025, 5, 1)
+    ))
+    assert len(messages) == 50
+    assert all(m.id for m in messages)
+    assert len({m.id for m in messages}) == 50
+
+def test_archive_prefixes_backfill(open_db):
+    db = archived_db(open_db)
+    with db.pool.transaction() as conn:
+        conn.execute("UPDATE message_archive SET prefixes = NULL")
+        conn.execute("DELETE FROM schema_migrations WHERE version = 9")
+    db.close()
+
+    # Блоки без метаданных читаются всегда, пока миграция 9 их не заполнит
+    db = open_db()
+    wait_migrations(db)
+    with db.pool.reader() as conn:
+        assert conn.execute(
+            "SELECT COUNT(*) FROM message_archive WHERE prefixes IS NULL"
+        ).fetchone()[0] == 0
+    assert len(list(db._iter_archive(CHAT_ID, terms=['груш']))) == 30
@@ -0,0 +1,90 @@
+"""
+Асинхронный фасад db.aio: запросы в потоках БД и ограниченная очередь ожидания
+"""
+
+import time
+import asyncio
+import threading
+
+import pytest
+
+from database import AsyncDatabaseManager
+from telemetry import CommandMetrics, _current
+
+class SlowDatabase:
+    """Методы, которые держат поток БД, пока тест их не отпустит"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def query(self, value):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.release.wait(2)
+        with self._lock:
+            self.running -= 1
+        return value * 2
+
+    def _private(self):
+        return "скрыто"
+
+@pytest.fixture
+def slow_db():
+    db = SlowDatabase()
+    yield db
+    db.release.set()
+
+def test_results_and_private_methods(slow_db):
+    facade = AsyncDatabaseManager(slow_db, workers=2, max_pending=4)
+    slow_db.release.set()
+    try:
+        assert asyncio.run(facade.query(21)) == 42
+        with pytest.raises(AttributeError):
+            facade._private
+    finally:
+        facade.shutdown()
+
+def test_pending_queries_are_bounded(slow_db):
+    facade = AsyncDatabaseManager(slow_db, workers=8, max_pending=3)
+
+    async def scenario():
+        tasks = [asyncio.ensure_future(facade.query(i)) for i in range(10)]
+        # Цикл событий не блокируется, пока запросы ждут базу
+        ticks = 0
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert ticks == 10
+        assert slow_db.running == 3
+
+        slow_db.release.set()
+        return await asyncio.gather(*tasks)
+
+    try:
+        assert asyncio.run(scenario()) == [i * 2 for i in range(10)]
+        assert slow_db.max_running == 3
+    finally:
+        facade.shutdown()
+
+def test_wait_counts_as_command_db_time(slow_db):
+    facade = AsyncDatabaseManager(slow_db, workers=1, max_pending=1)
+    metrics = CommandMetrics('test')
+
+    async def scenario():
+        token = _current.set(metrics)
+        try:
+            threading.Timer(0.05, slow_db.release.set).start()
+            await facade.query(1)
+        finally:
+            _current.reset(token)
+
+    try:
+        started = time.perf_counter()
+        asyncio.run(scenario())
+        assert 40 <= metrics.db_ms <= (time.perf_counter() - started) * 1000
+    finally:
+        facade.shutdown()
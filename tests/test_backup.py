@@ -0,0 +1,75 @@
+"""
+Онлайн-резервные копии через SQLite backup API и их ротация
+"""
+
+import os
+import gzip
+import time
+import sqlite3
+
+import pytest
+
+def backup_texts(path: str) -> list:
+    """Тексты сообщений из копии (сжатая копия распаковывается рядом)"""
+    if path.endswith('.gz'):
+        raw = path[:-3]
+        with gzip.open(path, 'rb') as source, open(raw, 'wb') as target:
+            target.write(source.read())
+        path = raw
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT message_text FROM messages ORDER BY id")]
+    finally:
+        conn.close()
+
+@pytest.fixture
+def backup_dir(tmp_path, test_config, monkeypatch):
+    path = tmp_path / "backups"
+    monkeypatch.setattr(test_config, "DB_BACKUP_DIR", str(path))
+    monkeypatch.setattr(test_config, "DB_BACKUP_STEP_PAUSE_MS", 0)
+    monkeypatch.setattr(test_config, "DB_WRITE_BUFFER_FLUSH_MS", 3600 * 1000)
+    return path
+
+def test_backup_includes_buffered_messages(tmp_path, open_db, backup_dir):
+    db = open_db(write_buffer=True)
+    for i in range(5):
+        db.save_message(1, 100, "user", f"сообщение {i}")
+    assert len(db.buffer) == 5
+
+    path = str(tmp_path / "copy.db")
+    assert db.backup_database(path, compress=True)
+    assert not os.path.exists(path)
+    assert backup_texts(path + '.gz') == [f"сообщение {i}" for i in range(5)]
+
+def test_scheduled_backup_rotates_old_copies(open_db, backup_dir, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "DATABASE_BACKUP_DAYS", 7)
+    db = open_db()
+    db.save_message(1, 100, "user", "сообщение")
+
+    backup_dir.mkdir()
+    old = backup_dir / "chat_data_backup_20200101_000000.db.gz"
+    old.write_bytes(b"")
+    stale = time.time() - 8 * 86400
+    os.utime(old, (stale, stale))
+    foreign = backup_dir / "other_backup_20200101_000000.db.gz"
+    foreign.write_bytes(b"")
+    os.utime(foreign, (stale, stale))
+
+    assert db.backup_database()
+    copies = sorted(os.listdir(backup_dir))
+    assert not old.exists()
+    assert foreign.exists()
+    new = [name for name in copies if name.startswith("chat_data_backup_")]
+    assert len(new) == 1
+    assert backup_texts(str(backup_dir / new[0])) == ["сообщение"]
+
+def test_backup_copies_shards(tmp_path, open_db, backup_dir):
+    db = open_db(shard_count=2)
+    db.save_message(1, 100, "user", "нечетный чат")
+    db.save_message(2, 100, "user", "четный чат")
+
+    path = str(tmp_path / "copy.db")
+    assert db.backup_database(path, compress=False)
+    assert backup_texts(str(tmp_path / "copy.shard0.db")) == ["четный чат"]
+    assert backup_texts(str(tmp_path / "copy.shard1.db")) == ["нечетный чат"]
+    assert backup_texts(path) == []
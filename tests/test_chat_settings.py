@@ -0,0 +1,70 @@
+"""
+Настройки чатов: UPSERT отдельных полей и кэш ChatSettingsService
+"""
+
+import asyncio
+
+def test_update_keeps_other_fields(open_db):
+    db = open_db()
+    assert db.get_chat_settings(1)['summary_time'] == '21:00'
+
+    assert db.update_chat_settings(1, summary_time='09:30', pin_summary=False)
+    assert db.update_chat_settings(1, bot_personality="строгий редактор")
+    settings = db.get_chat_settings(1)
+    assert settings['summary_time'] == '09:30'
+    assert settings['pin_summary'] is False
+    assert settings['bot_personality'] == "строгий редактор"
+    assert settings['daily_summary_enabled'] is True
+
+    # Неизвестные поля не пишутся
+    assert db.update_chat_settings(2, created_at='2020-01-01') is False
+    assert db.get_chat_settings(2)['created_at'] is None
+
+def test_cache_serves_repeated_reads(open_db):
+    db = open_db()
+    db.update_chat_settings(1, summary_time='10:00')
+    reads = []
+    original = db.get_chat_settings
+    db.get_chat_settings = lambda chat_id: reads.append(chat_id) or original(chat_id)
+
+    async def scenario():
+        first = await db.settings.get(1)
+        first['summary_time'] = '00:00'  # копия: правка результата не портит кэш
+        second = await db.settings.get(1)
+        return second
+
+    assert asyncio.run(scenario())['summary_time'] == '10:00'
+    assert reads == [1]
+
+def test_update_through_service_refreshes_cache(open_db):
+    db = open_db()
+
+    async def scenario():
+        await db.settings.get(1)
+        assert await db.settings.update(1, language='en')
+        assert await db.settings.update(1, pin_summary=False)
+        return await db.settings.get(1)
+
+    settings = asyncio.run(scenario())
+    assert settings['language'] == 'en'
+    assert settings['pin_summary'] is False
+    assert settings['summary_time'] == '21:00'
+
+def test_cache_expires_and_invalidates(open_db):
+    db = open_db()
+    db.settings.ttl = 0
+
+    async def read():
+        return (await db.settings.get(1))['language']
+
+    assert asyncio.run(read()) == 'ru'
+    # Запись в обход сервиса видна после истечения срока
+    db.update_chat_settings(1, language='en')
+    assert asyncio.run(read()) == 'en'
+
+    db.settings.ttl = 300
+    assert asyncio.run(read()) == 'en'
+    db.update_chat_settings(1, language='de')
+    assert asyncio.run(read()) == 'en'
+    db.settings.invalidate(1)
+    assert asyncio.run(read()) == 'de'
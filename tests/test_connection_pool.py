@@ -0,0 +1,73 @@
+"""
+Пул соединений SQLite: один писатель в WAL и читатели из очереди
+"""
+
+import threading
+
+import pytest
+
+from database import ConnectionPool
+
+def read_values(pool) -> list:
+    with pool.reader() as conn:
+        return [row[0] for row in conn.execute("SELECT value FROM items")]
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "pool.db"), readers=2)
+    with pool.transaction() as conn:
+        conn.execute("CREATE TABLE items (value INTEGER)")
+    yield pool
+    pool.close()
+
+def test_writer_uses_wal(pool):
+    with pool.reader() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+def test_transaction_rolls_back_on_error(pool):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO items VALUES (1)")
+    with pytest.raises(RuntimeError):
+        with pool.transaction() as conn:
+            conn.execute("INSERT INTO items VALUES (2)")
+            raise RuntimeError("откат")
+
+    with pool.reader() as conn:
+        assert conn.execute("SELECT value FROM items").fetchall() == [(1,)]
+
+def test_reader_does_not_wait_for_writer(pool):
+    # Открытая транзакция писателя не мешает читать последнее зафиксированное
+    with pool.transaction() as writer:
+        writer.execute("INSERT INTO items VALUES (1)")
+        result = []
+        reader = threading.Thread(target=lambda: result.append(read_values(pool)))
+        reader.start()
+        reader.join(2)
+        assert result == [[]]
+    assert read_values(pool) == [1]
+
+def test_readers_are_reused(pool):
+    with pool.reader() as first, pool.reader() as second:
+        assert first is not second
+    with pool.reader() as again:
+        assert again in (first, second)
+
+    # Все читатели заняты - следующий ждет возврата соединения
+    with pool.reader():
+        with pool.reader():
+            waiting = threading.Thread(target=read_values, args=(pool,))
+            waiting.start()
+            waiting.join(0.1)
+            assert waiting.is_alive()
+    waiting.join(2)
+    assert not waiting.is_alive()
+
+def test_memory_database_reads_through_writer():
+    pool = ConnectionPool(":memory:", readers=3)
+    try:
+        with pool.transaction() as conn:
+            conn.execute("CREATE TABLE items (value INTEGER)")
+            conn.execute("INSERT INTO items VALUES (1)")
+        assert read_values(pool) == [1]
+    finally:
+        pool.close()
@@ -0,0 +1,66 @@
+"""
+Счетчики активности чатов (chat_counters) обновляются в транзакции записи
+"""
+
+from datetime import datetime, timezone
+
+from conftest import wait_migrations, epoch, history_row
+from test_migrations import create_baseline_db
+
+CHAT_ID = 7
+
+def test_live_messages_update_counters(open_db):
+    db = open_db()
+    wait_migrations(db)
+    assert db.get_chat_counters(CHAT_ID).total == 0
+
+    for i in range(3):
+        db.save_message(CHAT_ID, 100, "user", f"сообщение {i}", message_id=i + 1)
+    db.save_message(CHAT_ID + 1, 100, "user", "другой чат", message_id=1)
+
+    counters = db.get_chat_counters(CHAT_ID)
+    assert counters.total == 3
+    assert counters.last_message_id == 3
+    assert counters.last_id == db.get_message(CHAT_ID, 3).id
+    assert counters.day == datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    assert counters.today == 3
+
+def test_import_of_older_history_keeps_last_message(open_db):
+    db = open_db()
+    wait_migrations(db)
+    db.save_message(CHAT_ID, 100, "user", "сегодня", message_id=100)
+
+    rows = [history_row(i, epoch(2026, 9, 1, 10) + i * 3600, f"старое {i}") for i in range(30)]
+    assert db.import_messages(CHAT_ID, rows) == 30
+
+    counters = db.get_chat_counters(CHAT_ID)
+    assert counters.total == 31
+    assert counters.last_message_id == 100
+    assert counters.today == 1
+
+def test_counters_of_imported_days(open_db):
+    db = open_db()
+    wait_migrations(db)
+    # 10:00 1 сентября + 20 часов: 14 сообщений 1-го и 6 сообщений 2-го
+    rows = [history_row(i, epoch(2026, 9, 1, 10) + i * 3600, f"старое {i}") for i in range(20)]
+    db.import_messages(CHAT_ID, rows, batch_size=7)
+
+    counters = db.get_chat_counters(CHAT_ID)
+    assert (counters.total, counters.last_message_id) == (20, 19)
+    assert (counters.day, counters.day_count) == ('2026-09-02', 6)
+    assert counters.last_timestamp == epoch(2026, 9, 2, 5)
+    assert counters.today == 0
+
+def test_counters_after_upgrade(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / "chat_data.db"), {1: 30, 2: 5})
+    db = open_db()
+    wait_migrations(db)
+
+    # Миграция 6 считает счетчики по уже сохраненным сообщениям
+    counters = db.get_chat_counters(1)
+    assert counters.total == 30
+    assert (counters.day, counters.day_count) == ('2026-08-21', 6)
+    assert db.get_chat_counters(2).total == 5
+
+    db.save_message(1, 100, "user", "после обновления", message_id=1)
+    assert db.get_chat_counters(1).total == 31
@@ -0,0 +1,68 @@
+"""
+Признаки текста при записи: шум отсекается в SQL, промпт собирается в бюджет токенов
+"""
+
+from conftest import wait_migrations, epoch, history_row
+
+CHAT_ID = 7
+
+def stored_features(db, text: str) -> dict:
+    db.save_message(CHAT_ID, 100, "user", text)
+    with db.pool.reader() as conn:
+        row = conn.execute(f'''
+            SELECT {', '.join(db.ENRICHMENT_COLUMNS)} FROM messages
+            WHERE message_text = ? ORDER BY id DESC LIMIT 1
+        ''', (text,)).fetchone()
+    return dict(zip(db.ENRICHMENT_COLUMNS, row))
+
+def test_features_are_stored_on_write(open_db):
+    db = open_db()
+    wait_migrations(db)
+
+    features = stored_features(db, "Завтра в 10 у входа 🙂")
+    assert features == {'char_len': 21, 'token_estimate': 7, 'has_link': 0,
+                        'emoji_count': 1, 'is_noise': 0}
+
+    for noise in ("ок", "Ок, спс!", "👍👍", "...", "ХАХА"):
+        assert stored_features(db, noise)['is_noise'] == 1, noise
+    assert stored_features(db, "👍👍")['emoji_count'] == 2
+
+    # Ссылка без слов - не шум
+    link = stored_features(db, "https://t.me/c/1/2")
+    assert (link['has_link'], link['is_noise']) == (1, 0)
+
+def test_recent_messages_skip_noise(open_db):
+    db = open_db()
+    wait_migrations(db)
+    for i, text in enumerate(["Во сколько встреча?", "ок", "👍", "В семь, у входа", "ага"]):
+        db.save_message(CHAT_ID, 100 + i % 2, "user", text, message_id=i + 1)
+
+    assert len(db.get_recent_messages(CHAT_ID)) == 5
+    assert [m.text for m in db.get_recent_messages(CHAT_ID, skip_noise=True)] == [
+        "Во сколько встреча?", "В семь, у входа"
+    ]
+    assert [m.text for m in db.get_messages_by_user_ids(CHAT_ID, [100], skip_noise=True)] == [
+        "Во сколько встреча?"
+    ]
+
+def test_token_budget_keeps_newest_messages(open_db):
+    db = open_db()
+    wait_migrations(db)
+    # По 10 токенов на сообщение, история на стыке сентября и октября
+    rows = [history_row(i, epoch(2026, 9, 30, 12) + i * 3600, f"сообщение номер {i:02d}" + "." * 12)
+            for i in range(20)]
+    assert db.import_messages(CHAT_ID, rows) == 20
+    assert len(db._partitions) == 2
+
+    def budget_ids(**kwargs):
+        return [m.message_id for m in db.get_recent_messages(CHAT_ID, limit=100, **kwargs)]
+
+    assert budget_ids(token_budget=35) == [17, 18, 19]
+    assert budget_ids(token_budget=30) == [17, 18, 19]
+    # Бюджет захватывает оба раздела
+    assert budget_ids(token_budget=150) == list(range(5, 20))
+    assert budget_ids(token_budget=10_000) == list(range(20))
+    # text_limit обрезает текст, и в бюджет помещается больше сообщений
+    assert budget_ids(token_budget=30, text_limit=15) == list(range(14, 20))
+    # limit по-прежнему действует
+    assert [m.message_id for m in db.get_recent_messages(CHAT_ID, limit=2, token_budget=10_000)] == [18, 19]
@@ -0,0 +1,90 @@
+"""
+Двухуровневый кэш ответов AI (LRU в памяти и SQLite-файл)
+"""
+
+import asyncio
+
+import pytest
+
+from llm_cache import LLMCache
+
+MESSAGES = [{"role": "system", "content": "Ты бот"}, {"role": "user", "content": "Итоги дня"}]
+
+def disk_rows(cache: LLMCache) -> int:
+    """Число строк в файле кэша (соединение живет в потоке кэша)"""
+    return cache._executor.submit(
+        lambda: cache._db().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+    ).result()
+
+def test_make_key():
+    key = LLMCache.make_key("yandex", "yandexgpt", MESSAGES, 0.7, 800)
+    # text и content - одно поле, роль по умолчанию - user
+    same = LLMCache.make_key("yandex", "yandexgpt", [
+        {"role": "system", "text": "Ты бот"}, {"text": "Итоги дня"}
+    ], 0.70000001, 800)
+    assert key == same
+    assert key != LLMCache.make_key("yandex", "yandexgpt", MESSAGES, 0.7, 801)
+    assert key != LLMCache.make_key("openai", "yandexgpt", MESSAGES, 0.7, 800)
+
+def test_cache_memory_and_disk(tmp_path):
+    path = str(tmp_path / "llm_cache.db")
+
+    async def scenario():
+        cache = LLMCache(path=path, memory_size=2, ttl=60)
+        for key in ("a", "b", "c"):
+            await cache.set(key, f"ответ {key}")
+        assert await cache.get("c") == "ответ c"
+        # "a" вытеснен из памяти, но остался на диске и поднимается обратно
+        assert await cache.get("a") == "ответ a"
+        assert await cache.get("нет") is None
+        stats = cache.stats()
+        assert (stats['memory_hits'], stats['disk_hits'], stats['misses'], stats['stores']) == (1, 1, 1, 3)
+        assert stats['memory_entries'] == 2
+        assert stats['hit_rate'] == pytest.approx(2 / 3)
+        cache.close()
+
+        # Ответы переживают перезапуск
+        restarted = LLMCache(path=path, memory_size=2, ttl=60)
+        assert await restarted.get("b") == "ответ b"
+        assert restarted.stats()['disk_hits'] == 1
+        restarted.clear()
+        assert await restarted.get("b") is None
+        restarted.close()
+
+    asyncio.run(scenario())
+
+def test_cache_ttl(tmp_path):
+    async def scenario():
+        cache = LLMCache(path=str(tmp_path / "llm_cache.db"), ttl=-1)
+        await cache.set("a", "устарел")
+        assert await cache.get("a") is None
+        assert cache.stats()['misses'] == 1
+        cache.close()
+
+    asyncio.run(scenario())
+
+def test_cache_prune(tmp_path):
+    async def scenario():
+        cache = LLMCache(path=str(tmp_path / "llm_cache.db"), max_rows=3)
+        cache.PRUNE_EVERY = 5
+        for i in range(5):
+            await cache.set(f"k{i}", str(i))
+        assert disk_rows(cache) == 3
+        # Остаются самые свежие
+        cache._memory.clear()
+        assert await cache.get("k4") == "4"
+        assert await cache.get("k0") is None
+        cache.close()
+
+    asyncio.run(scenario())
+
+def test_cache_memory_only():
+    async def scenario():
+        cache = LLMCache(path="", memory_size=1)
+        await cache.set("a", "1")
+        await cache.set("b", "2")
+        assert await cache.get("b") == "2"
+        assert await cache.get("a") is None
+        cache.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,56 @@
+"""
+id сообщений Telegram: повторное сохранение и правки обновляют запись на месте
+"""
+
+from conftest import wait_migrations
+
+CHAT_ID = 7
+
+def test_same_message_id_updates_in_place(open_db):
+    db = open_db()
+    wait_migrations(db)
+    db.save_message(CHAT_ID, 100, "user", "опечтка", message_id=10)
+    original = db.get_message(CHAT_ID, 10)
+
+    assert db.save_message(CHAT_ID, 100, "user", "опечатка, исправлено", message_id=10, edit=True)
+    edited = db.get_message(CHAT_ID, 10)
+    assert edited.text == "опечатка, исправлено"
+    assert (edited.id, edited.timestamp) == (original.id, original.timestamp)
+    assert len(db.get_recent_messages(CHAT_ID)) == 1
+    assert db.get_chat_counters(CHAT_ID).total == 1
+
+    # Тот же id в другом чате - другое сообщение
+    db.save_message(CHAT_ID + 1, 100, "user", "другой чат", message_id=10)
+    assert db.get_message(CHAT_ID, 10).text == "опечатка, исправлено"
+
+def test_edit_of_unknown_message_is_skipped(open_db):
+    db = open_db()
+    wait_migrations(db)
+    assert db.save_message(CHAT_ID, 100, "user", "правка до запуска бота", message_id=5, edit=True)
+    assert db.get_message(CHAT_ID, 5) is None
+    assert db.get_recent_messages(CHAT_ID) == []
+    assert db.get_chat_counters(CHAT_ID).total == 0
+
+def test_edit_in_the_same_buffered_batch(open_db, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "DB_WRITE_BUFFER_FLUSH_MS", 3600 * 1000)
+    db = open_db(write_buffer=True)
+    wait_migrations(db)
+    db.save_message(CHAT_ID, 100, "user", "первый вариант", message_id=1)
+    db.save_message(CHAT_ID, 100, "user", "второй вариант", message_id=1, edit=True)
+    db.save_message(CHAT_ID, 100, "user", "без id")
+    db.save_message(CHAT_ID, 100, "user", "без id")
+
+    assert db.flush_messages() == 4
+    assert [m.text for m in db.get_recent_messages(CHAT_ID)] == ["второй вариант", "без id", "без id"]
+
+def test_repeated_update_is_not_duplicated(open_db):
+    db = open_db()
+    wait_migrations(db)
+    # Повторная доставка того же update после перезапуска бота
+    for _ in range(3):
+        db.save_message(CHAT_ID, 100, "user", "одно сообщение", message_id=42, reply_to_message_id=41)
+
+    assert [m.message_id for m in db.get_recent_messages(CHAT_ID)] == [42]
+    assert db.get_chat_counters(CHAT_ID).total == 1
+    with db.pool.reader() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM message_index").fetchone()[0] == 1
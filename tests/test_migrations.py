@@ -0,0 +1,203 @@
+"""
+Миграции схемы: обновление базы первой версии бота и перевод времени
+в секунды Unix на ходу
+"""
+
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from conftest import wait_migrations
+from database import SchemaMigrator
+
+# Схема базы до версионных миграций (messages - одна таблица, время текстом)
+BASELINE_SCHEMA = '''
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        user_name TEXT NOT NULL,
+        message_text TEXT,
+        message_type TEXT DEFAULT 'text',
+        media_file_id TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        reply_to_message_id INTEGER,
+        is_forwarded BOOLEAN DEFAULT 0
+    );
+    CREATE TABLE chat_settings (
+        chat_id INTEGER PRIMARY KEY,
+        daily_summary_enabled BOOLEAN DEFAULT 1,
+        summary_time TEXT DEFAULT '21:00',
+        pin_summary BOOLEAN DEFAULT 1,
+        bot_personality TEXT,
+        language TEXT DEFAULT 'ru',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE extracted_texts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        original_message_id INTEGER,
+        chat_id INTEGER NOT NULL,
+        extracted_text TEXT NOT NULL,
+        extraction_type TEXT NOT NULL,
+        confidence_score REAL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (original_message_id) REFERENCES messages (id)
+    );
+    CREATE TABLE command_stats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        command TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        success BOOLEAN DEFAULT 1
+    );
+    CREATE INDEX idx_messages_chat_timestamp ON messages(chat_id, timestamp DESC);
+    CREATE INDEX idx_messages_user ON messages(chat_id, user_id);
+    CREATE INDEX idx_messages_timestamp ON messages(timestamp);
+    CREATE INDEX idx_command_stats_timestamp ON command_stats(timestamp);
+'''
+
+START = datetime(2026, 8, 20)
+
+def create_baseline_db(path: str, chats: dict):
+    """База первой версии: {chat_id: число сообщений}, по сообщению в час"""
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    for chat_id, count in chats.items():
+        conn.executemany('''
+            INSERT INTO messages (chat_id, user_id, user_name, message_text, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (chat_id, 100 + i % 3, f"user{i % 3}", f"сообщение {chat_id}-{i}",
+             (START + timedelta(hours=i)).strftime('%Y-%m-%d %H:%M:%S'))
+            for i in range(count)
+        ])
+    conn.execute(
+        "INSERT INTO command_stats (chat_id, user_id, command) VALUES (1, 100, 'summary')"
+    )
+    conn.commit()
+    conn.close()
+
+def timestamp_types(db) -> set:
+    types = set()
+    with db.pool.reader() as conn:
+        for _, _, table in db._partitions:
+            types.update(row[0] for row in conn.execute(f"SELECT DISTINCT typeof(timestamp) FROM {table}"))
+    return types
+
+def test_upgrade_from_baseline(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / "chat_data.db"), {1: 60, 2: 30})
+
+    db = open_db()
+    wait_migrations(db)
+
+    with db.pool.reader() as conn:
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        command_columns = {row[1] for row in conn.execute("PRAGMA table_info(command_stats)")}
+        legacy = conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name IN ('messages_legacy', 'messages_fts')"
+        ).fetchone()[0]
+    assert applied == {m[0] for m in SchemaMigrator.MIGRATIONS}
+    assert {'wall_ms', 'llm_ms', 'outcome'} <= command_columns
+    assert legacy == 0
+
+    # Сообщения разложены по месячным разделам, время - секунды Unix
+    assert [name for _, _, name in db._partitions] == ['messages_p20260801']
+    assert timestamp_types(db) == {'integer'}
+
+    messages = db.get_recent_messages(1, limit=100)
+    assert len(messages) == 60
+    assert messages[0].text == "сообщение 1-0"
+    assert messages[0].timestamp == "2026-08-20 00:00:00"
+    assert messages[-1].text == "сообщение 1-59"
+    assert [m.id for m in messages] == sorted(m.id for m in messages)
+
+    # Признаки текста заполнены фоновой миграцией 5
+    with db.pool.reader() as conn:
+        missing = conn.execute(
+            "SELECT COUNT(*) FROM messages_p20260801 WHERE char_len IS NULL"
+        ).fetchone()[0]
+    assert missing == 0
+
+    # Новые сообщения продолжают сквозную нумерацию старой таблицы
+    assert db.save_message(2, 200, "new", "после обновления", message_id=5)
+    assert db.get_recent_messages(2, limit=1)[0].id == 91
+
+def test_upgrade_is_idempotent(tmp_path, open_db):
+    create_baseline_db(str(tmp_path / "chat_data.db"), {1: 10})
+    db = open_db()
+    wait_migrations(db)
+    db.close()
+
+    db = open_db()
+    wait_migrations(db)
+    assert db.migrator._thread is None
+    assert len(db.get_recent_messages(1, limit=100)) == 10
+
+def test_epoch_conversion_while_reading(tmp_path, open_db, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "DB_MIGRATION_BATCH_SIZE", 10)
+    monkeypatch.setattr(test_config, "DB_MIGRATION_PAUSE_MS", 2)
+    create_baseline_db(str(tmp_path / "chat_data.db"), {1: 400, 2: 200})
+
+    db = open_db()
+    expected = [f"сообщение 1-{i}" for i in range(400)]
+    reads_during_migration = 0
+    written = 0
+    while not db.migrator.is_applied(1):
+        reads_during_migration += 1
+
+        # Порядок выдачи и курсоры верны при смеси текстового и числового времени
+        assert [m.text for m in db.get_recent_messages(1, limit=1000)][:400] == expected
+
+        texts, cursor = [], None
+        while True:
+            page, cursor = db.get_messages_page(1, limit=70, cursor=cursor, newest_first=False)
+            texts += [m.text for m in page]
+            if cursor is None:
+                break
+        assert texts[:400] == expected
+
+        # Запись не блокируется миграцией
+        assert db.save_message(2, 300, "writer", f"во время миграции {written}")
+        written += 1
+
+    wait_migrations(db)
+    assert reads_during_migration > 0
+    assert db._epoch_timestamps
+    assert timestamp_types(db) == {'integer'}
+
+    chat2 = db.get_recent_messages(2, limit=1000)
+    assert len(chat2) == 200 + written
+    assert [m.text for m in chat2[200:]] == [f"во время миграции {i}" for i in range(written)]
+
+def test_migration_stops_and_resumes(tmp_path, open_db, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "DB_MIGRATION_BATCH_SIZE", 5)
+    create_baseline_db(str(tmp_path / "chat_data.db"), {1: 50})
+
+    db = open_db()
+    stop = threading.Event()
+    stop.set()
+    db.migrator.close()
+    assert db._migrate_epoch_timestamps(1, 'epoch_timestamps', stop) is False
+    assert not db.migrator.is_applied(1)
+    db.close()
+
+    db = open_db()
+    wait_migrations(db)
+    assert db.migrator.is_applied(1)
+    assert timestamp_types(db) == {'integer'}
+
+def test_fresh_database_starts_in_final_format(open_db):
+    db = open_db(shard_count=2)
+
+    # Переводить нечего: online-миграции не запускаются ни в каталоге, ни в шардах
+    for manager in [db] + db.shards:
+        assert manager.migrator._thread is None
+        assert manager._epoch_timestamps
+        with manager.pool.reader() as conn:
+            applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        assert applied == {m[0] for m in SchemaMigrator.MIGRATIONS}
+
+    db.save_message(1, 100, "user", "первое")
+    assert timestamp_types(db.shard_for(1)) == {'integer'}
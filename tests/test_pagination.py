@@ -0,0 +1,55 @@
+"""
+Постраничное чтение истории по курсору (keyset по (timestamp, id))
+"""
+
+from conftest import wait_migrations, epoch, history_row
+
+CHAT_ID = 7
+
+def walk_pages(db, limit: int, newest_first: bool) -> list:
+    messages, cursor = [], None
+    while True:
+        page, cursor = db.get_messages_page(CHAT_ID, limit=limit, cursor=cursor,
+                                            newest_first=newest_first)
+        assert len(page) <= limit
+        messages += page
+        if cursor is None:
+            return messages
+
+def test_page_cursors_with_equal_timestamps(open_db):
+    db = open_db()
+    wait_migrations(db)
+    # По 7 сообщений на одну секунду: порядок внутри секунды - по id
+    start = epoch(2026, 10, 1)
+    rows = [history_row(i, start + i // 7, f"сообщение {i}") for i in range(120)]
+    assert db.import_messages(CHAT_ID, rows) == 120
+
+    newest = walk_pages(db, 25, newest_first=True)
+    assert [m.message_id for m in newest] == list(range(119, -1, -1))
+
+    oldest = walk_pages(db, 25, newest_first=False)
+    assert [m.message_id for m in oldest] == list(range(120))
+
+    # Страница, кратная размеру истории, заканчивается пустой страницей без курсора
+    page, cursor = db.get_messages_page(CHAT_ID, limit=120)
+    assert len(page) == 120
+    assert db.get_messages_page(CHAT_ID, limit=120, cursor=cursor) == ([], None)
+
+def test_page_cursor_is_stable_under_writes(open_db):
+    db = open_db()
+    wait_migrations(db)
+    for i in range(10):
+        db.save_message(CHAT_ID, 100, "user", f"старое {i}", message_id=i + 1)
+
+    first, cursor = db.get_messages_page(CHAT_ID, limit=4)
+    assert [m.text for m in first] == [f"старое {i}" for i in (9, 8, 7, 6)]
+
+    # Новое сообщение не сдвигает следующие страницы
+    db.save_message(CHAT_ID, 100, "user", "новое", message_id=11)
+    second, cursor = db.get_messages_page(CHAT_ID, limit=4, cursor=cursor)
+    assert [m.text for m in second] == [f"старое {i}" for i in (5, 4, 3, 2)]
+
+    # Направление обхода хранится в курсоре
+    third, cursor = db.get_messages_page(CHAT_ID, limit=4, cursor=cursor, newest_first=False)
+    assert [m.text for m in third] == ["старое 1", "старое 0"]
+    assert cursor is None
@@ -0,0 +1,47 @@
+"""
+Учет времени запросов: имя запроса - метод базы, который его выполнил
+"""
+
+from datetime import datetime, timedelta
+
+from conftest import wait_migrations
+import database
+from database import query_monitor
+
+def query_names() -> dict:
+    return {row['name']: row['count'] for row in query_monitor.summary()}
+
+def test_queries_are_named_by_method(open_db):
+    db = open_db()
+    wait_migrations(db)
+    for i in range(3):
+        db.save_message(1, 100, "user", f"сообщение {i}", message_id=i + 1)
+    query_monitor.reset()
+
+    db.get_recent_messages(1)
+    db.search_messages(1, "сообщение")
+    now = datetime.now()
+    assert list(db.iter_messages_by_time_range(1, now - timedelta(days=1), now + timedelta(days=1)))
+    # Запросы вспомогательных методов обхода разделов - на счету вызвавшего
+    names = query_names()
+    assert {'get_recent_messages', 'search_messages', 'iter_messages_by_time_range'} <= set(names)
+    assert not set(names) & {'_query_partitions', '_stream_partitions', '_query_budget'}
+
+    # Вне методов базы - первые слова запроса
+    query_monitor.reset()
+    with db.pool.reader() as conn:
+        conn.execute("SELECT COUNT(*) FROM chat_counters").fetchone()
+    assert query_names() == {'SELECT COUNT(*)': 1}
+
+def test_inner_method_name_is_restored(open_db):
+    db = open_db()
+    wait_migrations(db)
+    query_monitor.reset()
+
+    # _insert_messages внутри save_message; после возврата имя снимается
+    db.save_message(1, 100, "user", "сообщение", message_id=1)
+    assert '_insert_messages' in query_names()
+    assert database._query_name.get() is None
+    with db.pool.reader() as conn:
+        conn.execute("SELECT 1").fetchone()
+    assert 'SELECT 1' in query_names()
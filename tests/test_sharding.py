@@ -0,0 +1,83 @@
+"""
+Шардирование: перенос сообщений основного файла в шарды по chat_id
+"""
+
+from datetime import datetime
+
+from conftest import wait_migrations, epoch, history_row
+
+def test_move_messages_to_shards(tmp_path, open_db, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "DB_MIGRATION_BATCH_SIZE", 7)
+
+    db = open_db(shard_count=0)
+    for chat_id in (1, 2, 3, 4):
+        for i in range(chat_id * 10):
+            db.save_message(chat_id, 100 + chat_id, f"user{chat_id}", f"{chat_id}:{i}",
+                            username=f"login{chat_id}", message_id=i + 1)
+    wait_migrations(db)
+    db.close()
+
+    db = open_db(shard_count=2)
+    wait_migrations(db)
+
+    # Основной файл остался каталогом без сообщений
+    assert db._partitions == []
+    with db.pool.reader() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM message_index").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+    for chat_id in (1, 2, 3, 4):
+        shard = db.shard_for(chat_id)
+        other = db.shards[1 - db.shards.index(shard)]
+        messages = db.get_recent_messages(chat_id, limit=100)
+        assert [m.text for m in messages] == [f"{chat_id}:{i}" for i in range(chat_id * 10)]
+        assert other.get_recent_messages(chat_id, limit=100) == []
+
+        # Индекс message_id и справочник пользователей переехали вместе с сообщениями
+        assert db.get_message(chat_id, 3).text == f"{chat_id}:2"
+        assert shard.find_user_ids(f"login{chat_id}") == [100 + chat_id]
+    db.close()
+
+    # Повторный запуск ничего не переносит и не теряет
+    db = open_db(shard_count=2)
+    assert sum(len(db.get_recent_messages(chat_id, limit=100)) for chat_id in (1, 2, 3, 4)) == 100
+
+def test_move_keeps_message_ids(open_db):
+    db = open_db(shard_count=0)
+    # Чаты вперемешку: у каждого шарда id идут с пропусками
+    for i in range(20):
+        db.save_message(i % 2 + 1, 100, "user", f"сообщение {i}", message_id=i + 1)
+    before = {chat_id: [(m.id, m.text) for m in db.get_recent_messages(chat_id)] for chat_id in (1, 2)}
+    db.close()
+
+    db = open_db(shard_count=2)
+    after = {chat_id: [(m.id, m.text) for m in db.get_recent_messages(chat_id)] for chat_id in (1, 2)}
+    assert after == before
+
+    # Новые сообщения шарда получают id после перенесенных в него
+    db.save_message(1, 100, "user", "новое", message_id=100)
+    assert db.get_recent_messages(1, limit=1)[0].id == max(m_id for m_id, _ in before[1]) + 1
+
+def test_move_archive_to_shards(open_db):
+    db = open_db(shard_count=0)
+    wait_migrations(db)
+    for chat_id in (1, 2):
+        rows = [history_row(i, epoch(2025, 3, 1) + i * 3600, f"груша {chat_id}-{i}") for i in range(10)]
+        assert db.import_messages(chat_id, rows) == 10
+        db.save_message(chat_id, 100, "user", f"свежее {chat_id}", message_id=1000)
+    assert db.cleanup_old_messages(days=90) == 20
+    archived_ids = [m.id for m in db.iter_messages_by_time_range(1, datetime(2025, 3, 1), datetime(2025, 4, 1))]
+    assert len(archived_ids) == 10
+    db.close()
+
+    db = open_db(shard_count=2)
+    with db.pool.reader() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM message_archive").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM archive_dictionaries").fetchone()[0] == 0
+
+    for chat_id in (1, 2):
+        history = list(db.iter_messages_by_time_range(chat_id, datetime(2025, 3, 1), datetime(2025, 4, 1)))
+        assert [m.text for m in history] == [f"груша {chat_id}-{i}" for i in range(10)]
+        assert db.search_messages(chat_id, "груша", limit=2)[0]['snippet'] == f"«груша» {chat_id}-9"
+        assert [m.text for m in db.get_recent_messages(chat_id)] == [f"свежее {chat_id}"]
+    assert [m.id for m in db.iter_messages_by_time_range(1, datetime(2025, 3, 1), datetime(2025, 4, 1))] == archived_ids
@@ -0,0 +1,46 @@
+"""
+Статистика чата по почасовым сводкам и их очистка
+"""
+
+import time
+
+from conftest import wait_migrations, history_row
+
+CHAT_ID = 5
+DAY = 86400
+
+def stats_rows(db) -> tuple:
+    with db.pool.reader() as conn:
+        return tuple(
+            conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ('chat_stats_hourly', 'user_stats_hourly')
+        )
+
+def test_statistics_from_rollups(open_db):
+    db = open_db()
+    for i in range(6):
+        db.save_message(CHAT_ID, 100 + i % 2, f"user{i % 2}", f"сообщение {i}",
+                        message_type='voice' if i == 5 else 'text')
+    db.save_message(CHAT_ID + 1, 100, "user0", "другой чат")
+
+    stats = db.get_chat_statistics(CHAT_ID, days=1)
+    assert stats['total_messages'] == 6
+    assert stats['message_types'] == {'text': 5, 'voice': 1}
+    assert stats['active_users'] == 2
+    assert sorted((u['user'], u['count']) for u in stats['top_users']) == [("user0", 3), ("user1", 3)]
+
+def test_cleanup_prunes_old_rollups(open_db, test_config, monkeypatch):
+    monkeypatch.setattr(test_config, "MAX_STATS_DAYS", 365)
+    db = open_db()
+    wait_migrations(db)
+    now = int(time.time())
+    rows = [history_row(1, now - 400 * DAY, "давнее"), history_row(2, now - 200 * DAY, "старое")]
+    assert db.import_messages(CHAT_ID, rows) == 2
+    db.save_message(CHAT_ID, 100, "user0", "свежее")
+    assert stats_rows(db) == (3, 3)
+
+    db.cleanup_old_messages(days=90)
+
+    # Сводки старше MAX_STATS_DAYS удалены, /stats за год не изменился
+    assert stats_rows(db) == (2, 2)
+    assert db.get_chat_statistics(CHAT_ID, days=365)['total_messages'] == 2
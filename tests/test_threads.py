@@ -0,0 +1,55 @@
+"""
+Ветки ответов: корень ветки записывается при сохранении, ветка читается по индексу
+"""
+
+from conftest import wait_migrations, epoch, history_row
+
+CHAT_ID = 7
+
+def thread_ids(db, message_id: int, **kwargs) -> list:
+    return [m.message_id for m in db.get_thread_messages(CHAT_ID, message_id, **kwargs)]
+
+def test_nested_replies_share_root(open_db):
+    db = open_db()
+    wait_migrations(db)
+    db.save_message(CHAT_ID, 100, "a", "вопрос", message_id=1)
+    db.save_message(CHAT_ID, 101, "b", "ответ", message_id=2, reply_to_message_id=1)
+    db.save_message(CHAT_ID, 100, "a", "ответ на ответ", message_id=3, reply_to_message_id=2)
+    db.save_message(CHAT_ID, 102, "c", "другая тема", message_id=4)
+    db.save_message(CHAT_ID, 101, "b", "про другую тему", message_id=5, reply_to_message_id=4)
+    db.save_message(CHAT_ID, 102, "c", "снова про вопрос", message_id=6, reply_to_message_id=3)
+
+    for member in (1, 2, 3, 6):
+        assert thread_ids(db, member) == [1, 2, 3, 6]
+    assert thread_ids(db, 5) == [4, 5]
+
+    # limit - последние сообщения ветки, по-прежнему по порядку
+    assert thread_ids(db, 1, limit=2) == [3, 6]
+    assert [m.text for m in db.get_thread_messages(CHAT_ID, 6, limit=1)] == ["снова про вопрос"]
+
+def test_reply_to_unsaved_message(open_db):
+    db = open_db()
+    wait_migrations(db)
+    # Корень ветки написан до запуска бота: ветка держится на его id
+    db.save_message(CHAT_ID, 100, "a", "ответ", message_id=11, reply_to_message_id=10)
+    db.save_message(CHAT_ID, 101, "b", "еще ответ", message_id=12, reply_to_message_id=11)
+
+    assert thread_ids(db, 12) == [11, 12]
+    assert thread_ids(db, 10) == [11, 12]
+    assert thread_ids(db, 999) == []
+
+def test_imported_thread_across_partitions(open_db):
+    db = open_db()
+    wait_migrations(db)
+    rows = [
+        history_row(1, epoch(2026, 8, 31, 23, 0), "вопрос в августе"),
+        history_row(2, epoch(2026, 9, 1, 9, 0), "другое"),
+        dict(history_row(3, epoch(2026, 9, 2), "ответ в сентябре"), reply_to_message_id=1),
+        dict(history_row(4, epoch(2026, 10, 5), "ответ в октябре"), reply_to_message_id=3),
+    ]
+    assert db.import_messages(CHAT_ID, rows) == 4
+    assert len(db._partitions) == 3
+
+    thread = db.get_thread_messages(CHAT_ID, 4)
+    assert [m.message_id for m in thread] == [1, 3, 4]
+    assert [m.text for m in thread] == ["вопрос в августе", "ответ в сентябре", "ответ в октябре"]
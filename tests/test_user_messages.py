@@ -0,0 +1,45 @@
+"""
+Сообщения участника: поиск по имени и последние сообщения по user_id
+"""
+
+from conftest import wait_migrations, epoch, history_row
+
+CHAT_ID = 7
+
+def test_user_messages_with_equal_timestamps(open_db):
+    db = open_db()
+    wait_migrations(db)
+    # Все сообщения в одну секунду: новее то, что записано позже
+    start = epoch(2026, 10, 1)
+    assert db.import_messages(CHAT_ID, [history_row(i, start, f"сообщение {i}") for i in range(20)]) == 20
+
+    messages = db.get_messages_by_user_ids(CHAT_ID, [100], limit=5)
+    assert [m.message_id for m in messages] == [18, 16, 14, 12, 10]
+    assert [m.id for m in messages] == sorted((m.id for m in messages), reverse=True)
+
+def test_find_user_by_any_name_casefold(open_db):
+    db = open_db()
+    db.save_message(CHAT_ID, 100, "Алёна", "привет", username="Alena_K", first_name="Алёна")
+    db.save_message(CHAT_ID, 101, "ЁЖИК", "и тебе")
+    # Имя без username не затирает известный username
+    db.save_message(CHAT_ID, 100, "Алёна", "как дела", first_name="Алёна")
+
+    # NOCASE в SQLite сравнивает только латиницу - ключ строится через casefold()
+    assert db.find_user_ids("алёна") == [100]
+    assert db.find_user_ids("АЛЁНА") == [100]
+    assert db.find_user_ids("@alena_k") == [100]
+    assert db.find_user_ids("ёжик") == [101]
+    assert db.find_user_ids("Алена") == []
+
+    assert [m.text for m in db.get_user_messages(CHAT_ID, "@ALENA_K")] == ["как дела", "привет"]
+    with db.pool.reader() as conn:
+        assert conn.execute("SELECT username FROM users WHERE user_id = 100").fetchone() == ("Alena_K",)
+
+def test_find_user_in_chat_shard(open_db):
+    db = open_db(shard_count=2)
+    db.save_message(1, 100, "Маша", "в нечетном чате")
+    db.save_message(2, 200, "маша", "в четном чате")
+
+    assert db.find_user_ids("МАША", chat_id=1) == [100]
+    assert db.find_user_ids("МАША", chat_id=2) == [200]
+    assert db.find_user_ids("МАША") == [100, 200]
@@ -0,0 +1,150 @@
+"""
+Буфер отложенной записи сообщений (MessageBuffer) и его сброс в базу
+"""
+
+import time
+import threading
+
+import pytest
+
+from database import MessageBuffer
+
+HOUR_MS = 3600 * 1000
+
+def wait_for(condition, timeout: float = 2.0):
+    """Ожидание условия, которое выполняет фоновый поток буфера"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.005)
+
+class Recorder:
+    """Функция сброса, запоминающая пачки; gate задерживает сброс"""
+
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, rows):
+        self.gate.wait()
+        self.batches.append(list(rows))
+
+    @property
+    def rows(self):
+        return [row for batch in self.batches for row in batch]
+
+@pytest.fixture
+def make_buffer():
+    buffers = []
+
+    def _make(**kwargs):
+        recorder = Recorder()
+        buffers.append((MessageBuffer(recorder, **kwargs), recorder))
+        return buffers[-1]
+
+    yield _make
+    for buffer, recorder in buffers:
+        recorder.gate.set()
+        buffer.close()
+
+def test_flush_at_max_rows(make_buffer):
+    buffer, recorder = make_buffer(max_rows=5, interval_ms=HOUR_MS)
+    for i in range(4):
+        buffer.put({'n': i})
+    time.sleep(0.05)
+    assert recorder.batches == []
+
+    buffer.put({'n': 4})
+    wait_for(lambda: recorder.batches)
+    assert recorder.batches == [[{'n': i} for i in range(5)]]
+    assert len(buffer) == 0
+
+def test_flush_on_interval(make_buffer):
+    buffer, recorder = make_buffer(max_rows=1000, interval_ms=20)
+    buffer.put({'n': 1})
+    wait_for(lambda: recorder.batches)
+    assert recorder.rows == [{'n': 1}]
+
+def test_full_buffer_blocks_producer(make_buffer):
+    buffer, recorder = make_buffer(max_rows=1000, interval_ms=HOUR_MS, capacity=3)
+
+    # Первый сброс "завис" в базе, за это время буфер снова заполнился
+    recorder.gate.clear()
+    for i in range(3):
+        buffer.put({'n': i})
+    slow_flush = threading.Thread(target=buffer.flush)
+    slow_flush.start()
+    wait_for(lambda: len(buffer) == 0)
+    for i in range(3, 6):
+        buffer.put({'n': i})
+
+    producer = threading.Thread(target=buffer.put, args=({'n': 6},))
+    producer.start()
+    time.sleep(0.1)
+    assert producer.is_alive()
+
+    # Сброс освободил место - отправитель продолжает, строки не теряются
+    recorder.gate.set()
+    producer.join(2)
+    slow_flush.join(2)
+    assert not producer.is_alive()
+    buffer.flush()
+    assert sorted(row['n'] for row in recorder.rows) == list(range(7))
+
+def test_put_without_blocking(make_buffer):
+    buffer, recorder = make_buffer(max_rows=1000, interval_ms=HOUR_MS, capacity=2)
+    assert buffer.put({'n': 1}, block=False)
+    assert buffer.put({'n': 2}, block=False)
+    assert buffer.put({'n': 3}, block=False) is False
+
+    # Переполнение будит фоновый сброс, отклоненная строка не записывается
+    wait_for(lambda: recorder.batches)
+    assert recorder.rows == [{'n': 1}, {'n': 2}]
+    assert buffer.put({'n': 4}, block=False)
+
+def test_close_flushes_pending(make_buffer):
+    buffer, recorder = make_buffer(max_rows=1000, interval_ms=HOUR_MS)
+    buffer.put({'n': 1})
+    buffer.close()
+    assert recorder.rows == [{'n': 1}]
+
+@pytest.fixture
+def buffered_db(open_db, test_config, monkeypatch):
+    """База с буфером, который сам не сбрасывается во время теста"""
+    monkeypatch.setattr(test_config, "DB_WRITE_BUFFER_MAX_ROWS", 1000)
+    monkeypatch.setattr(test_config, "DB_WRITE_BUFFER_FLUSH_MS", HOUR_MS)
+    return open_db(write_buffer=True)
+
+def test_read_after_write(buffered_db):
+    db = buffered_db
+    for i in range(3):
+        assert db.save_message(1, 100, "user", f"сообщение {i}", message_id=i + 1)
+    assert len(db.buffer) == 3
+
+    # Чтение сначала сбрасывает буфер: свои же сообщения видны сразу
+    assert [m.text for m in db.get_recent_messages(1)] == [f"сообщение {i}" for i in range(3)]
+    assert len(db.buffer) == 0
+    assert db.flush_messages() == 0
+
+    db.save_message(1, 100, "user", "еще одно", message_id=4)
+    assert db.get_message(1, 4).text == "еще одно"
+
+def test_failed_batch_keeps_good_rows(buffered_db):
+    db = buffered_db
+    db.save_message(1, 100, "user", "первое", message_id=1)
+    # Текст не строка: ошибка при разборе строки, а не в SQLite
+    db.save_message(1, 100, "user", 12345, message_id=2)
+    db.save_message(1, 100, "user", "третье", message_id=3)
+
+    assert db.flush_messages() == 3
+    assert [m.text for m in db.get_recent_messages(1)] == ["первое", "третье"]
+    assert db.get_chat_counters(1).total == 2
+
+def test_close_writes_buffer(tmp_path, buffered_db, open_db):
+    db = buffered_db
+    db.save_message(1, 100, "user", "перед остановкой")
+    db.close()
+
+    reopened = open_db()
+    assert [m.text for m in reopened.get_recent_messages(1)] == ["перед остановкой"]